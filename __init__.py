@@ -6,6 +6,27 @@ from pci import *
 from mmio import *
 from xhci import *
 from cse_controller import *
+from dumpstore import *
+from sbsweep import *
+from addrmap import *
+from cache import *
+from profiler import *
+from dcitrace import *
+from replay import *
+from offline import *
+from dispatch import *
+from dumpwriter import *
+from search import *
+from uploader import *
+from checkpoint import *
+from monitor import *
+from scheduler import *
+from session import *
+from functrace import *
+from snapdiff import *
+from export import *
+from sparsedump import *
+# sim and bench are imported on demand (import sim / python bench.py)
 
 try:
     t.halt()
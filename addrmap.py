@@ -0,0 +1,330 @@
+import bisect
+import struct
+from utils import *
+from proc import *
+from segments import GDTEntry
+from pci import PCIDevice
+import mem
+
+# ATT entries (base, size, external low/high, control), 0x20 bytes each
+ATT_BASE = 0xF00A8000
+ATT_ENTRIES = 8
+
+PCI_ECAM = (0xE0000000, 0x10000000)
+
+class AddressRange(object):
+    """
+    [start, end) with where it comes from and what it is
+
+    attrs are free form, the ones the tools look at are cacheable, mmio,
+    device, selector and host (ATT windows).
+    """
+    __slots__ = ("start", "end", "kind", "source", "attrs")
+
+    def __init__(self, start, end, kind, source, **attrs):
+        self.start = start
+        self.end = end
+        self.kind = kind
+        self.source = source
+        self.attrs = attrs
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+    def get(self, name, default=None):
+        return self.attrs.get(name, default)
+
+    def __str__(self):
+        attrs = " ".join("%s=%s" % (name, hex(value) if isinstance(value, (int, long)) and
+                                    not isinstance(value, bool) else value)
+                         for (name, value) in sorted(self.attrs.items()))
+        return "0x%08X-0x%08X %-9s %s %s" % (self.start, self.end, self.kind, self.source, attrs)
+
+def _size(address_range):
+    return address_range.end - address_range.start
+
+class AddressMap(object):
+    """
+    Interval index over possibly overlapping ranges
+
+    The space is cut at every range boundary and each slice keeps the
+    ranges covering it, smallest first. Point lookups are a bisect and
+    adding or removing a range only touches the slices it spans, so
+    sources can be replaced (by key) without rebuilding the index.
+    """
+
+    def __init__(self, ranges=()):
+        self.bounds = [0]
+        self.covers = [()]
+        self.keys = {}
+        for address_range in ranges:
+            self.add(address_range)
+
+    def __cut(self, addr):
+        idx = bisect.bisect_right(self.bounds, addr) - 1
+        if self.bounds[idx] == addr:
+            return idx
+        self.bounds.insert(idx + 1, addr)
+        self.covers.insert(idx + 1, self.covers[idx])
+        return idx + 1
+
+    def __merge(self, idx):
+        if 0 < idx < len(self.bounds) and self.covers[idx] == self.covers[idx - 1]:
+            del self.bounds[idx]
+            del self.covers[idx]
+
+    def add(self, address_range, key=None):
+        if address_range.end <= address_range.start:
+            return
+        first = self.__cut(address_range.start)
+        last = self.__cut(address_range.end)
+        for idx in xrange(first, last):
+            self.covers[idx] = tuple(sorted(self.covers[idx] + (address_range, ), key=_size))
+        if key is not None:
+            self.keys.setdefault(key, []).append(address_range)
+
+    def remove(self, address_range):
+        first = bisect.bisect_left(self.bounds, address_range.start)
+        last = bisect.bisect_left(self.bounds, address_range.end)
+        for idx in xrange(first, last):
+            self.covers[idx] = tuple(cover for cover in self.covers[idx] if cover is not address_range)
+        self.__merge(last)
+        self.__merge(first)
+
+    def replace(self, key, ranges):
+        """
+        Swap the ranges previously added with key for new ones
+        """
+        for address_range in self.keys.pop(key, []):
+            self.remove(address_range)
+        for address_range in ranges:
+            self.add(address_range, key)
+
+    def lookup(self, addr):
+        """
+        Ranges containing addr, smallest first
+        """
+        return self.covers[bisect.bisect_right(self.bounds, addr) - 1]
+
+    def classify(self, addr):
+        covers = self.lookup(addr)
+        return covers[0] if covers else None
+
+    def overlapping(self, start, size):
+        first = bisect.bisect_right(self.bounds, start) - 1
+        last = bisect.bisect_left(self.bounds, start + size)
+        seen = set()
+        result = []
+        for idx in xrange(first, max(last, first + 1)):
+            for address_range in self.covers[idx]:
+                if id(address_range) not in seen:
+                    seen.add(id(address_range))
+                    result.append(address_range)
+        return result
+
+    def ranges(self):
+        return sorted(set(cover for covers in self.covers for cover in covers),
+                      key=lambda address_range: (address_range.start, address_range.end))
+
+def descriptor_tables(thread=None):
+    """
+    (gdtbas, gdtlim, ldtbas, ldtlim) of a thread
+    """
+    thread = thread if thread is not None else t
+    return tuple(int(thread.arch_register(name)) for name in ("gdtbas", "gdtlim", "ldtbas", "ldtlim"))
+
+def segment_ranges(thread=None, tables=None):
+    """
+    Linear ranges of the present GDT and LDT entries, with their selector
+    """
+    thread = thread if thread is not None else t
+    tables = tables if tables is not None else descriptor_tables(thread)
+    ranges = []
+    for (table, flags, base, limit) in (("gdt", 0) + tables[:2], ("ldt", 7) + tables[2:]):
+        entries = (limit + 1) // 8
+        if entries <= 0:
+            continue
+        data = thread.memblock("0x%XL" % base, entries * 8, 1).ToRawBytes()
+        for (i, entry) in enumerate(GDTEntry.table(data)):
+            if entry.present_value:
+                ranges.append(AddressRange(entry.base_value, entry.base_value + entry.size_value, "segment",
+                                           "%s %d" % (table.upper(), i), selector=i << 3 | flags, table=table))
+    return ranges
+
+class SystemMap(object):
+    """
+    What every physical address of a thread is, from all the known sources
+
+    MMIOS lists, PCI ECAM, PCI BARs, ATT windows and the sideband window
+    are indexed in phys, GDT/LDT segments in linear. Each source is kept
+    under its own key so update_att()/update_bars()/update_segments()
+    only replace their part. ATT changes made through mem.setup_att or
+    mem.att_window are picked up automatically once attach()ed, refresh()
+    re-reads the sideband window, the segments and the BARs of the devices
+    given to update_bars().
+    """
+
+    def __init__(self, thread=None, build=True):
+        self.thread = thread if thread is not None else t
+        self.phys = AddressMap()
+        self.linear = AddressMap()
+        self.selectors = (None, {})
+        self.tables = None
+        self.devices = {}
+        if build:
+            self.build()
+
+    def build(self):
+        self.add_mmios()
+        self.add_pci_ecam()
+        for update in (self.update_att, self.update_sideband, self.update_segments):
+            try:
+                update()
+            except Exception as e:
+                print("Address map: %s failed: %s" % (update.__name__, e))
+
+    def add_ram(self, addr, size, source="RAM"):
+        self.phys.add(AddressRange(addr, addr + size, "ram", source, cacheable=True), "ram")
+
+    def add_mmios(self):
+        self.phys.replace("mmios", [AddressRange(addr, addr + size, "mmio", "MMIOS", mmio=True, cacheable=False)
+                                    for (addr, size) in proc_get_address(self.thread, "MMIOS", [])])
+
+    def add_pci_ecam(self, base=PCI_ECAM[0], size=PCI_ECAM[1]):
+        self.phys.replace("ecam", [AddressRange(base, base + size, "pci-ecam", "PCI ECAM", mmio=True,
+                                                device="pci", cacheable=False)])
+
+    def update_att(self):
+        data = bytes(bytearray(self.thread.memblock(mem.phys(ATT_BASE), 0x20 * ATT_ENTRIES, 1).ToRawBytes()))
+        ranges = []
+        for entry in xrange(ATT_ENTRIES):
+            base, size, ext_lo, ext_hi, control = struct.unpack_from("<IIIII", data, 0x20 * entry)
+            if control & 1 and size and control != 0xFFFFFFFF:
+                ranges.append(AddressRange(base, base + size, "att", "ATT %d" % entry,
+                                           host=ext_lo | ext_hi << 32, cacheable=False))
+        self.phys.replace("att", ranges)
+
+    def update_sideband(self):
+        channel = proc_get_address(self.thread, "SB_CHANNEL")
+        if not channel:
+            return
+        data = bytes(bytearray(self.thread.memblock(mem.phys(channel), 8, 1).ToRawBytes()))
+        window, size = struct.unpack("<II", data)
+        ranges = [AddressRange(channel, channel + 0x20, "mmio", "Sideband channel", mmio=True, cacheable=False)]
+        if window and size:
+            ranges.append(AddressRange(window, window + size, "sideband", "Sideband window", mmio=True,
+                                       device="sideband", cacheable=False))
+        self.phys.replace("sideband", ranges)
+
+    def update_bars(self, devices, base_address=PCI_ECAM[0]):
+        """
+        Re-read the memory BARs of (bus, dev, func) devices
+        """
+        for (bus, dev, func) in devices:
+            self.devices[(bus, dev, func)] = base_address
+            device = PCIDevice(bus, dev, func, self.thread, base_address)
+            name = "%d.%d.%d" % (bus, dev, func)
+            data = bytes(bytearray(self.thread.memblock(mem.phys(device.getIOAddress(0x10)), 0x18, 1).ToRawBytes()))
+            ranges = []
+            for (i, bar) in enumerate(struct.unpack("<6I", data)):
+                # Memory BARs only, sized like list_pci_devices dumps them
+                if bar not in (0, 0xFFFFFFFF) and not bar & 1:
+                    ranges.append(AddressRange(bar & ~0xF, (bar & ~0xF) + 0x1000, "bar", "PCI %s BAR%d" % (name, i),
+                                               mmio=True, device=name, cacheable=False))
+            self.phys.replace("bar:" + name, ranges)
+
+    def update_segments(self):
+        self.tables = descriptor_tables(self.thread)
+        self.linear.replace("segments", segment_ranges(self.thread, self.tables))
+
+    def refresh(self):
+        """
+        Re-read what the firmware can change behind our back
+        """
+        self.update_sideband()
+        self.update_segments()
+        for (device, base_address) in self.devices.items():
+            self.update_bars([device], base_address)
+
+    def paging(self):
+        return int(self.thread.arch_register("cr0")) & 0x80000001 == 0x80000001
+
+    def attach(self):
+        """
+        Follow ATT changes made by mem.setup_att/mem.att_window
+        """
+        listeners = mem.get_att_listeners()
+        if self.update_att not in listeners:
+            listeners.append(self.update_att)
+
+    def detach(self):
+        listeners = mem.get_att_listeners()
+        if self.update_att in listeners:
+            listeners.remove(self.update_att)
+
+    def lookup(self, addr, space="P"):
+        return (self.linear if space == "L" else self.phys).lookup(addr)
+
+    def classify(self, addr, space="P"):
+        return (self.linear if space == "L" else self.phys).classify(addr)
+
+    def cacheable(self, addr, size=1):
+        return all(address_range.get("cacheable", True) for address_range in self.phys.overlapping(addr, size))
+
+    def segment(self, linear, table=None, exact=True):
+        """
+        Smallest segment starting at a linear address, or if not exact
+        containing it
+        """
+        candidates = [address_range for address_range in self.linear.lookup(linear)
+                      if (table is None or address_range.get("table") == table) and
+                      (not exact or address_range.start == linear)]
+        return candidates[0] if candidates else None
+
+    def by_selector(self, selector):
+        """
+        Segment of a selector, RPL ignored
+        """
+        segments = self.linear.keys.get("segments")
+        if self.selectors[0] is not segments:
+            self.selectors = (segments, dict((address_range.get("selector") & ~3, address_range)
+                                             for address_range in segments or ()))
+        return self.selectors[1].get(selector & ~3)
+
+    def selector(self, linear, table=None):
+        segment = self.segment(linear, table)
+        return segment.get("selector") if segment is not None else None
+
+    def print_map(self, space="P"):
+        for address_range in (self.linear if space == "L" else self.phys).ranges():
+            print(address_range)
+
+address_map = None
+
+def system_map(thread=None, rebuild=False, refresh=False, tables=None):
+    """
+    Shared SystemMap of the current thread (or session), built on first use
+
+    Nothing is read from the target once built: refresh re-reads
+    everything refresh() does (e.g. after the firmware reprogrammed BARs or
+    LDT entries), and a caller that read the descriptor_tables() can pass
+    them as tables to have the segments re-read if the GDT/LDT moved.
+    """
+    global address_map
+    session = current_session()
+    shared = session.address_map if session is not None else address_map
+    if shared is None or rebuild or (thread is not None and shared.thread is not thread):
+        if shared is not None:
+            shared.detach()
+        shared = SystemMap(thread if thread is not None or session is None else session.thread)
+        shared.attach()
+        if session is not None:
+            session.address_map = shared
+        else:
+            address_map = shared
+    elif refresh:
+        shared.refresh()
+    elif tables is not None and shared.tables is not None and tuple(tables) != shared.tables:
+        shared.update_segments()
+    return shared
@@ -169,10 +169,9 @@ def printStackContent():
     idx = ss[3:15]
     base = t.arch_register("ldtbas" if table else "gdtbas")
     segment = GDTEntry(t.memblock(str(base.ToUInt32() + 8 * idx.ToUInt32()) + "L", 8, 1))
-    limit = segment.limit
     print("ESP : %s" % esp.ToHex())
-    esp = esp & ~0xF
-    t.memdump(ss.ToHex() + ":" + esp.ToHex(), limit - esp, 1)
+    esp = esp.ToUInt32() & ~0xF
+    t.memdump(ss.ToHex() + ":" + hex(esp), segment.limit - esp, 1)
 
 def peek(register, offset=0, size=4, value=None):
     ds = reg("ds")
@@ -197,7 +196,8 @@ def ebp(*args, **kwargs):
 
 def force_32_bit_asmmode(did):
     return '32Bit'
-ipc.devs.base.cmds._instruction_size = force_32_bit_asmmode
+if ipc is not None:
+    ipc.devs.base.cmds._instruction_size = force_32_bit_asmmode
 
 
 def reset_me():
@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import traceback
+
+if __name__ == "__main__":
+    # Don't try to open a DCI connection, everything runs against sim.py
+    os.environ.setdefault("IPCLIB_OFFLINE", "1")
+
+from utils import *
+from proc import *
+from mem import *
+from segments import *
+from pci import *
+from mmio import *
+from xhci import XHCI
+from dumpwriter import save_mmios_pipelined
+from sim import *
+import mem as mem_module
+import xhci as xhci_module
+import utils as utils_module
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Benchmarks of the heavy workflows, run against a fresh simulated board.
+# Each one gets (target, workdir) and the library's globals pointing at target.
+BENCHMARKS = []
+# Benchmarks whose transaction count depends on timing (merged reads)
+VARIABLE_COUNTS = set()
+
+def benchmark(name, paging=False, exact=True):
+    def register(func):
+        BENCHMARKS.append((name, func, paging))
+        if not exact:
+            VARIABLE_COUNTS.add(name)
+        return func
+    return register
+
+@benchmark("save_mmios")
+def bench_save_mmios(target, workdir):
+    mmios = [(addr, size) for (addr, size) in proc_get_address(target, "MMIOS") if size <= 0x10000]
+    save_mmios(target, workdir, mmios)
+
+@benchmark("save_mmios_pipelined", exact=False)
+def bench_save_mmios_pipelined(target, workdir):
+    mmios = [(addr, size) for (addr, size) in proc_get_address(target, "MMIOS") if size <= 0x10000]
+    save_mmios_pipelined(target, workdir, mmios)
+
+@benchmark("list_pci_devices")
+def bench_list_pci_devices(target, workdir):
+    list_pci_devices(target)
+
+@benchmark("print_pages", paging=True)
+def bench_print_pages(target, workdir):
+    print_pages()
+    for addr in xrange(0, 0x400000, 0x40000):
+        linear_to_phys(addr)
+
+@benchmark("print_segments")
+def bench_print_segments(target, workdir):
+    print_segments()
+
+@benchmark("xhci_setup")
+def bench_xhci_setup(target, workdir):
+    xhci_module.xhci = XHCI(target)
+    xhci_module.xhci.setup()
+
+@benchmark("sideband_bruteforce")
+def bench_sideband_bruteforce(target, workdir):
+    Sideband(target).bruteforce(0x0100)
+
+@benchmark("dram")
+def bench_dram(target, workdir):
+    dram(0x100000000, 0x10000)
+
+def _peak_memory():
+    # Peak of what got allocated since tracemalloc.start(), so the run's own
+    # usage. Without tracemalloc, run_forked reports the child's peak RSS.
+    if tracemalloc is not None:
+        return tracemalloc.get_traced_memory()[1]
+    return None
+
+def _peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def run_forked(name, func, paging=False, latency=0.0, per_byte=0.0, verbose=False):
+    """
+    run_benchmark in a forked child, whose peak RSS is the run's peak memory
+    """
+    sys.stdout.flush()
+    (read, write) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read)
+            metrics = run_benchmark(name, func, paging, latency, per_byte, verbose)
+            metrics["peak_memory"] = _peak_rss()
+            with os.fdopen(write, "w") as f:
+                json.dump(metrics, f)
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            os._exit(status)
+    os.close(write)
+    with os.fdopen(read, "r") as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    if not data:
+        raise Exception("Benchmark %s failed" % name)
+    return json.loads(data)
+
+def run_benchmark(name, func, paging=False, latency=0.0, per_byte=0.0, verbose=False):
+    target = simulated_board(latency=latency, per_byte=per_byte)
+    if paging:
+        enable_paging(target)
+    target.reset_counters()
+    previous = install_simulation(target)
+    previous_xhci = getattr(xhci_module, "xhci", None)
+    mem_module.dma_heap = None
+    workdir = tempfile.mkdtemp(prefix="ipclib-bench-")
+    cwd = os.getcwd()
+    dumps = utils_module.pwd
+    stdout = sys.stdout
+    if tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        os.chdir(workdir)
+        utils_module.pwd = workdir
+        if not verbose:
+            sys.stdout = open(os.devnull, "w")
+        start = time.time()
+        func(target, workdir)
+        elapsed = time.time() - start
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+        os.chdir(cwd)
+        utils_module.pwd = dumps
+        peak = _peak_memory()
+        if tracemalloc is not None:
+            tracemalloc.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+        uninstall_simulation(previous)
+        xhci_module.xhci = previous_xhci
+    return {"time": elapsed, "transactions": target.transactions,
+            "bytes": target.bytes_read + target.bytes_written, "peak_memory": peak}
+
+def run_benchmarks(names=None, latency=0.0, per_byte=0.0, repeat=1, verbose=False):
+    """
+    Run the benchmarks (all of them by default) and return {name: metrics}
+    The fastest of repeat runs is kept. Without tracemalloc, each run is
+    forked (where possible) to measure its peak memory.
+    """
+    run = run_benchmark
+    if tracemalloc is None and resource is not None and hasattr(os, "fork"):
+        run = run_forked
+    results = {}
+    for (name, func, paging) in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for i in xrange(repeat):
+            metrics = run(name, func, paging, latency, per_byte, verbose)
+            if name not in results or metrics["time"] < results[name]["time"]:
+                results[name] = metrics
+        print_result(name, results[name])
+    return results
+
+def print_result(name, metrics, baseline=None):
+    line = "%-22s %9.3fs %9d transactions %11d bytes" % (name, metrics["time"], metrics["transactions"],
+                                                           metrics["bytes"])
+    if metrics.get("peak_memory") is not None:
+        line += " %9.1f MB peak" % (metrics["peak_memory"] / (1024.0 * 1024))
+    if baseline is not None:
+        line += "  (%+.1f%% time, %+d transactions)" % (
+            (metrics["time"] / baseline["time"] - 1) * 100 if baseline["time"] else 0,
+            metrics["transactions"] - baseline["transactions"])
+    print(line)
+
+def save_baseline(results, filename, latency=0.0):
+    with open(filename, "w") as f:
+        json.dump({"latency": latency, "created": time.time(), "results": results}, f, indent=1, sort_keys=True)
+
+def load_baseline(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Print results against a baseline and return the names that regressed
+
+    Transaction and byte counts are deterministic so any increase is a
+    regression, time only counts once it's more than tolerance slower.
+    So do the counts of the VARIABLE_COUNTS benchmarks.
+    """
+    regressions = []
+    reference = baseline.get("results", baseline)
+    for (name, metrics) in sorted(results.items()):
+        base = reference.get(name)
+        print_result(name, metrics, base)
+        if base is None:
+            continue
+        slack = 1 + tolerance if name in VARIABLE_COUNTS else 1
+        if metrics["transactions"] > base["transactions"] * slack or metrics["bytes"] > base["bytes"] * slack or \
+           metrics["time"] > base["time"] * (1 + tolerance):
+            regressions.append(name)
+    if regressions:
+        print("Regressions: %s" % ", ".join(regressions))
+    return regressions
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="ipclib benchmarks on a simulated target")
+    parser.add_argument("names", nargs="*", help="Benchmarks to run (default: all)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per DCI transaction")
+    parser.add_argument("--per-byte", type=float, default=0.0, help="Seconds per byte transferred")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--save", metavar="FILE", help="Store the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="Compare against a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--list", action="store_true")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the benchmarked functions' output")
+    args = parser.parse_args(argv)
+    if args.list:
+        for (name, func, paging) in BENCHMARKS:
+            print(name)
+        return 0
+    results = run_benchmarks(args.names, args.latency, args.per_byte, args.repeat, args.verbose)
+    if args.save:
+        save_baseline(results, args.save, args.latency)
+    if args.compare:
+        if compare(results, load_baseline(args.compare), args.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,358 @@
+import struct
+import binascii
+from collections import OrderedDict
+from utils import *
+from proc import *
+from mem import DMA_HEAP_WINDOW, phys
+from addrmap import AddressMap, AddressRange, system_map
+
+# Region policies
+CACHE_HALTED = "halted"              # Cacheable while the thread is halted
+CACHE_WRITE_THROUGH = "write-through" # Cacheable, writes update the cached copy
+CACHE_NEVER = "never"                # Always read from the target
+
+def parse_address(addr):
+    """
+    Split an ipccli address into (space, offset)
+
+    Physical ("...P"), linear ("...L") and selector:offset addresses each get
+    their own space. Flat addresses are decimal unless prefixed with 0x
+    (segments.py builds "<decimal>L" strings) while both halves of
+    selector:offset are hex (e.g. "0x8:20ac0").
+    Returns None for addresses that can't be parsed.
+    """
+    if isinstance(addr, (int, long)):
+        return ("", addr)
+    if not isinstance(addr, str):
+        return None
+    addr = addr.strip()
+    try:
+        if ":" in addr:
+            selector, offset = addr.split(":", 1)
+            return ("%X:" % int(selector, 16), int(offset.rstrip("Ll"), 16))
+        if addr[-1] in "Pp":
+            return ("P", int(addr[:-1], 0))
+        if addr[-1] in "Ll":
+            return ("L", int(addr[:-1], 0))
+        return ("", int(addr, 0))
+    except (ValueError, IndexError):
+        return None
+
+def default_cache_regions():
+    # The heap is host memory the controllers DMA into, mapped before the
+    # ATT entry shows up in the address map
+    return [(DMA_HEAP_WINDOW[0], DMA_HEAP_WINDOW[1], CACHE_NEVER)]
+
+class ReadCache(ThreadProxy):
+    """
+    Page granular read-through cache in front of a thread's memory accesses
+
+    Whatever the address map (addrmap.system_map() unless given) doesn't
+    flag cacheable is never cached: MMIOS, PCI ECAM and BARs, ATT windows
+    and the sideband window, followed as the map gets updated. Selector
+    addresses are checked through their segment base, a selector the map
+    doesn't know is never cached. Linear and selector addresses are only
+    cached while the thread is halted and, with paging on, checked at the
+    physical pages they translate to.
+    Pages are evicted LRU-first once the cached bytes exceed budget. Any
+    go()/step()/asm write or memory write invalidates what it could have
+    changed; since aliasing between address spaces is unknown, a write drops
+    every page cached through a different space.
+    """
+
+    def __init__(self, thread, budget=4 * 1024 * 1024, page_size=0x1000, regions=None,
+                 default_policy=CACHE_HALTED, uncached_selectors=(), address_map=None):
+        ThreadProxy.__init__(self, thread)
+        self.budget = budget
+        self.page_size = page_size
+        self.address_map = address_map if address_map is not None else system_map(thread)
+        self.regions = regions if regions is not None else default_cache_regions()
+        self.region_map = AddressMap(AddressRange(start, start + length, "cache", "region %d" % i, policy=policy,
+                                                  order=i)
+                                     for (i, (start, length, policy)) in enumerate(self.regions))
+        self.default_policy = default_policy
+        self.uncached_selectors = set("%X:" % s for s in uncached_selectors)
+        self.pages = OrderedDict()
+        self.registers = {}
+        # Page directory/tables by physical address, for policy()
+        self.tables = {}
+        self.halted = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        self.evictions = 0
+        self.bytes_cached = 0
+        self.bytes_read = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def print_stats(self):
+        print("Cache: %d pages (%d bytes), hits: %d, misses: %d, uncached: %d, evictions: %d, hit rate: %.1f%%" %
+              (len(self.pages), len(self.pages) * self.page_size, self.hits, self.misses,
+               self.uncached, self.evictions, self.hit_rate() * 100))
+
+    def invalidate(self, space=None, start=0, size=None):
+        self.registers = {}
+        self.tables = {}
+        if space is None:
+            self.pages.clear()
+            return
+        for key in list(self.pages.keys()):
+            if key[0] != space:
+                del self.pages[key]
+            elif size is not None and start // self.page_size <= key[1] <= (start + size - 1) // self.page_size:
+                del self.pages[key]
+
+    def __page_table(self, base):
+        table = self.tables.get(base)
+        if table is None:
+            table = self.tables[base] = bytearray(self._thread.memblock(phys(base), 0x1000, 1).ToRawBytes())
+        return table
+
+    def physical_ranges(self, linear, size):
+        """
+        (physical address, size) chunks backing a linear range, None if
+        part of it isn't mapped
+        """
+        if int(self.arch_register("cr0")) & 0x80000001 != 0x80000001:
+            return [(linear, size)]
+        directory = self.__page_table(int(self.arch_register("cr3")) & ~0xFFF)
+        ranges = []
+        end = linear + size
+        while linear < end:
+            pde = struct.unpack_from("<I", directory, (linear >> 22 & 0x3FF) * 4)[0]
+            if not pde & 1:
+                return None
+            if pde & 0x80:
+                chunk = min(end, (linear | 0x3FFFFF) + 1) - linear
+                addr = (pde & 0xFFC00000) | (linear & 0x3FFFFF)
+            else:
+                pte = struct.unpack_from("<I", self.__page_table(pde & ~0xFFF), (linear >> 12 & 0x3FF) * 4)[0]
+                if not pte & 1:
+                    return None
+                chunk = min(end, (linear | 0xFFF) + 1) - linear
+                addr = (pte & ~0xFFF) | (linear & 0xFFF)
+            ranges.append((addr, chunk))
+            linear += chunk
+        return ranges
+
+    def policy(self, space, offset, size):
+        if space not in ("P", "L", ""):
+            segment = self.address_map.by_selector(int(space[:-1], 16))
+            if space in self.uncached_selectors or segment is None:
+                return CACHE_NEVER
+            offset += segment.start
+        ranges = [(offset, size)]
+        if space != "P":
+            # The map and regions are physical, and the page tables are
+            # only stable while halted
+            if not self.is_halted():
+                return CACHE_NEVER
+            ranges = self.physical_ranges(offset & 0xFFFFFFFF, size)
+            if ranges is None:
+                return CACHE_NEVER
+        # Never wins, otherwise the last listed region
+        policy = self.default_policy
+        order = -1
+        for (start, length) in ranges:
+            if not self.address_map.cacheable(start, length):
+                return CACHE_NEVER
+            for region in self.region_map.overlapping(start, length):
+                if region.get("policy") == CACHE_NEVER:
+                    return CACHE_NEVER
+                if region.get("order") > order:
+                    policy, order = region.get("policy"), region.get("order")
+        return policy
+
+    def is_halted(self):
+        if self.halted is None:
+            # Only remember it once halted, a running thread can stop by itself
+            if not self._thread.ishalted():
+                return False
+            self.halted = True
+        return self.halted
+
+    def cacheable(self, space, offset, size):
+        policy = self.policy(space, offset, size)
+        if policy == CACHE_NEVER:
+            return False
+        return policy == CACHE_WRITE_THROUGH or self.is_halted()
+
+    def __fill(self, space, first, last):
+        # Read consecutive missing pages with a single memblock
+        start = first * self.page_size
+        size = (last - first + 1) * self.page_size
+        addr = ("0x%s0x%X" % (space, start)) if space.endswith(":") else ("0x%X%s" % (start, space))
+        data = bytearray(self._thread.memblock(addr, size, 1).ToRawBytes())
+        self.bytes_read += size
+        for page in xrange(first, last + 1):
+            offset = (page - first) * self.page_size
+            self.pages[(space, page)] = data[offset:offset + self.page_size]
+        while len(self.pages) * self.page_size > self.budget:
+            self.pages.popitem(last=False)
+            self.evictions += 1
+
+    def read(self, space, offset, size):
+        first = offset // self.page_size
+        last = (offset + size - 1) // self.page_size
+        missing = None
+        for page in xrange(first, last + 1):
+            key = (space, page)
+            if key in self.pages:
+                self.hits += 1
+                self.pages[key] = self.pages.pop(key)
+                if missing is not None:
+                    self.__fill(space, missing, page - 1)
+                    missing = None
+            else:
+                self.misses += 1
+                if missing is None:
+                    missing = page
+        if missing is not None:
+            self.__fill(space, missing, last)
+        data = bytearray()
+        for page in xrange(first, last + 1):
+            data += self.pages[(space, page)]
+        start = offset - first * self.page_size
+        self.bytes_cached += size
+        return data[start:start + size]
+
+    def __bitdata(self, data):
+        value = int(binascii.hexlify(bytes(data[::-1])), 16) if data else 0
+        return ipc.BitData(len(data) * 8, value)
+
+    def __write(self, addr, size, data=None):
+        parsed = parse_address(addr)
+        if parsed is None:
+            self.invalidate()
+            return
+        space, offset = parsed
+        if data is not None and self.policy(space, offset, size) == CACHE_WRITE_THROUGH:
+            for i in xrange(size):
+                key = (space, (offset + i) // self.page_size)
+                if key in self.pages:
+                    self.pages[key][(offset + i) % self.page_size] = data[i]
+            # Still drop other spaces, they may alias the written bytes
+            for key in list(self.pages.keys()):
+                if key[0] != space:
+                    del self.pages[key]
+            self.registers = {}
+            self.tables = {}
+        else:
+            self.invalidate(space, offset, size)
+
+    def memblock(self, addr, size, width, *args):
+        if args:
+            ret = self._thread.memblock(addr, size, width, *args)
+            data = args[0]
+            if width == 1 and not isinstance(data, (int, long)):
+                self.__write(addr, int(size), bytearray(data))
+            else:
+                self.__write(addr, int(size) * int(width))
+            return ret
+        parsed = parse_address(addr)
+        size = int(size)
+        if width != 1 or parsed is None or size <= 0 or size > self.budget or \
+           not self.cacheable(parsed[0], parsed[1], size):
+            self.uncached += 1
+            return self._thread.memblock(addr, size, width)
+        return self.__bitdata(self.read(parsed[0], parsed[1], size))
+
+    def mem(self, addr, size, *args):
+        if args and args[0] is not None:
+            ret = self._thread.mem(addr, size, *args)
+            value = int(args[0])
+            self.__write(addr, size, bytearray((value >> (8 * i)) & 0xFF for i in xrange(size)))
+            return ret
+        parsed = parse_address(addr)
+        if parsed is None or size > self.budget or not self.cacheable(parsed[0], parsed[1], size):
+            self.uncached += 1
+            return self._thread.mem(addr, size)
+        return self.__bitdata(self.read(parsed[0], parsed[1], size))
+
+    def arch_register(self, name, *args):
+        if args and args[0] is not None:
+            self.registers.pop(name, None)
+            self.tables = {}
+            return self._thread.arch_register(name, *args)
+        if not self.is_halted():
+            return self._thread.arch_register(name)
+        if name not in self.registers:
+            self.registers[name] = self._thread.arch_register(name)
+        return self.registers[name]
+
+    def asm(self, addr, *args):
+        # asm(addr, count) disassembles, asm(addr, "instr", ...) writes code,
+        # and both clobber eax/ebx/ecx/edx on the ipc side.
+        if any(isinstance(arg, str) for arg in args):
+            self.invalidate()
+        self.registers = {}
+        self.tables = {}
+        return self._thread.asm(addr, *args)
+
+    def go(self, *args, **kwargs):
+        self.invalidate()
+        self.halted = False
+        return self._thread.go(*args, **kwargs)
+
+    def step(self, *args, **kwargs):
+        self.invalidate()
+        self.halted = None
+        return self._thread.step(*args, **kwargs)
+
+    def halt(self, *args, **kwargs):
+        ret = self._thread.halt(*args, **kwargs)
+        self.halted = None
+        return ret
+
+    def ishalted(self):
+        halted = self._thread.ishalted()
+        if not halted:
+            self.invalidate()
+        self.halted = True if halted else None
+        return halted
+
+    def isrunning(self):
+        running = self._thread.isrunning()
+        if running:
+            self.invalidate()
+            self.halted = None
+        return running
+
+read_cache = None
+
+# Each session (see session.py) has its own cache, the module global is the
+# one used without sessions
+def get_read_cache():
+    session = current_session()
+    return session.read_cache if session is not None else read_cache
+
+def _set_read_cache(value):
+    global read_cache
+    session = current_session()
+    if session is not None:
+        session.read_cache = value
+    else:
+        read_cache = value
+
+def enable_cache(thread=None, **kwargs):
+    cache = get_read_cache()
+    if cache is not None:
+        return cache
+    cache = ReadCache(thread if thread is not None else target_thread(), **kwargs)
+    _set_read_cache(cache)
+    use_thread(cache)
+    return cache
+
+def disable_cache():
+    cache = get_read_cache()
+    if cache is None:
+        return
+    cache.print_stats()
+    use_thread(cache._thread)
+    _set_read_cache(None)
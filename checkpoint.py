@@ -0,0 +1,214 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+from utils import *
+from mmio import dump_filename
+from offline import REGISTERS_FILE, DESCRIPTOR_TABLES, save_registers
+from search import Region
+from uploader import WriteBatch, format_address, MAX_WRITE
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+# Registers are written back after memory, tables and paging first so the
+# selectors and eip make sense once they're loaded
+RESTORE_ORDER = ["cr3", "cr4", "cr0", "cr2",
+                 "gdtbas", "gdtlim", "idtbas", "idtlim", "ldtbas", "ldtlim", "ldtr", "tr",
+                 "cs", "ds", "es", "fs", "gs", "ss",
+                 "eax", "ebx", "ecx", "edx", "esi", "edi", "ebp", "esp", "eflags", "eip"]
+
+def _page_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
+class CheckpointRegion(object):
+    """
+    Saved memory range with the hash of each of its pages
+    """
+
+    def __init__(self, addr, size, space, filename, hashes=None):
+        self.addr = addr
+        self.size = size
+        self.space = space
+        self.filename = filename
+        self.hashes = hashes or []
+
+    @property
+    def name(self):
+        return format_address(self.space, self.addr)
+
+    def to_json(self):
+        return {"addr": self.addr, "size": self.size, "space": self.space, "file": self.filename,
+                "hashes": self.hashes}
+
+    @classmethod
+    def from_json(cls, value):
+        return cls(value["addr"], value["size"], str(value["space"]), str(value["file"]), value["hashes"])
+
+class Checkpoint(object):
+    """
+    Registers, descriptor tables and RAM regions of a halted thread
+
+    restore() reads the regions back, hashes them page by page and only
+    writes the pages that changed, then loads the registers again. Pages
+    that still differ afterwards (ROM, device registers...) and registers
+    that can't be written are reported instead of failing the restore.
+
+    Region files are named like save_mmios dumps (RAM_<addr>.bin) and the
+    registers and tables like save_registers, so
+    DumpImage(pwd, prefixes=("RAM_", )) can open a checkpoint.
+    """
+
+    def __init__(self, pwd):
+        self.pwd = pwd
+        self.regions = []
+        self.registers = {}
+        self.page_size = 0x1000
+        self.created = None
+        path = os.path.join(pwd, CHECKPOINT_FILE)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                state = json.load(f)
+            self.page_size = state["page_size"]
+            self.created = state["created"]
+            self.regions = [CheckpointRegion.from_json(region) for region in state["regions"]]
+        path = os.path.join(pwd, REGISTERS_FILE)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.registers = dict((name, value) for (name, (size, value)) in json.load(f)["registers"].items())
+
+    @classmethod
+    def capture(cls, pwd, regions, thread=None, tables=True, page_size=0x1000, chunk=MAX_WRITE):
+        """
+        Save the physical (addr, size) regions and the registers into pwd
+        """
+        if not (thread if thread is not None else t).ishalted():
+            raise Exception("Thread must be halted to take a checkpoint")
+        start = time.time()
+        save_registers(pwd, thread, tables=False)
+        checkpoint = cls(pwd)
+        checkpoint.regions = []
+        checkpoint.page_size = page_size
+        checkpoint.created = time.time()
+        ranges = [(addr, size, "P", dump_filename("RAM_", addr)) for (addr, size) in regions]
+        for table in DESCRIPTOR_TABLES if tables else ():
+            if table + "bas" in checkpoint.registers and table + "lim" in checkpoint.registers:
+                ranges.append((checkpoint.registers[table + "bas"], checkpoint.registers[table + "lim"] + 1, "L",
+                               table.upper() + ".bin"))
+        chunk -= chunk % page_size
+        for (addr, size, space, filename) in ranges:
+            region = CheckpointRegion(addr, size, space, filename)
+            with open(os.path.join(pwd, filename), "wb") as f:
+                for (offset, data) in checkpoint.reader(region, thread).chunks(chunk):
+                    f.write(data)
+                    region.hashes.extend(_page_hash(data[pos:pos + page_size])
+                                         for pos in xrange(0, len(data), page_size))
+            checkpoint.regions.append(region)
+        checkpoint.save()
+        print("Checkpoint of %d regions (%d bytes) in %.2fs" %
+              (len(checkpoint.regions), sum(region.size for region in checkpoint.regions), time.time() - start))
+        return checkpoint
+
+    def save(self):
+        with open(os.path.join(self.pwd, CHECKPOINT_FILE), "w") as f:
+            json.dump({"created": self.created, "page_size": self.page_size,
+                       "regions": [region.to_json() for region in self.regions]}, f, indent=1, sort_keys=True)
+
+    def reader(self, region, thread=None):
+        # Goes through the dispatcher (with read-ahead) for the global thread
+        return Region(region.name, region.addr, region.size, region.space, thread=thread)
+
+    def diff(self, thread=None, chunk=MAX_WRITE):
+        """
+        {region: [offsets of the pages that changed since the checkpoint]}
+        """
+        chunk -= chunk % self.page_size
+        changes = {}
+        for region in self.regions:
+            dirty = []
+            for (offset, data) in self.reader(region, thread).chunks(chunk):
+                for pos in xrange(0, len(data), self.page_size):
+                    page = offset + pos
+                    if _page_hash(data[pos:pos + self.page_size]) != region.hashes[page // self.page_size]:
+                        dirty.append(page)
+            if dirty:
+                changes[region] = dirty
+        return changes
+
+    def __write_pages(self, region, pages, thread, max_write):
+        with open(os.path.join(self.pwd, region.filename), "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                batch = WriteBatch(thread, max_write)
+                for page in pages:
+                    batch.write(format_address(region.space, region.addr + page),
+                                data[page:page + self.page_size])
+                batch.flush()
+                return batch.bytes
+            finally:
+                data.close()
+
+    def __still_dirty(self, region, pages, thread, max_write):
+        # Read back the written pages only, a run of consecutive ones at a time
+        runs = []
+        for page in pages:
+            if runs and runs[-1][1] == page and runs[-1][1] - runs[-1][0] < max_write:
+                runs[-1][1] = page + self.page_size
+            else:
+                runs.append([page, page + self.page_size])
+        dirty = []
+        for (first, last) in runs:
+            last = min(last, region.size)
+            data = bytes(bytearray(thread.memblock(format_address(region.space, region.addr + first),
+                                                   last - first, 1).ToRawBytes()))
+            for page in xrange(first, last, self.page_size):
+                pos = page - first
+                if _page_hash(data[pos:pos + self.page_size]) != region.hashes[page // self.page_size]:
+                    dirty.append(page)
+        return dirty
+
+    def restore(self, thread=None, registers=True, verify=True, max_write=MAX_WRITE):
+        """
+        Roll the thread back to the checkpoint, returns what couldn't be
+        restored as [(region or register name, reason)]
+        """
+        if not (thread if thread is not None else t).ishalted():
+            raise Exception("Thread must be halted to restore a checkpoint")
+        start = time.time()
+        changes = self.diff(thread, max_write)
+        thread = thread if thread is not None else t
+        failed = []
+        written = 0
+        for region in self.regions:
+            pages = changes.get(region)
+            if not pages:
+                continue
+            try:
+                written += self.__write_pages(region, pages, thread, max_write)
+            except Exception as e:
+                failed.append((region.name, "write failed: %s" % e))
+                continue
+            if verify:
+                dirty = self.__still_dirty(region, pages, thread, max_write)
+                if dirty:
+                    failed.append((region.name, "%d/%d pages don't hold their value (first at +0x%X)" %
+                                   (len(dirty), len(pages), dirty[0])))
+        if registers:
+            for name in RESTORE_ORDER:
+                if name not in self.registers:
+                    continue
+                try:
+                    thread.arch_register(name, self.registers[name])
+                except Exception as e:
+                    failed.append((name, "register write failed: %s" % e))
+        print("Restored %d changed pages of %d regions (%d bytes written) in %.2fs" %
+              (sum(len(pages) for pages in changes.values()), len(changes), written, time.time() - start))
+        for (name, reason) in failed:
+            print("Can't restore %s: %s" % (name, reason))
+        return failed
+
+def checkpoint(pwd, regions, thread=None, **kwargs):
+    return Checkpoint.capture(pwd, regions, thread, **kwargs)
+
+def rollback(pwd, thread=None, **kwargs):
+    return Checkpoint(pwd).restore(thread, **kwargs)
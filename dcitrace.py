@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import math
+import time
+import threading
+from collections import deque
+from utils import *
+
+# Thread operations that go over the link
+TRACED_OPS = ("mem", "memblock", "memdump", "memsave", "arch_register", "asm",
+              "halt", "go", "step", "dport", "port", "brnew", "brremove",
+              "brenable", "brdisable", "ishalted", "isrunning")
+
+_this_file = os.path.abspath(__file__)
+_library_dir = os.path.dirname(_this_file)
+
+def _callsites(depth):
+    """
+    Innermost library functions on the current stack, skipping thread proxies
+    """
+    sites = []
+    frame = sys._getframe(1)
+    while frame is not None and len(sites) < depth:
+        code = frame.f_code
+        path = os.path.abspath(code.co_filename)
+        if os.path.dirname(path) != _library_dir:
+            break
+        owner = frame.f_locals.get("self")
+        if os.path.splitext(path)[0] != os.path.splitext(_this_file)[0] and \
+           not isinstance(owner, (ThreadProxy, TracedDevice)):
+            # __class__ rather than type() to handle old-style classes
+            if owner is not None and hasattr(owner.__class__, code.co_name):
+                sites.append("%s.%s" % (owner.__class__.__name__, code.co_name))
+            else:
+                sites.append(code.co_name)
+        frame = frame.f_back
+    return tuple(sites) if sites else ("<console>", )
+
+def _describe(op, args):
+    """
+    (address, size) of an operation from its arguments
+    """
+    if not args:
+        return (None, 0)
+    addr = args[0]
+    if isinstance(addr, (int, long)):
+        addr = "0x%X" % addr
+    elif not isinstance(addr, str):
+        addr = str(addr)
+    size = 0
+    if op in ("mem", "memblock", "memdump") and len(args) > 1:
+        try:
+            size = int(args[1])
+        except (TypeError, ValueError):
+            pass
+    return (addr, size)
+
+class CallSiteStats(object):
+    __slots__ = ("count", "total", "min", "max", "bytes", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.bytes = 0
+        self.buckets = {}
+
+    def add(self, duration, size):
+        self.count += 1
+        self.total += duration
+        self.bytes += size
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if duration > self.max:
+            self.max = duration
+        # log2 buckets of microseconds
+        bucket = int(math.log(max(duration * 1e6, 1), 2))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total, "min": self.min, "max": self.max,
+                "mean": self.total / self.count if self.count else 0, "bytes": self.bytes,
+                "histogram_us": dict(("%d-%d" % (1 << b, 2 << b), n) for (b, n) in sorted(self.buckets.items()))}
+
+class Tracer(object):
+    """
+    Records every link operation with its duration and calling library function
+
+    Nothing is recorded (and nothing is wrapped) until install() is called.
+    """
+
+    def __init__(self, depth=1, max_events=100000):
+        self.depth = depth
+        self.events = deque(maxlen=max_events)
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.session = None
+        self.thread = None
+        self.ipc = None
+        self.stateport = None
+        self.__live = None
+
+    def record(self, op, args, start, duration):
+        addr, size = _describe(op, args)
+        sites = _callsites(self.depth)
+        with self.lock:
+            self.events.append((op, addr, size, start, duration, sites, threading.current_thread().ident))
+            key = (op, sites[0])
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = CallSiteStats()
+            stats.add(duration, size)
+
+    def call(self, op, func, args, kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(op, args, start, time.time() - start)
+
+    def install(self, thread=None, stateport=True):
+        self.session = current_session()
+        self.thread = TracingThread(thread if thread is not None else target_thread(), self)
+        use_thread(self.thread, self.session)
+        self.ipc = self.session.ipc if self.session is not None else ipc
+        if stateport and self.ipc is not None and hasattr(self.ipc, "stateport"):
+            self.stateport = self.ipc.stateport
+            self.ipc.stateport = TracedDevice(self.stateport, self, ("sbreg", ))
+        return self
+
+    def uninstall(self):
+        self.stop_live()
+        if self.thread is not None:
+            use_thread(self.thread._thread, self.session)
+            self.thread = None
+        if self.stateport is not None:
+            self.ipc.stateport = self.stateport
+            self.stateport = None
+
+    def reset(self):
+        with self.lock:
+            self.events.clear()
+            self.stats = {}
+            self.start = time.time()
+
+    def summary(self, sort="total"):
+        with self.lock:
+            items = [(op, site, stats) for ((op, site), stats) in self.stats.items()]
+        items.sort(key=lambda item: -getattr(item[2], sort))
+        return items
+
+    def print_stats(self, top=20, sort="total"):
+        print("%-14s %-40s %8s %10s %10s %10s" % ("Operation", "Call site", "Count", "Total(ms)", "Mean(ms)", "Bytes"))
+        for (op, site, stats) in self.summary(sort)[:top]:
+            print("%-14s %-40s %8d %10.1f %10.3f %10d" % (op, site, stats.count, stats.total * 1000,
+                                                           stats.total * 1000 / stats.count, stats.bytes))
+
+    def start_live(self, interval=5, top=10):
+        stop = threading.Event()
+        def show():
+            while not stop.wait(interval):
+                self.print_stats(top)
+        worker = threading.Thread(target=show)
+        worker.daemon = True
+        worker.start()
+        self.__live = stop
+
+    def stop_live(self):
+        if self.__live is not None:
+            self.__live.set()
+            self.__live = None
+
+    def to_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump([dict(stats.to_dict(), op=op, callsite=site)
+                       for (op, site, stats) in self.summary()], f, indent=1)
+
+    def to_chrome_trace(self, filename):
+        """
+        Chrome trace event file (chrome://tracing, Perfetto)
+        """
+        with self.lock:
+            events = list(self.events)
+        trace = []
+        for (op, addr, size, start, duration, sites, tid) in events:
+            trace.append({"name": op, "cat": sites[0], "ph": "X", "pid": os.getpid(), "tid": tid,
+                          "ts": (start - self.start) * 1e6, "dur": duration * 1e6,
+                          "args": {"addr": addr, "size": size, "stack": list(sites)}})
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": trace}, f)
+
+class TracingThread(ThreadProxy):
+    def __init__(self, thread, tracer):
+        ThreadProxy.__init__(self, thread)
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        attr = getattr(self._thread, name)
+        if name not in TRACED_OPS:
+            return attr
+        tracer = self._tracer
+        def traced(*args, **kwargs):
+            return tracer.call(name, attr, args, kwargs)
+        return traced
+
+class TracedDevice(object):
+    """
+    Traces some methods of an object and of the objects hanging off it
+    (e.g. ipc.stateport.<tpsb>.sbreg)
+    """
+
+    def __init__(self, obj, tracer, ops):
+        self._obj = obj
+        self._tracer = tracer
+        self._ops = ops
+
+    def __dir__(self):
+        return dir(self._obj)
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        tracer = self._tracer
+        if name in self._ops and callable(attr):
+            def traced(*args, **kwargs):
+                return tracer.call(name, attr, args, kwargs)
+            return traced
+        if not callable(attr) and not isinstance(attr, (int, long, str, float)) and not name.startswith("_"):
+            return TracedDevice(attr, tracer, self._ops)
+        return attr
+
+tracer = None
+
+# Each session (see session.py) has its own tracer, the module global is the
+# one used without sessions
+def get_tracer():
+    session = current_session()
+    return session.tracer if session is not None else tracer
+
+def _set_tracer(value):
+    global tracer
+    session = current_session()
+    if session is not None:
+        session.tracer = value
+    else:
+        tracer = value
+
+def start_tracing(depth=1, live=None):
+    running = get_tracer()
+    if running is None:
+        running = Tracer(depth).install()
+        _set_tracer(running)
+    if live:
+        running.start_live(live)
+    return running
+
+def stop_tracing(top=20):
+    running = get_tracer()
+    if running is None:
+        return None
+    running.uninstall()
+    running.print_stats(top)
+    _set_tracer(None)
+    return running
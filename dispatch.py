@@ -0,0 +1,361 @@
+import sys
+import heapq
+import binascii
+import threading
+import itertools
+from contextlib import contextmanager
+from utils import *
+from cache import parse_address
+from dcitrace import TRACED_OPS
+
+# Request priorities, lowest first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+class DispatcherStopped(Exception):
+    pass
+
+class Request(object):
+    """
+    Future for an operation queued on the dispatcher
+    """
+
+    def __init__(self, op, args, kwargs, priority, func=None):
+        self.op = op
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.func = func
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+        self.__result = None
+        self.__exc_info = None
+        self.__callbacks = []
+
+    def done(self):
+        return self.__done.is_set()
+
+    def set_result(self, result):
+        self.__result = result
+        self.__finish()
+
+    def set_exception(self, exc_info):
+        self.__exc_info = exc_info
+        self.__finish()
+
+    def __finish(self):
+        with self.__lock:
+            self.__done.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Call callback(request) once done, from the dispatcher thread
+        """
+        with self.__lock:
+            if not self.done():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        self.wait(timeout)
+        return self.__exc_info[1] if self.__exc_info else None
+
+    def wait(self, timeout=None):
+        if not self.__done.wait(timeout):
+            raise Exception("Timed out waiting for %s" % self.op)
+
+    def result(self, timeout=None):
+        self.wait(timeout)
+        if self.__exc_info is not None:
+            raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+        return self.__result
+
+    def read_range(self):
+        """
+        (space, start, end) if this is a memblock read that can be merged
+        """
+        if self.op != "memblock" or self.kwargs or len(self.args) != 3 or self.args[2] != 1:
+            return None
+        parsed = parse_address(self.args[0])
+        if parsed is None or parsed[0] not in ("P", "L", ""):
+            return None
+        return (parsed[0], parsed[1], parsed[1] + int(self.args[1]))
+
+def _bitdata(data):
+    value = int(binascii.hexlify(bytes(data[::-1])), 16) if data else 0
+    return ipc.BitData(len(data) * 8, value)
+
+class Dispatcher(object):
+    """
+    Owns a thread's DCI link on a dedicated worker thread
+
+    Operations are queued with a priority and run one at a time, in
+    priority then submission order. Consecutive memblock reads of adjacent
+    or overlapping ranges are merged into a single link transaction (up to
+    max_merge bytes) and their results split back.
+    """
+
+    def __init__(self, thread=None, max_merge=0x10000):
+        # The session's own thread, 't' routes to the DispatchedThread
+        self.thread = thread if thread is not None else target_thread()
+        self.session = current_session()
+        self.max_merge = max_merge
+        self.queue = []
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.local = threading.local()
+        self.stopping = False
+        self.requests = 0
+        self.transactions = 0
+        self.merged = 0
+        self.ipc = None
+        self.stateport = None
+        self.resettarget = None
+        self.worker = threading.Thread(target=self.__run, name="ipclib-dispatcher")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def current_priority(self):
+        return getattr(self.local, "priority", PRIORITY_INTERACTIVE)
+
+    @contextmanager
+    def priority(self, priority):
+        """
+        Default priority of the requests submitted by this Python thread
+        """
+        previous = self.current_priority()
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def __queue(self, request):
+        with self.condition:
+            if self.stopping:
+                raise DispatcherStopped("Dispatcher is stopped")
+            heapq.heappush(self.queue, (request.priority, next(self.counter), request))
+            self.requests += 1
+            self.condition.notify()
+        return request
+
+    def submit(self, op, args=(), kwargs=None, priority=None):
+        """
+        Queue thread.<op>(*args, **kwargs), returns its Request
+        """
+        return self.__queue(Request(op, tuple(args), kwargs or {},
+                                    self.current_priority() if priority is None else priority))
+
+    def submit_call(self, func, args=(), kwargs=None, priority=None):
+        """
+        Queue any function needing the link (e.g. ipc.stateport sbreg)
+        """
+        return self.__queue(Request(getattr(func, "__name__", "call"), tuple(args), kwargs or {},
+                                    self.current_priority() if priority is None else priority, func))
+
+    def call(self, op, *args, **kwargs):
+        if threading.current_thread() is self.worker:
+            return getattr(self.thread, op)(*args, **kwargs)
+        return self.submit(op, args, kwargs).result()
+
+    def call_func(self, func, *args, **kwargs):
+        if threading.current_thread() is self.worker:
+            return func(*args, **kwargs)
+        return self.submit_call(func, args, kwargs).result()
+
+    def memblock_async(self, addr, size, width=1, priority=None):
+        return self.submit("memblock", (addr, size, width), priority=priority)
+
+    def __take(self):
+        batch = [heapq.heappop(self.queue)[2]]
+        first = batch[0].read_range()
+        if first is None:
+            return batch
+        space, start, end = first
+        while self.queue:
+            following = self.queue[0][2].read_range()
+            if following is None or following[0] != space or \
+               not start <= following[1] <= end or max(end, following[2]) - start > self.max_merge:
+                break
+            batch.append(heapq.heappop(self.queue)[2])
+            end = max(end, following[2])
+        return batch
+
+    def __execute(self, batch):
+        self.transactions += 1
+        if len(batch) == 1:
+            request = batch[0]
+            try:
+                if request.func is not None:
+                    result = request.func(*request.args, **request.kwargs)
+                else:
+                    result = getattr(self.thread, request.op)(*request.args, **request.kwargs)
+            except:
+                request.set_exception(sys.exc_info())
+            else:
+                request.set_result(result)
+            return
+        self.merged += len(batch) - 1
+        space, start, end = batch[0].read_range()
+        for request in batch[1:]:
+            end = max(end, request.read_range()[2])
+        addr = "0x%X%s" % (start, space)
+        try:
+            data = bytearray(self.thread.memblock(addr, end - start, 1).ToRawBytes())
+        except:
+            exc_info = sys.exc_info()
+            for request in batch:
+                request.set_exception(exc_info)
+            return
+        for request in batch:
+            (space, first, last) = request.read_range()
+            request.set_result(_bitdata(data[first - start:last - start]))
+
+    def __run(self):
+        # Same session as whoever started us, for what the requests use
+        bind_session(self.session)
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopping:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                batch = self.__take()
+            self.__execute(batch)
+
+    def install(self, stateport=True):
+        """
+        Become the only way to the link of the session: 't' is replaced by
+        a DispatchedThread, ipc.stateport sbreg accesses and
+        ipc.resettarget() are queued too
+        """
+        use_thread(DispatchedThread(self), self.session)
+        self.ipc = self.session.ipc if self.session is not None else ipc
+        if self.ipc is None:
+            return self
+        if stateport and hasattr(self.ipc, "stateport"):
+            self.stateport = self.ipc.stateport
+            self.ipc.stateport = DispatchedDevice(self.stateport, self, ("sbreg", ))
+        if hasattr(self.ipc, "resettarget"):
+            # Shadowed on the instance, uninstall() uncovers the method again
+            self.resettarget = getattr(self.ipc, "__dict__", {}).get("resettarget")
+            resettarget = self.ipc.resettarget
+            self.ipc.resettarget = lambda *args, **kwargs: self.call_func(resettarget, *args, **kwargs)
+        return self
+
+    def uninstall(self):
+        use_thread(self.thread, self.session)
+        if self.ipc is None:
+            return
+        if self.stateport is not None:
+            self.ipc.stateport = self.stateport
+            self.stateport = None
+        if self.resettarget is not None:
+            self.ipc.resettarget = self.resettarget
+        elif "resettarget" in getattr(self.ipc, "__dict__", {}):
+            del self.ipc.resettarget
+        self.resettarget = None
+        self.ipc = None
+
+    def pending(self):
+        with self.condition:
+            return len(self.queue)
+
+    def stop(self, wait=True):
+        """
+        Stop once the queued requests are done (or fail them if not wait)
+        """
+        with self.condition:
+            self.stopping = True
+            if not wait:
+                for (priority, seq, request) in self.queue:
+                    request.set_exception((DispatcherStopped, DispatcherStopped("Dispatcher is stopped"), None))
+                self.queue = []
+            self.condition.notify()
+        if threading.current_thread() is not self.worker:
+            self.worker.join()
+
+    def print_stats(self):
+        print("Dispatcher: %d requests, %d link transactions, %d reads merged, %d pending" %
+              (self.requests, self.transactions, self.merged, self.pending()))
+
+class DispatchedThread(ThreadProxy):
+    """
+    Thread stand-in sending every link operation through a Dispatcher, so
+    any Python thread can use it
+    """
+
+    def __init__(self, dispatcher):
+        ThreadProxy.__init__(self, dispatcher.thread)
+        self._dispatcher = dispatcher
+
+    def __getattr__(self, name):
+        if name not in TRACED_OPS:
+            return getattr(self._thread, name)
+        dispatcher = self._dispatcher
+        def dispatched(*args, **kwargs):
+            return dispatcher.call(name, *args, **kwargs)
+        return dispatched
+
+class DispatchedDevice(object):
+    """
+    Sends some methods of an object and of the objects hanging off it
+    (e.g. ipc.stateport.<tpsb>.sbreg) through a Dispatcher
+    """
+
+    def __init__(self, obj, dispatcher, ops):
+        self._obj = obj
+        self._dispatcher = dispatcher
+        self._ops = ops
+
+    def __dir__(self):
+        return dir(self._obj)
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        dispatcher = self._dispatcher
+        if name in self._ops and callable(attr):
+            def dispatched(*args, **kwargs):
+                return dispatcher.call_func(attr, *args, **kwargs)
+            return dispatched
+        if not callable(attr) and not isinstance(attr, (int, long, str, float)) and not name.startswith("_"):
+            return DispatchedDevice(attr, dispatcher, self._ops)
+        return attr
+
+dispatcher = None
+
+# Each session (see session.py) has its own dispatcher, the module global is
+# the one used without sessions
+def get_dispatcher():
+    session = current_session()
+    return session.dispatcher if session is not None else dispatcher
+
+def _set_dispatcher(value):
+    global dispatcher
+    session = current_session()
+    if session is not None:
+        session.dispatcher = value
+    else:
+        dispatcher = value
+
+def start_dispatcher(thread=None, **kwargs):
+    running = get_dispatcher()
+    if running is None:
+        running = Dispatcher(thread, **kwargs)
+        _set_dispatcher(running)
+        running.install()
+    return running
+
+def stop_dispatcher():
+    running = get_dispatcher()
+    if running is None:
+        return
+    running.uninstall()
+    running.stop()
+    running.print_stats()
+    _set_dispatcher(None)
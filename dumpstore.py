@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import zlib
+import struct
+import hashlib
+from utils import *
+from proc import *
+from mem import *
+from mmio import dump_filename
+
+PAGE_SIZE = 0x1000
+
+# Dump store layout:
+#   pages.pack          - page payloads, appended one after another (raw or zlib)
+#   pages.idx           - fixed size records : sha1, offset in pack, length, flags
+#   snapshots/<name>.json - manifest listing the page hashes of every dumped range
+#
+# Identical pages (and all the 0xFF/0x00 ones) are only ever stored once, and a
+# later snapshot can reuse the pages of an earlier one instead of reading them
+# over DCI again.
+
+class DumpStore(object):
+    """
+    Content-addressed, deduplicating store for target dumps
+    """
+
+    INDEX_ENTRY = struct.Struct("<20sQII")
+    RAW = 0
+    ZLIB = 1
+
+    def __init__(self, path, page_size=PAGE_SIZE, compress=True):
+        self.path = path
+        self.page_size = page_size
+        self.compress = compress
+        self.snapshot_dir = os.path.join(path, "snapshots")
+        try:
+            os.makedirs(self.snapshot_dir)
+        except:
+            pass
+        self.pack_path = os.path.join(path, "pages.pack")
+        self.index_path = os.path.join(path, "pages.idx")
+        self.index = {}
+        self.__load_index()
+        self.__pack = open(self.pack_path, "a+b")
+        self.__idx = open(self.index_path, "ab")
+        self.__last_page = (None, None)
+
+    def __load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        size = self.INDEX_ENTRY.size
+        with open(self.index_path, "rb") as f:
+            data = f.read()
+        # Drop a partially written record left by an interrupted session,
+        # new records are appended after the last complete one
+        end = len(data) - len(data) % size
+        if end != len(data):
+            with open(self.index_path, "r+b") as f:
+                f.truncate(end)
+        for i in xrange(0, end, size):
+            digest, offset, length, flags = self.INDEX_ENTRY.unpack_from(data, i)
+            self.index[digest] = (offset, length, flags)
+
+    def close(self):
+        self.__pack.close()
+        self.__idx.close()
+
+    def flush(self):
+        self.__pack.flush()
+        self.__idx.flush()
+
+    def put_page(self, data):
+        key = hashlib.sha1(data).digest()
+        if key not in self.index:
+            flags = self.RAW
+            payload = data
+            if self.compress:
+                packed = zlib.compress(data, 6)
+                if len(packed) < len(data):
+                    flags = self.ZLIB
+                    payload = packed
+            self.__pack.seek(0, os.SEEK_END)
+            offset = self.__pack.tell()
+            self.__pack.write(payload)
+            self.__idx.write(self.INDEX_ENTRY.pack(key, offset, len(payload), flags))
+            self.index[key] = (offset, len(payload), flags)
+        return key.encode("hex")
+
+    def get_page(self, digest):
+        if self.__last_page[0] == digest:
+            return self.__last_page[1]
+        offset, length, flags = self.index[digest.decode("hex")]
+        self.__pack.flush()
+        self.__pack.seek(offset)
+        data = self.__pack.read(length)
+        if flags == self.ZLIB:
+            data = zlib.decompress(data)
+        self.__last_page = (digest, data)
+        return data
+
+    def snapshot_path(self, name):
+        return os.path.join(self.snapshot_dir, name + ".json")
+
+    def snapshots(self):
+        names = [f[:-5] for f in os.listdir(self.snapshot_dir) if f.endswith(".json")]
+        names.sort(key=lambda name: os.stat(self.snapshot_path(name)).st_mtime)
+        return names
+
+    def latest(self):
+        names = self.snapshots()
+        return names[-1] if names else None
+
+    def load_snapshot(self, name):
+        with open(self.snapshot_path(name), "r") as f:
+            return json.load(f)
+
+    def save_snapshot(self, snapshot):
+        self.flush()
+        with open(self.snapshot_path(snapshot["name"]), "w") as f:
+            json.dump(snapshot, f, indent=1)
+
+    def pages(self, addr, size):
+        """
+        Generate (address, length) for every page of a range
+        """
+        page_size = self.page_size
+        for offset in xrange(0, size, page_size):
+            yield (addr + offset, min(page_size, size - offset))
+
+    def __sample_offsets(self, addr, length, samples):
+        words = length // 4
+        if words == 0:
+            return []
+        offsets = [0, (words - 1) * 4]
+        seed = addr
+        for i in xrange(max(0, samples - 2)):
+            # Deterministic per page so a re-dump probes the same words
+            seed = (seed * 1103515245 + 12345) & 0x7FFFFFFF
+            offsets.append((seed % words) * 4)
+        return sorted(set(offsets[:max(samples, 1)]))
+
+    def page_unchanged(self, t, addr, length, digest, samples=3):
+        """
+        Compare a few words of the target page against the stored page
+
+        Only meant for memory that changes a page at a time (RAM), a
+        register changing outside the sampled words goes unnoticed.
+        """
+        data = self.get_page(digest)
+        if len(data) != length:
+            return False
+        for offset in self.__sample_offsets(addr, length, samples):
+            value = t.mem(phys(addr + offset), 4).ToUInt32()
+            if value != struct.unpack_from("<I", data, offset)[0]:
+                return False
+        return True
+
+    def snapshot(self, t, name, regions, base=None, verify=None, samples=3, chunk=0x10000):
+        """
+        Dump regions into a new snapshot
+
+        regions is a list of (addr, size) or (addr, size, prefix) tuples.
+        Pages are read chunk bytes per memblock and only stored if their
+        hash is new. If base names an earlier snapshot, pages at the same
+        address are instead reused when a few sampled words match the
+        stored copy: a single word read each, so it only pays off on slow
+        links. verify=True reads every page in full regardless (needed for
+        registers changing outside the sampled words), verify defaults to
+        sampling whenever a base is given.
+        """
+        if verify is None:
+            verify = base is None
+        known = {}
+        if base is not None:
+            if not isinstance(base, dict):
+                base = self.load_snapshot(base)
+            for region in base["regions"]:
+                for (addr, length), digest in zip(self.pages(region["addr"], region["size"]), region["pages"]):
+                    known[(addr, length)] = digest
+
+        snapshot = {"name": name,
+                    "created": time.time(),
+                    "thread": getattr(t, "name", None),
+                    "base": base["name"] if base else None,
+                    "page_size": self.page_size,
+                    "regions": []}
+        stats = {"fetched": 0, "reused": 0, "bytes_read": 0}
+        chunk = max(self.page_size, chunk - chunk % self.page_size)
+        for region in regions:
+            addr, size = region[0], region[1]
+            prefix = region[2] if len(region) > 2 else "MMIO_"
+            print("Addr: %s, size: %s" % (hex(addr), hex(size)))
+            entry = {"prefix": prefix, "addr": addr, "size": size, "pages": []}
+            pages = list(self.pages(addr, size))
+            while pages:
+                if not verify:
+                    digest = known.get(pages[0])
+                    if digest is not None and self.page_unchanged(t, pages[0][0], pages[0][1], digest, samples):
+                        entry["pages"].append(digest)
+                        stats["reused"] += 1
+                        pages.pop(0)
+                        continue
+                # Read as many pages as fit in a chunk at once
+                batch = [pages.pop(0)]
+                while pages and batch[-1][0] + batch[-1][1] == pages[0][0] and \
+                      sum(length for (page, length) in batch) + pages[0][1] <= chunk and \
+                      (verify or pages[0] not in known):
+                    batch.append(pages.pop(0))
+                length = sum(length for (page, length) in batch)
+                data = memtostr(t, phys(batch[0][0]), length)
+                offset = 0
+                for (page, page_length) in batch:
+                    entry["pages"].append(self.put_page(data[offset:offset + page_length]))
+                    offset += page_length
+                stats["fetched"] += len(batch)
+                stats["bytes_read"] += length
+            snapshot["regions"].append(entry)
+        snapshot["stats"] = stats
+        self.save_snapshot(snapshot)
+        print("Snapshot %s: %d pages fetched, %d reused (%d bytes read)" %
+              (name, stats["fetched"], stats["reused"], stats["bytes_read"]))
+        return snapshot
+
+    def region_data(self, region):
+        return "".join(self.get_page(digest) for digest in region["pages"])
+
+    def export(self, name, pwd):
+        """
+        Write a snapshot back as the legacy one .bin file per range layout
+        """
+        snapshot = self.load_snapshot(name) if not isinstance(name, dict) else name
+        try:
+            os.makedirs(pwd)
+        except:
+            pass
+        for region in snapshot["regions"]:
+            path = os.path.join(pwd, dump_filename(region["prefix"], region["addr"]))
+            with open(path, "wb") as f:
+                for digest in region["pages"]:
+                    f.write(self.get_page(digest))
+
+def snapshot_mmios(t, store, name=None, mmios=None, prefix="MMIO_", incremental=True, verify=None):
+    if mmios is None:
+        mmios = proc_get_address(t, "MMIOS", [])
+    if name is None:
+        name = time.strftime("%Y%m%d-%H%M%S")
+    base = store.latest() if incremental else None
+    return store.snapshot(t, name, [(addr, size, prefix) for (addr, size) in mmios],
+                          base=base, verify=verify)
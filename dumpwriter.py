@@ -0,0 +1,268 @@
+import os
+import time
+import gzip
+import zlib
+import Queue
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from utils import *
+from mem import phys
+from mmio import dump_filename
+import dispatch
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Output formats: (file suffix, compress). Compressed chunks are written as
+# independent gzip members / xz streams, which concatenate into a valid file.
+COMPRESSION = {
+    None: ".bin",
+    "gzip": ".bin.gz",
+    "xz": ".bin.xz",
+}
+
+def _compress(data, method, level):
+    # Module level so the process pool can pickle it
+    if method == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    return lzma.compress(data, preset=level)
+
+def read_compressed(path):
+    """
+    Decompressed contents of a .bin.gz / .bin.xz dump (all members)
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            return f.read()
+    if lzma is None:
+        raise ValueError("Reading %s needs the lzma module" % path)
+    with open(path, "rb") as f:
+        data = f.read()
+    # Concatenated streams, lzma.decompress stops after the first one on py2 backports
+    result = []
+    while data:
+        decompressor = lzma.LZMADecompressor()
+        result.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return "".join(result)
+
+class DumpWriter(object):
+    """
+    Pipelined save_mmios
+
+    The link side keeps read_ahead chunk reads queued on a Dispatcher (bulk
+    priority, so adjacent chunks get merged) while a writer thread converts,
+    hashes, compresses (in a process pool of workers) and writes them.
+    At most max_pending chunks wait for the writer, after which reading
+    blocks until it catches up.
+
+    Uncompressed dumps are the same files as save_mmios and resume the same
+    way. Compressed ones are written to a .part file and renamed once
+    complete, a region that fails on the way leaves no file behind.
+    """
+
+    def __init__(self, thread=None, chunk=0x1000, read_ahead=8, max_pending=32, compress=None,
+                 level=6, workers=None, dispatcher=None):
+        if compress not in COMPRESSION:
+            raise ValueError("Unknown compression %r" % (compress, ))
+        if compress == "xz" and lzma is None:
+            raise ValueError("xz compression needs the lzma module")
+        self.thread = thread if thread is not None else target_thread()
+        self.chunk = chunk
+        self.read_ahead = read_ahead
+        self.max_pending = max_pending
+        self.compress = compress
+        self.level = level
+        self.workers = workers
+        self.dispatcher = dispatcher
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.read_stall = 0.0
+        self.write_stall = 0.0
+        self.elapsed = 0.0
+
+    def __writer(self, queue, pool, errors):
+        pending = deque()
+        current = [None, None, None, None]
+        def flush(limit):
+            while len(pending) > limit:
+                data = pending.popleft()
+                if not isinstance(data, str):
+                    data = data.get()
+                current[0].write(data)
+                self.bytes_written += len(data)
+        while True:
+            item = queue.get()
+            try:
+                if item is None:
+                    break
+                if errors:
+                    # Keep draining so the reader never blocks
+                    continue
+                if isinstance(item, tuple):
+                    # Start (path, final path) or end (None, None) of a region
+                    flush(0)
+                    if item[0] is None:
+                        self.__close(current, True)
+                    else:
+                        start = os.path.getsize(item[0]) if os.path.exists(item[0]) else 0
+                        current[:] = [open(item[0], "ab"), item[0], item[1], start]
+                    continue
+                data = bytes(bytearray(item.ToRawBytes()))
+                self.hashes[current[2]].update(data)
+                if pool is not None:
+                    pending.append(pool.apply_async(_compress, (data, self.compress, self.level)))
+                elif self.compress is not None:
+                    pending.append(_compress(data, self.compress, self.level))
+                else:
+                    pending.append(data)
+                flush(self.workers or 2)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                queue.task_done()
+        # A region still open here never got its end marker: drop what was
+        # written of it, except from a plain file, which resumes
+        try:
+            if not errors:
+                flush(0)
+        except Exception as e:
+            errors.append(e)
+        try:
+            self.__close(current, False)
+        except Exception as e:
+            errors.append(e)
+
+    def __close(self, current, complete):
+        f, path, final, start = current
+        if f is None:
+            return
+        current[:] = [None, None, None, None]
+        if complete:
+            f.close()
+            if path != final:
+                os.rename(path, final)
+        elif path != final:
+            f.close()
+            os.remove(path)
+        else:
+            if self.compress is not None:
+                # Extension of an already complete compressed dump
+                f.truncate(start)
+            f.close()
+
+    def __region(self, dispatcher, queue, errors, pwd, prefix, addr, size):
+        final = os.path.join(pwd, dump_filename(prefix, addr)[:-len(".bin")] + COMPRESSION[self.compress])
+        path = final
+        # Ranges listed twice extend what this run already queued (the writer
+        # may not have caught up yet). Compressed members simply concatenate.
+        queued = self.queued.get(final)
+        if queued is not None:
+            if queued >= size:
+                print("Skipping. Already dumped")
+                return
+            addr += queued
+            size -= queued
+        elif os.path.exists(final):
+            done = os.stat(final).st_size
+            if self.compress is not None or done >= size:
+                print("Skipping. Already dumped")
+                return
+            # The digest covers the whole file, not only the resumed part
+            digest = self.hashes.setdefault(final, hashlib.sha1())
+            with open(final, "rb") as f:
+                for data in iter(lambda: f.read(0x100000), ""):
+                    digest.update(data)
+            addr += done
+            size -= done
+        elif self.compress is not None:
+            path = final + ".part"
+            if os.path.exists(path):
+                os.remove(path)
+        self.hashes.setdefault(final, hashlib.sha1())
+        self.queued[final] = (queued or 0) + size
+        queue.put((path, final))
+        inflight = deque()
+        offset = 0
+        while (offset < size or inflight) and not errors:
+            while offset < size and len(inflight) < self.read_ahead:
+                length = min(self.chunk, size - offset)
+                inflight.append((dispatcher.memblock_async(phys(addr + offset), length, 1, dispatch.PRIORITY_BULK),
+                                 length))
+                offset += length
+            start = time.time()
+            request, length = inflight.popleft()
+            data = request.result()
+            self.read_stall += time.time() - start
+            self.bytes_read += length
+            start = time.time()
+            queue.put(data)
+            self.write_stall += time.time() - start
+        queue.put((None, None))
+
+    def dump(self, pwd, mmios, prefix="MMIO_"):
+        """
+        Dump (addr, size) ranges into pwd, returns {path: sha1 of the raw data}
+        """
+        try:
+            os.makedirs(pwd)
+        except:
+            pass
+        self.hashes = {}
+        self.queued = {}
+        dispatcher = self.dispatcher or dispatch.get_dispatcher()
+        private = dispatcher is None
+        if private:
+            dispatcher = dispatch.Dispatcher(self.thread)
+        pool = None
+        if self.compress is not None and self.workers != 0:
+            pool = multiprocessing.Pool(self.workers)
+        queue = Queue.Queue(self.max_pending)
+        errors = []
+        writer = threading.Thread(target=self.__writer, args=(queue, pool, errors))
+        writer.daemon = True
+        writer.start()
+        start = time.time()
+        try:
+            # Same order as save_mmios
+            for (addr, size) in sorted(mmios, key=lambda mmio: (mmio[1], mmio[0])):
+                print("Addr: %s, size: %s" % (hex(addr), hex(size)))
+                self.__region(dispatcher, queue, errors, pwd, prefix, addr, size)
+                if errors:
+                    break
+        finally:
+            queue.put(None)
+            writer.join()
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if private:
+                dispatcher.stop()
+            self.elapsed += time.time() - start
+        if errors:
+            raise errors[0]
+        return dict((path, digest.hexdigest()) for (path, digest) in self.hashes.items())
+
+    def print_stats(self):
+        print("Dumped %d bytes in %.2fs (%.1f KB/s), wrote %d bytes (%.1f%%), "
+              "waited %.2fs on the link and %.2fs on the writer" %
+              (self.bytes_read, self.elapsed, self.bytes_read / 1024.0 / self.elapsed if self.elapsed else 0,
+               self.bytes_written, self.bytes_written * 100.0 / self.bytes_read if self.bytes_read else 0,
+               self.read_stall, self.write_stall))
+
+def save_mmios_pipelined(t, pwd, mmios, prefix="MMIO_", **kwargs):
+    writer = DumpWriter(t, **kwargs)
+    hashes = writer.dump(pwd, mmios, prefix)
+    writer.print_stats()
+    return hashes
@@ -0,0 +1,287 @@
+import os
+import csv
+import json
+import struct
+from utils import *
+from mem import walk_pages
+from segments import GDTEntry, IDTEntry, read_descriptor_table
+from pci import PCIDevice
+
+# Structured exports of the tables the print_* helpers show as text.
+#
+# Records are tuples following a schema, a list of (name, type) with type
+# "u" (unsigned integer) or "s" (string). They are streamed from the
+# generators below to a writer, one at a time, into:
+#   .jsonl - one JSON object per line
+#   .csv   - header line then one line per record, integers in hex
+#   .col   - "IPCC" | u16 version | u32 header length | JSON header
+#            then row groups: u32 rows, and for each column either the
+#            rows as u64 ("u") or their u16 lengths followed by the
+#            concatenated strings ("s")
+
+COLUMNAR_MAGIC = "IPCC"
+COLUMNAR_VERSION = 1
+ROW_GROUP = 4096
+
+PAGE_FIELDS = [("kind", "s"), ("directory", "u"), ("table", "u"), ("linear", "u"), ("base", "u"),
+               ("size", "u"), ("raw", "u"), ("present", "u"), ("writable", "u"), ("user", "u"),
+               ("write_through", "u"), ("cache_disabled", "u"), ("accessed", "u"), ("dirty", "u"),
+               ("global", "u"), ("avail", "u")]
+
+DESCRIPTOR_FIELDS = [("table", "s"), ("index", "u"), ("raw", "u"), ("present", "u"), ("dpl", "u"),
+                     ("kind", "s"), ("type", "u"), ("base", "u"), ("limit", "u"), ("size", "u"),
+                     ("flags", "u"), ("selector", "u"), ("offset", "u")]
+
+PCI_FIELDS = [("bus", "u"), ("dev", "u"), ("func", "u"), ("config", "u"), ("vendor", "u"), ("device", "u"),
+              ("command", "u"), ("status", "u"), ("revision", "u"), ("class_code", "u"), ("header_type", "u")] + \
+             [("bar%d" % i, "u") for i in xrange(6)]
+
+def page_records(pd=None, directories=True):
+    """
+    Yield the present PDEs (if directories) and PTEs as PAGE_FIELDS records
+    """
+    if pd is None:
+        if t.arch_register("cr0").ToUInt32() & 0x80000001 != 0x80000001:
+            return
+        pd = t.arch_register("cr3").ToUInt32()
+    for entry in walk_pages(int(pd) & ~0xFFF, directories):
+        raw = entry.raw
+        if hasattr(entry, "pde"):
+            (kind, directory, table) = ("PTE", entry.pde.offset, entry.offset)
+            (linear, base, size) = (directory << 22 | table << 12, raw & ~0xFFF, 0x1000)
+        elif raw & 0x80:
+            (kind, directory, table) = ("PDE", entry.offset, 0)
+            (linear, base, size) = (directory << 22, raw & 0xFFC00000, 0x400000)
+        else:
+            (kind, directory, table) = ("PDE", entry.offset, 0)
+            # Address of the page table, the PTEs cover the memory
+            (linear, base, size) = (directory << 22, raw & ~0xFFF, 0)
+        yield (kind, directory, table, linear, base & 0xFFFFFFFF, size, raw, raw & 1, raw >> 1 & 1, raw >> 2 & 1,
+               raw >> 3 & 1, raw >> 4 & 1, raw >> 5 & 1, raw >> 6 & 1 if size else 0, raw >> 8 & 1,
+               raw >> 9 & 7)
+
+def descriptor_records(tables=("gdt", "ldt", "idt"), present=True):
+    """
+    Yield the entries of the thread's descriptor tables as
+    DESCRIPTOR_FIELDS records, only the present ones if present
+    """
+    for table in tables:
+        base = t.arch_register(table + "bas")
+        limit = t.arch_register(table + "lim")
+        gates = table == "idt"
+        for (i, entry) in enumerate(read_descriptor_table(base, limit, IDTEntry if gates else GDTEntry)):
+            raw = entry.raw
+            if present and not entry.present_value:
+                continue
+            access = raw >> 40 & 0xFF
+            if gates:
+                yield (table.upper(), i, raw, entry.present_value, access >> 5 & 3, "gate", access & 0xF,
+                       0, 0, 0, 0, raw >> 16 & 0xFFFF, entry.offset_value)
+                continue
+            kind = "system" if not access & 0x10 else ("code" if access & 0x8 else "data")
+            yield (table.upper(), i, raw, entry.present_value, access >> 5 & 3, kind, access & 0xF,
+                   entry.base_value, entry.limit_value, entry.size_value, raw >> 52 & 0xF,
+                   i << 3 | (4 if table == "ldt" else 0) | access >> 5 & 3, 0)
+
+def pci_records(thread=None, base_addr=0xE0000000):
+    """
+    Yield the functions found on the PCI buses as PCI_FIELDS records,
+    the config header of each one read in a single memblock
+    """
+    thread = thread if thread is not None else t
+    for bus in xrange(256):
+        device_found = False
+        for dev in xrange(32):
+            for func in xrange(8):
+                device = PCIDevice(bus, dev, func, thread, base_addr)
+                vid = device.getVID()
+                if vid == 0xFFFFFFFF or vid == 0x0:
+                    if func == 0:
+                        break
+                    continue
+                if func == 0:
+                    device_found = True
+                config = device.getIOAddress()
+                header = bytes(bytearray(thread.memblock("0x%XP" % config, 0x28, 1).ToRawBytes()))
+                (vendor, device_id, command, status, revision) = struct.unpack_from("<HHHHB", header)
+                class_code = struct.unpack_from("<I", header, 8)[0] >> 8
+                yield (bus, dev, func, config, vendor, device_id, command, status, revision, class_code,
+                       ord(header[0xE])) + struct.unpack_from("<6I", header, 0x10)
+        if not device_found:
+            # bus is empty as there is no root device, skip it
+            break
+
+class JSONLinesWriter(object):
+    def __init__(self, f, fields, kind=None):
+        self.f = f
+        self.names = [name for (name, type) in fields]
+
+    def write(self, record):
+        self.f.write(json.dumps(dict(zip(self.names, record)), sort_keys=True) + "\n")
+
+    def close(self):
+        pass
+
+class CSVWriter(object):
+    def __init__(self, f, fields, kind=None):
+        self.writer = csv.writer(f)
+        self.hex = [type == "u" for (name, type) in fields]
+        self.writer.writerow([name for (name, type) in fields])
+
+    def write(self, record):
+        self.writer.writerow(["0x%X" % value if number else value for (value, number) in zip(record, self.hex)])
+
+    def close(self):
+        pass
+
+class ColumnarWriter(object):
+    """
+    Buffers at most a row group of records before writing it out
+    """
+
+    def __init__(self, f, fields, kind=None, rows=ROW_GROUP):
+        self.f = f
+        self.fields = fields
+        self.rows = rows
+        self.group = []
+        header = json.dumps({"kind": kind, "fields": fields})
+        f.write(COLUMNAR_MAGIC + struct.pack("<HI", COLUMNAR_VERSION, len(header)) + header)
+
+    def write(self, record):
+        self.group.append(record)
+        if len(self.group) >= self.rows:
+            self.flush()
+
+    def flush(self):
+        if not self.group:
+            return
+        count = len(self.group)
+        out = [struct.pack("<I", count)]
+        for (i, (name, type)) in enumerate(self.fields):
+            column = [record[i] for record in self.group]
+            if type == "u":
+                out.append(struct.pack("<%dQ" % count, *column))
+            else:
+                column = [str(value) for value in column]
+                out.append(struct.pack("<%dH" % count, *[len(value) for value in column]))
+                out.append("".join(column))
+        self.f.write("".join(out))
+        self.group = []
+
+    def close(self):
+        self.flush()
+
+WRITERS = {".jsonl": JSONLinesWriter, ".csv": CSVWriter, ".col": ColumnarWriter}
+
+def _format(filename, format):
+    format = format or os.path.splitext(filename)[1]
+    if format not in WRITERS:
+        format = "." + format
+    if format not in WRITERS:
+        raise ValueError("Unknown export format %r" % format)
+    return format
+
+def export_records(filename, fields, records, kind=None, format=None):
+    """
+    Stream records into filename, format from its extension unless given
+    (jsonl, csv or col). Returns the number of records written.
+    """
+    cls = WRITERS[_format(filename, format)]
+    count = 0
+    with open(filename, "wb") as f:
+        writer = cls(f, fields, kind)
+        for record in records:
+            writer.write(record)
+            count += 1
+        writer.close()
+    return count
+
+def export_pages(filename, pd=None, format=None):
+    return export_records(filename, PAGE_FIELDS, page_records(pd), "pages", format)
+
+def export_descriptors(filename, tables=("gdt", "ldt", "idt"), format=None):
+    return export_records(filename, DESCRIPTOR_FIELDS, descriptor_records(tables), "descriptors", format)
+
+def export_pci(filename, thread=None, base_addr=0xE0000000, format=None):
+    return export_records(filename, PCI_FIELDS, pci_records(thread, base_addr), "pci", format)
+
+def _read_header(f):
+    start = f.read(10)
+    if start[:4] != COLUMNAR_MAGIC:
+        raise ValueError("%s is not a columnar export" % f.name)
+    version, length = struct.unpack_from("<HI", start, 4)
+    header = json.loads(f.read(length))
+    return (header.get("kind"), [(str(name), str(type)) for (name, type) in header["fields"]])
+
+def _row_groups(f, fields):
+    # Yield {name: column} for each row group
+    while True:
+        raw = f.read(4)
+        if len(raw) < 4:
+            return
+        count = struct.unpack("<I", raw)[0]
+        columns = {}
+        for (name, type) in fields:
+            if type == "u":
+                column = list(struct.unpack("<%dQ" % count, f.read(8 * count)))
+            else:
+                lengths = struct.unpack("<%dH" % count, f.read(2 * count))
+                data = f.read(sum(lengths))
+                column = []
+                pos = 0
+                for length in lengths:
+                    column.append(data[pos:pos + length])
+                    pos += length
+            columns[name] = column
+        yield (count, columns)
+
+def read_columnar(filename):
+    """
+    Yield the records of a columnar export as dicts, a row group at a time
+    """
+    with open(filename, "rb") as f:
+        (kind, fields) = _read_header(f)
+        names = [name for (name, type) in fields]
+        for (count, columns) in _row_groups(f, fields):
+            for values in zip(*[columns[name] for name in names]):
+                yield dict(zip(names, values))
+
+def load_columns(filename, names=None):
+    """
+    {name: [values]} of a columnar export, only the names columns if given
+    """
+    with open(filename, "rb") as f:
+        (kind, fields) = _read_header(f)
+        names = names or [name for (name, type) in fields]
+        result = {}
+        for (count, columns) in _row_groups(f, fields):
+            for name in names:
+                if name in result:
+                    result[name].extend(columns[name])
+                else:
+                    result[name] = columns[name]
+        return result
+
+def read_jsonl(filename):
+    with open(filename, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def read_csv(filename):
+    with open(filename, "rb") as f:
+        reader = csv.reader(f)
+        names = next(reader)
+        for row in reader:
+            yield dict(zip(names, (int(value, 16) if value.startswith("0x") else value for value in row)))
+
+def load_records(filename, format=None):
+    """
+    Yield the records of an export as dicts, whatever its format
+    """
+    format = _format(filename, format)
+    if format == ".jsonl":
+        return read_jsonl(filename)
+    if format == ".csv":
+        return read_csv(filename)
+    return read_columnar(filename)
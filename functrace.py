@@ -0,0 +1,294 @@
+import csv
+import json
+import time
+import struct
+from collections import deque
+from utils import *
+from proc import *
+import dispatch
+
+# Function trace format:
+#   "IPCF" | u16 version | u32 header length | JSON header
+#   then fixed size records: d time | u16 function | u32 hit | u32 registers[] | u32 stack[]
+#
+# The header names the functions, registers and stack words of the records,
+# stack[0] being the return address and stack[1:] the arguments.
+
+FUNCTION_TRACE_MAGIC = "IPCF"
+FUNCTION_TRACE_VERSION = 1
+
+def load_symbol_file(filename):
+    """
+    {name: address} from a symbol file, "address name" lines (nm output,
+    linker maps...) or "name address" ones
+    """
+    symbols = {}
+    with open(filename, "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2 or fields[0].startswith("#"):
+                continue
+            for (addr, name) in ((fields[0], fields[-1]), (fields[-1], fields[0])):
+                try:
+                    symbols[name] = int(addr, 16)
+                    break
+                except ValueError:
+                    pass
+    return symbols
+
+class Breakpoint(object):
+    __slots__ = ("index", "name", "addr", "handle", "hits", "recorded", "limit", "recent", "disarmed")
+
+    def __init__(self, index, name, addr, limit=None, hot_hits=0):
+        self.index = index
+        self.name = name
+        self.addr = addr
+        self.handle = None
+        self.hits = 0
+        self.recorded = 0
+        self.limit = limit
+        self.recent = deque(maxlen=hot_hits) if hot_hits else None
+        self.disarmed = None
+
+class FunctionTracer(object):
+    """
+    Traces calls of firmware functions with breakpoints on their entry
+
+    Each hit reads the requested registers and, in a single memblock, the
+    return address and stack arguments (as one request when a dispatcher is
+    running), stores a fixed size record and resumes the thread (stepping
+    over the breakpoint first). A function listed twice, by name or
+    address, gets a single breakpoint. Only every
+    every-th hit of a function is read, a function is disarmed after limit
+    hits and, so the firmware doesn't stall, once hot_hits of its hits
+    fall within hot_period seconds.
+    """
+
+    def __init__(self, functions, thread=None, registers=("eax", "ecx", "edx"), args=4, symbols=None,
+                 cs=None, limit=None, every=1, hot_hits=100, hot_period=1.0, filename=None, poll=0.001):
+        self.thread = thread if thread is not None else t
+        self.registers = list(registers)
+        self.args = args
+        self.every = max(1, every)
+        self.hot_period = hot_period
+        self.filename = filename
+        self.poll = poll
+        self.cs = cs
+        self.breakpoints = []
+        self.by_addr = {}
+        for function in functions:
+            if isinstance(function, (int, long)):
+                (name, addr) = ("0x%X" % function, function)
+            else:
+                name = function
+                addr = symbols.get(name) if symbols is not None else None
+                if addr is None:
+                    addr = proc_get_address(self.thread, name, None)
+                if not isinstance(addr, (int, long)):
+                    raise Exception("No address for %s on %s" % (name, self.thread.name))
+            if addr in self.by_addr:
+                print("%s is at the same address as %s, tracing it once" % (name, self.by_addr[addr].name))
+                continue
+            bp = Breakpoint(len(self.breakpoints), name, addr, limit, hot_hits)
+            self.breakpoints.append(bp)
+            self.by_addr[addr] = bp
+        # eip is known from the hit, esp is needed for the stack
+        self.reads = [name for name in self.registers if name != "eip"]
+        if "esp" not in self.reads:
+            self.reads.append("esp")
+        self.record = struct.Struct("<dHI%dI" % (len(self.registers) + 1 + args))
+        self.data = bytearray()
+        self.file = None
+        self.hits = 0
+        self.foreign = 0
+        self.halted_time = 0.0
+        self.wall_time = 0.0
+
+    def header(self):
+        return {"thread": getattr(self.thread, "name", None), "created": time.time(), "cs": self.cs,
+                "functions": [[bp.name, bp.addr] for bp in self.breakpoints],
+                "registers": self.registers, "stack": ["ret"] + ["arg%d" % i for i in xrange(self.args)]}
+
+    def __write(self, data):
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self.data += data
+
+    def __halt(self):
+        try:
+            self.thread.halt()
+        except:
+            # It could timeout for no good reason
+            pass
+
+    def arm(self):
+        if self.cs is None:
+            self.cs = self.thread.arch_register("cs").ToUInt32()
+        for bp in self.breakpoints:
+            if bp.handle is None and bp.disarmed is None:
+                bp.handle = self.thread.brnew("0x%X:0x%X" % (self.cs, bp.addr))
+
+    def disarm(self, bp, reason):
+        if bp.handle is not None:
+            self.thread.brremove(bp.handle)
+            bp.handle = None
+        bp.disarmed = reason
+
+    def armed(self):
+        return [bp for bp in self.breakpoints if bp.handle is not None]
+
+    def __wait(self, deadline):
+        while not self.thread.ishalted():
+            if time.time() >= deadline:
+                return False
+            time.sleep(self.poll)
+        return True
+
+    def __read(self):
+        registers = dict((name, self.thread.arch_register(name).ToUInt32()) for name in self.reads)
+        raw = self.thread.memblock("0x%X:0x%X" % (self.ss, registers["esp"]), 4 * (1 + self.args), 1).ToRawBytes()
+        return (registers, raw)
+
+    def __capture(self, bp, now, eip):
+        dispatcher = dispatch.get_dispatcher()
+        if dispatcher is not None:
+            # Back to back on the link, nothing queued in between
+            (registers, raw) = dispatcher.submit_call(self.__read, priority=dispatch.PRIORITY_INTERACTIVE).result()
+        else:
+            (registers, raw) = self.__read()
+        registers["eip"] = eip
+        values = [registers[name] for name in self.registers]
+        values.extend(struct.unpack("<%dI" % (1 + self.args), bytes(bytearray(raw))))
+        self.__write(self.record.pack(now, bp.index, bp.hits, *values))
+        bp.recorded += 1
+
+    def __resume(self, bp):
+        if bp.handle is None:
+            self.thread.go()
+            return
+        # Get past the breakpoint we're sitting on
+        self.thread.brdisable(bp.handle)
+        self.thread.step("into", 1)
+        self.thread.brenable(bp.handle)
+        self.thread.go()
+
+    def __hit(self, bp, now, eip):
+        bp.hits += 1
+        self.hits += 1
+        if (bp.hits - 1) % self.every == 0:
+            self.__capture(bp, now, eip)
+        if bp.limit is not None and bp.hits >= bp.limit:
+            self.disarm(bp, "limit")
+        elif bp.recent is not None:
+            bp.recent.append(now)
+            if len(bp.recent) == bp.recent.maxlen and now - bp.recent[0] < self.hot_period:
+                self.disarm(bp, "hot")
+
+    def run(self, duration=10, max_hits=None):
+        """
+        Trace for duration seconds, until max_hits hits or until every
+        function got disarmed
+        """
+        was_halted = self.thread.ishalted()
+        self.__halt()
+        if self.filename is not None and self.file is None:
+            header = json.dumps(self.header())
+            self.file = open(self.filename, "wb")
+            self.file.write(FUNCTION_TRACE_MAGIC + struct.pack("<HI", FUNCTION_TRACE_VERSION, len(header)) + header)
+        self.ss = self.thread.arch_register("ss").ToUInt32()
+        self.arm()
+        start = time.time()
+        deadline = start + duration
+        hits = 0
+        try:
+            self.thread.go()
+            while self.armed() and (max_hits is None or hits < max_hits):
+                if not self.__wait(deadline):
+                    break
+                halted = time.time()
+                eip = self.thread.arch_register("eip").ToUInt32()
+                bp = self.by_addr.get(eip)
+                if bp is None:
+                    # Not one of ours, someone else's breakpoint or a halt
+                    self.foreign += 1
+                    self.thread.go()
+                else:
+                    self.__hit(bp, halted, eip)
+                    hits += 1
+                    self.__resume(bp)
+                self.halted_time += time.time() - halted
+        finally:
+            self.__halt()
+            for bp in self.armed():
+                self.thread.brremove(bp.handle)
+                bp.handle = None
+            if not was_halted:
+                self.thread.go()
+            self.wall_time += time.time() - start
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        print("Function tracer: %d hits in %.1fs, target halted %.1f%% of the time" %
+              (hits, time.time() - start, self.intrusion() * 100))
+        return self
+
+    def intrusion(self):
+        return self.halted_time / self.wall_time if self.wall_time else 0.0
+
+    def records(self):
+        """
+        Records traced without a file, see read_function_trace
+        """
+        return _records(self.header(), self.record, bytes(self.data))
+
+    def print_stats(self):
+        for bp in sorted(self.breakpoints, key=lambda bp: -bp.hits):
+            print("%-32s %8d hits %8d recorded%s" % (bp.name, bp.hits, bp.recorded,
+                                                      " (disarmed: %s)" % bp.disarmed if bp.disarmed else ""))
+        if self.foreign:
+            print("%d halts on other breakpoints" % self.foreign)
+
+def _records(header, record, data):
+    functions = [name for (name, addr) in header["functions"]]
+    fields = header["registers"] + header["stack"]
+    records = []
+    for pos in xrange(0, len(data) - record.size + 1, record.size):
+        values = record.unpack_from(data, pos)
+        entry = {"time": values[0], "function": functions[values[1]], "hit": values[2]}
+        entry.update(zip(fields, values[3:]))
+        records.append(entry)
+    return records
+
+def read_function_trace(filename):
+    """
+    Return (header, records) of a function trace, each record a dict
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    if data[:4] != FUNCTION_TRACE_MAGIC:
+        raise ValueError("%s is not a function trace" % filename)
+    version, length = struct.unpack_from("<HI", data, 4)
+    header = json.loads(data[10:10 + length])
+    record = struct.Struct("<dHI%dI" % (len(header["registers"]) + len(header["stack"])))
+    return (header, _records(header, record, data[10 + length:]))
+
+def function_trace_to_json(filename, output):
+    (header, records) = read_function_trace(filename)
+    with open(output, "w") as f:
+        json.dump({"header": header, "records": records}, f, indent=1)
+
+def function_trace_to_csv(filename, output):
+    (header, records) = read_function_trace(filename)
+    columns = ["time", "function", "hit"] + header["registers"] + header["stack"]
+    with open(output, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for record in records:
+            writer.writerow([record[column] if column in ("time", "function", "hit") else "0x%X" % record[column]
+                             for column in columns])
+
+def trace_functions(functions, duration=10, max_hits=None, **kwargs):
+    tracer = FunctionTracer(functions, **kwargs).run(duration, max_hits)
+    tracer.print_stats()
+    return tracer
@@ -1,28 +1,47 @@
+import struct
+from contextlib import contextmanager
 from utils import *
 from asm import *
 from segments import *
 
-class PDE:
+class PDE(object):
+    """
+    Page directory entry, stored as its raw 32 bit value
+    """
+    __slots__ = ("offset", "raw")
+
     def __init__(self, offset, bits):
         # https://wiki.osdev.org/Paging
         self.offset = offset
-        self.bits = bits
-        self.base_addr = bits[12:31]
-        self.avail = bits[9:11]
-        self.glob = bits[8]
-        self.size = bits[7]
-        self.reserved = bits[6]
-        self.accessed = bits[5]
-        self.cache_disabled = bits[4]
-        self.write_through = bits[3]
-        self.user_supervisor = bits[2]
-        self.read_write = bits[1]
-        self.present = bits[0]
+        self.raw = bits if isinstance(bits, (int, long)) else int(bits)
 
+    @staticmethod
+    def entries(data):
+        """
+        Raw values of a whole page directory/table from its bytes
+        """
+        data = bytes(bytearray(data))
+        return struct.unpack_from("<%dI" % (len(data) // 4), data)
 
-        
+    @classmethod
+    def table(cls, data):
+        return [cls(i, raw) for (i, raw) in enumerate(cls.entries(data))]
+
+    bits = property(lambda self: bitdata(32, self.raw))
+    base_addr = property(lambda self: self.raw >> 12 & 0xFFFFF)
+    avail = property(lambda self: self.raw >> 9 & 7)
+    glob = property(lambda self: self.raw >> 8 & 1)
+    size = property(lambda self: self.raw >> 7 & 1)
+    reserved = property(lambda self: self.raw >> 6 & 1)
+    accessed = property(lambda self: self.raw >> 5 & 1)
+    cache_disabled = property(lambda self: self.raw >> 4 & 1)
+    write_through = property(lambda self: self.raw >> 3 & 1)
+    user_supervisor = property(lambda self: self.raw >> 2 & 1)
+    read_write = property(lambda self: self.raw >> 1 & 1)
+    present = property(lambda self: self.raw & 1)
 
     def __str__(self):
+        bits = self.bits
         return "Page Directory Entry: %s\n" \
             "  Memory address : %s-%s\n" \
             "  Page-Table Base Address: %s\n" \
@@ -36,28 +55,35 @@ class PDE:
             "  User-Supervisor: %s\n" \
             "  Read-Write: %s\n" \
             "  Present: %s\n" % \
-            (self.bits,
+            (bits,
              hex(self.offset << 22), hex(self.offset << 22 | 0x3FFFFF),
-             self.base_addr,
-             self.avail,
-             self.glob,
-             self.size, "4MB" if self.size else "4KB",
-             self.reserved,
-             self.accessed,
-             self.cache_disabled,
-             self.write_through,
-             self.user_supervisor,
-             self.read_write,
-             self.present)
+             bits[12:31],
+             bits[9:11],
+             bits[8],
+             bits[7], "4MB" if self.size else "4KB",
+             bits[6],
+             bits[5],
+             bits[4],
+             bits[3],
+             bits[2],
+             bits[1],
+             bits[0])
     
 class PTE(PDE):
+    __slots__ = ("pde", )
+
     def __init__(self, pde, offset, bits):
         PDE.__init__(self, offset, bits)
         self.pde = pde
-        self.dirty = self.reserved
-        
-        
+
+    @classmethod
+    def table(cls, pde, data):
+        return [cls(pde, i, raw) for (i, raw) in enumerate(cls.entries(data))]
+
+    dirty = property(lambda self: self.reserved)
+
     def __str__(self):
+        bits = self.bits
         return "Page Table Entry: %s\n" \
             "  Memory address : %s-%s\n" \
             "  Page Base Address: %s\n" \
@@ -71,20 +97,41 @@ class PTE(PDE):
             "  User-Supervisor: %s\n" \
             "  Read-Write: %s\n" \
             "  Present: %s\n" % \
-            (self.bits,
+            (bits,
              hex(self.pde.offset << 22 | self.offset << 12),
              hex(self.pde.offset << 22 | self.offset << 12 | 0xFFF),
-             self.base_addr,
-             self.avail,
-             self.glob,
-             self.size,
-             self.dirty,
-             self.accessed,
-             self.cache_disabled,
-             self.write_through,
-             self.user_supervisor,
-             self.read_write,
-             self.present)
+             bits[12:31],
+             bits[9:11],
+             bits[8],
+             bits[7],
+             bits[6],
+             bits[5],
+             bits[4],
+             bits[3],
+             bits[2],
+             bits[1],
+             bits[0])
+
+def read_page_table(addr):
+    """
+    Raw entries of a page directory or table, read with a single memblock
+    """
+    return PDE.entries(t.memblock(phys(addr), 0x1000, 1).ToRawBytes())
+
+def walk_pages(pd, directories=True):
+    """
+    Yield the present PDEs (if directories) and PTEs
+    """
+    for (i, raw) in enumerate(read_page_table(pd)):
+        if not raw & 1:
+            continue
+        pde = PDE(i, raw)
+        if directories:
+            yield pde
+        if raw & 0x80 == 0:
+            for (j, raw) in enumerate(read_page_table(raw & ~0xFFF)):
+                if raw & 1:
+                    yield PTE(pde, j, raw)
 
 def print_memory_mapping():
     cr0 = reg("cr0")
@@ -93,18 +140,9 @@ def print_memory_mapping():
     if cr0 & 0x80000001 != 0x80000001:
         print "Paging not Enabled"
         return
-    memory = []
-    for i in range(1024):
-        pde = t.memblock(phys(pd + i*4), 4, 1)
-        pde = PDE(i, pde)
-        if pde.present:
-            if pde.size == 0:
-                pt = pde.base_addr << 12
-                for j in range(1024):
-                    pte = t.memblock(phys(pt + j*4), 4, 1)
-                    pte = PTE(pde, j, pte)
-                    if pte.present:
-                        print(pte)
+    for pte in walk_pages(int(pd), directories=False):
+        print(pte)
+
 def print_pages():
     cr0 = reg("cr0")
     pd = reg("cr3")
@@ -112,30 +150,20 @@ def print_pages():
     if cr0 & 0x80000001 != 0x80000001:
         print "Paging not Enabled"
         return
-    for i in range(1024):
-        pde = t.memblock(phys(pd + i*4), 4, 1)
-        pde = PDE(i, pde)
-        if pde.present:
-            print(pde)
-            if pde.size == 0:
-                pt = pde.base_addr << 12
-                for j in range(1024):
-                    pte = t.memblock(phys(pt + j*4), 4, 1)
-                    pte = PTE(pde, j, pte)
-                    if pte.present:
-                        print(pte)
+    for entry in walk_pages(int(pd)):
+        print(entry)
 
 def linear_to_pages(addr):
-    addr_bits = ipc.BitData(32, addr)
-    directory = addr_bits[22:31].ToUInt32()
-    offset = addr_bits[0:21].ToUInt32()
+    addr = int(addr)
+    directory = addr >> 22 & 0x3FF
+    offset = addr & 0x3FFFFF
     pd = reg("cr3")
     pde = t.memblock(phys(pd + directory*4), 4, 1)
     pde = PDE(directory, pde)
     if pde.present:
         if pde.size == 0:
-            table = addr_bits[12:21].ToUInt32()
-            offset = addr_bits[0:11].ToUInt32()
+            table = addr >> 12 & 0x3FF
+            offset = addr & 0xFFF
             pt = pde.base_addr << 12
             pte = t.memblock(phys(pt + table*4), 4, 1)
             pte = PTE(pde, table, pte)
@@ -152,14 +180,14 @@ def print_page_info(addr):
             if pte.present:
                 print(pte)
                 print "Offset in table : %s" % hex(offset)
-                print "Physical address : 0x%XP" % (pte.base_addr.ToUInt32() << 12 | offset)
+                print "Physical address : 0x%XP" % (pte.base_addr << 12 | offset)
                 return pte
             else:
                 print "Table not present"
         else:
             print(pde)
             print "Offset in table : %s" % hex(offset)
-            print "Physical address : %sP" % hex(pde.base_addr.ToUInt32() << 12 | offset)
+            print "Physical address : %sP" % hex(pde.base_addr << 12 | offset)
             return pde
     else:
         print "Directory not present"
@@ -173,10 +201,10 @@ def linear_to_phys(addr):
     (pde, pte, offset) = linear_to_pages(addr)
     if pte:
         if pte.present:
-            return pte.base_addr.ToUInt32() << 12 | offset
+            return pte.base_addr << 12 | offset
         return None
     if pde.present:
-        return pde.base_addr.ToUInt32() << 12 | offset
+        return pde.base_addr << 12 | offset
     return None
     
 def dump_pages(filename):
@@ -223,49 +251,91 @@ def malign(alignment, size):
 
 dma_heap = None
 
-def dma_init_heap():
+# ATT window dma_init_heap maps for the heap, host memory behind it
+DMA_HEAP_WINDOW = (0x20000000, 0x10000000)
+
+# Each session (see session.py) has its own heap, the module global is the
+# one used without sessions
+def get_dma_heap():
+    session = current_session()
+    return session.dma_heap if session is not None else dma_heap
+
+def set_dma_heap(value):
     global dma_heap
-    setup_att(0x20000000, 0x10000000, 0x20000000, 0x03060001)
-    dma_heap = 0x20000000
+    session = current_session()
+    if session is not None:
+        session.dma_heap = value
+    else:
+        dma_heap = value
+
+def dma_init_heap():
+    setup_att(DMA_HEAP_WINDOW[0], DMA_HEAP_WINDOW[1], 0x20000000, 0x03060001)
+    set_dma_heap(DMA_HEAP_WINDOW[0])
     
 def dma_alloc(size, memset_value=None):
-    global dma_heap
     size = int(size)
-    if dma_heap is None:
+    if get_dma_heap() is None:
         dma_init_heap()
-    addr = dma_heap
-    dma_heap = (addr + size) & ~3
+    addr = get_dma_heap()
+    set_dma_heap((addr + size) & ~3)
     if memset_value is not None:
         memset(addr, memset_value, size)
     return addr
 
 def dma_align(alignment, size, memset_value=None):
-    global dma_heap
     alignment = int(alignment)
     size = int(size)
-    if dma_heap is None:
+    if get_dma_heap() is None:
         dma_init_heap()
-    addr = (dma_heap + alignment - 1) & ~(alignment - 1)
-    dma_heap = (addr + size) & ~3
+    addr = (get_dma_heap() + alignment - 1) & ~(alignment - 1)
+    set_dma_heap((addr + size) & ~3)
     if memset_value is not None:
         memset(addr, memset_value, size)
     return addr
 
+# Called without arguments whenever setup_att/att_window change the ATT
+att_listeners = []
+
+def get_att_listeners():
+    session = current_session()
+    return session.att_listeners if session is not None else att_listeners
+
+def _att_changed():
+    for listener in list(get_att_listeners()):
+        listener()
+
 def setup_att(addr, size, external, control):
     t.mem(phys(0xf00a80c0), 4, addr)
     t.mem(phys(0xf00a80c4), 4, size)
     t.mem(phys(0xf00a80c8), 4, external & 0xFFFFFFFF)
     t.mem(phys(0xf00a80cc), 4, external >> 32)
     t.mem(phys(0xf00a80d0), 4, control)
+    _att_changed()
 
-def dram(addr, size):
+# Where dram() maps host memory through the first ATT entry
+DRAM_WINDOW = 0x30000000
+
+@contextmanager
+def att_window(addr, size):
+    """
+    Map host memory at DRAM_WINDOW for the duration of the block
+    The previous ATT entry is restored afterwards.
+    """
     att = t.memblock(phys(0xf00a8000), 0x20, 1)
-    t.mem(phys(0xf00a8000), 4, 0x30000000)
+    t.mem(phys(0xf00a8000), 4, DRAM_WINDOW)
     t.mem(phys(0xf00a8004), 4, (size + 0xffffff) & ~0xffffff)
     t.mem(phys(0xf00a8008), 4, addr & 0xFFFFFFFF)
     t.mem(phys(0xf00a800c), 4, addr >> 32)
     t.mem(phys(0xf00a8010), 4, 0x03060001)
-    data = t.memblock(0x30000000, size, 1).ToRawBytes()
-    t.memdump(phys(0x30000000), size, 1)
-    t.memblock(phys(0xf00a8000), 0x20, 1, att.ToRawBytes())
+    _att_changed()
+    try:
+        yield DRAM_WINDOW
+    finally:
+        t.memblock(phys(0xf00a8000), 0x20, 1, att.ToRawBytes())
+        _att_changed()
+
+def dram(addr, size):
+    with att_window(addr, size) as window:
+        data = t.memblock(window, size, 1).ToRawBytes()
+        t.memdump(phys(window), size, 1)
     return data
@@ -92,6 +92,9 @@ ldt_ranges = [
     (0xFFFF0000, 0xF01CF)]
     
 
+def dump_filename(prefix, addr):
+    return prefix + hex(addr)[2:].replace("L", "") + ".bin"
+
 def save_mmios(t, pwd, mmios, prefix="MMIO_"):
     try:
         os.makedirs(pwd)
@@ -101,7 +104,7 @@ def save_mmios(t, pwd, mmios, prefix="MMIO_"):
     mmios.sort(lambda a, b: cmp(a[1], b[1]) if a[1] != b[1] else cmp(a[0], b[0]))
     for (addr, size) in mmios:
         print("Addr: %s, size: %s" % (hex(addr), hex(size)))
-        path = os.path.join(pwd, prefix + hex(addr)[2:].replace("L", "") + ".bin")
+        path = os.path.join(pwd, dump_filename(prefix, addr))
         if os.path.exists(path):
             statinfo = os.stat(path)
             if statinfo.st_size >= size:
@@ -119,6 +122,12 @@ def save_mmios(t, pwd, mmios, prefix="MMIO_"):
                 size -= chunk
 
 
+def value_is_interesting(value):
+    for i in value.ReadByteArray():
+        if i != 0xFF and i != 0x00:
+            return True
+    return False
+
 # Sideband loading. No idea what the value is/represents, but 0x706a8 makes it
 # load DCI sideband into segment 0x19f (at 0xf6110000) and 0x70684 loads the DFx
 # agregator instead. So let's try to bruteforce a few of these, see if any of them
@@ -143,7 +152,7 @@ class Sideband(object):
     def __init__(self, t, base_address=None):
         self.__thread = t
         self.base_addr = proc_get_address(t, "SB_CHANNEL") if not base_address else base_address
-        self.broken_ports = proc_get_address(t, "SB_BROKEN_PORTS")
+        self.broken_ports = proc_get_address(t, "SB_BROKEN_PORTS", [])
 
     def __setup(self, channel, rs=1, fid=0,):
         # Can only set it if the flag 0x2 (LOCK) is not set
@@ -157,7 +166,10 @@ class Sideband(object):
     def __channel_value(self, group, port):
         return (group << 8) + port
 
-    def read(self, group, port, size, rs=1, fid=0):
+    def probe(self, group, port, size, rs=1, fid=0):
+        """
+        Read a sideband port, returning (value, locked)
+        """
         if not self.__thread.ishalted():
             raise Exception("Execution threads is not halted!")
         
@@ -165,10 +177,14 @@ class Sideband(object):
         sb_mmio, _ = self.__setup(channel, rs, fid)
         ret = self.__thread.memblock(phys(sb_mmio), size, 1)
         try:
-            a = self.__thread.mem(phys(self.base_addr + 0x18), 4)
-            if a != channel:
-                raise "Error"
+            locked = self.__thread.mem(phys(self.base_addr + 0x18), 4) != channel
         except:
+            locked = True
+        return (ret, locked)
+
+    def read(self, group, port, size, rs=1, fid=0):
+        ret, locked = self.probe(group, port, size, rs, fid)
+        if locked:
             print("SB seems to have locked")
         
         return ret
@@ -183,10 +199,7 @@ class Sideband(object):
     
     
     def __value_is_interesting(self, value):
-        for i in value.ReadByteArray():
-            if i != 0xFF and i != 0x00:
-                return True
-        return False
+        return value_is_interesting(value)
     
     def bruteforce(self, group, pstart=0, pend=0x100, rs=1, fid=0, size=0x10):
         for port in xrange(pstart, pend):
@@ -277,30 +290,133 @@ def dump_sideband_channel(t, pwd, channel, size=0x8000, rs=1, fid=0):
         print("SB seems to have locked")
         ipc.resettarget()
 
-def dump_sideband_channel_via_sbreg(t, pwd, channel, offset=0, size=0x8000, rs=1, fid=0, bar=0, opcode=0):
+def find_tpsb():
     tpsbs = [i for i in dir(ipc.stateport) if "tpsb" in i]
     if len(tpsbs) == 0:
-        print("Can't find Tap2IOSF device")
-        return
-    tpsb = getattr(ipc.stateport, tpsbs[0])
+        return None
+    return getattr(ipc.stateport, tpsbs[0])
+
+class HexView(object):
+    """
+    Lazy hex/ASCII rendering of a buffer, one line per row
+    """
+
+    def __init__(self, data, base=0, failed=None, width=0x10, word=4):
+        self.data = data
+        self.base = base
+        self.failed = failed
+        self.width = width
+        self.word = word
+
+    def word_failed(self, idx):
+        return self.failed is not None and (self.failed[idx >> 3] >> (idx & 7)) & 1
+
+    def row(self, offset):
+        row = self.data[offset:offset + self.width]
+        hexa = []
+        text = []
+        partial = False
+        for i in xrange(0, len(row), self.word):
+            if self.word_failed((offset + i) // self.word):
+                partial = True
+                hexa.append(" ".join(["--"] * len(row[i:i + self.word])))
+                text.append(" " * len(row[i:i + self.word]))
+                continue
+            hexa.append(" ".join("%02X" % b for b in row[i:i + self.word]))
+            text.append("".join(chr(b) if 0x20 <= b < 0x7F else "." for b in row[i:i + self.word]))
+        return "0x%08X: %s  %s%s" % (self.base + offset, " ".join(hexa), "".join(text),
+                                     "   ***" if partial else "")
+
+    def __iter__(self):
+        for offset in xrange(0, len(self.data), self.width):
+            yield self.row(offset)
+
+    def __str__(self):
+        return "\n".join(self)
 
-    data = ipc.BitData(0, 0)
-    force = False
-    limit = offset + size
-    for i in xrange(offset, limit, 4):
+class SbregDump(object):
+    def __init__(self, offset, data, failed):
+        self.offset = offset
+        self.data = data
+        self.failed = failed
+
+    def failed_offsets(self):
+        for idx in xrange(len(self.data) // 4):
+            if (self.failed[idx >> 3] >> (idx & 7)) & 1:
+                yield self.offset + idx * 4
+
+    def view(self):
+        return HexView(self.data, self.offset, self.failed)
+
+    def __str__(self):
+        return str(self.view())
+
+class SbregReader(object):
+    """
+    Bulk reads through the Tap2IOSF sbreg stateport
+
+    Data goes straight into a preallocated bytearray and failed words are
+    recorded in a bitmap (bit n = word at offset + 4 * n).
+    """
+
+    ACCESS_SIZES = (8, 4)
+
+    def __init__(self, tpsb, channel, rs=1, fid=0, bar=0, opcode=0):
+        self.tpsb = tpsb
+        self.channel = channel
+        self.rs = rs
+        self.fid = fid
+        self.bar = bar
+        self.opcode = opcode
+        self.access_size = None
+
+    def sbreg(self, offset, size):
         try:
-            data.Append(tpsb.sbreg(bar, fid, i, channel, rs, 4, opcode)[0:31])
-            if ((i + 4) % 0x10) == 0:
-                force = True
+            value = self.tpsb.sbreg(self.bar, self.fid, offset, self.channel, self.rs, size, self.opcode)
         except:
-            force = True
-            offset = i - (data.BitSize / 8)
-        if force or i + 4 >= limit:
-            if data.BitSize > 0:
-                print "0x%08X: %s%s" % (offset, " ".join(map(lambda b: "%02X" % b, data.ToRawBytes())), "" if data.BitSize == 0x80 else "   ***")
-                data = ipc.BitData(0, 0)
-            offset = i + 4
-        force = False
+            return None
+        return int(value[0:size * 8 - 1])
+
+    def probe_access_size(self, offset):
+        # Use the widest access the port accepts
+        for size in self.ACCESS_SIZES:
+            if self.sbreg(offset, size) is not None:
+                return size
+        return 4
+
+    def read(self, offset, size):
+        size = (size + 3) & ~3
+        data = bytearray(size)
+        failed = bytearray((size // 4 + 7) // 8)
+        if self.access_size is None:
+            self.access_size = self.probe_access_size(offset)
+        wide = self.access_size
+        pos = 0
+        while pos < size:
+            width = wide if size - pos >= wide else 4
+            value = self.sbreg(offset + pos, width)
+            if value is None and width > 4:
+                # Retry word by word so a single bad word doesn't hide its neighbour
+                width = 4
+                value = self.sbreg(offset + pos, width)
+            if value is None:
+                idx = pos // 4
+                failed[idx >> 3] |= 1 << (idx & 7)
+            else:
+                for i in xrange(width):
+                    data[pos + i] = (value >> (8 * i)) & 0xFF
+            pos += width
+        return SbregDump(offset, data, failed)
+
+def dump_sideband_channel_via_sbreg(t, pwd, channel, offset=0, size=0x8000, rs=1, fid=0, bar=0, opcode=0):
+    tpsb = find_tpsb()
+    if tpsb is None:
+        print("Can't find Tap2IOSF device")
+        return
+    dump = SbregReader(tpsb, channel, rs, fid, bar, opcode).read(offset, size)
+    for line in dump.view():
+        print(line)
+    return dump
         
             
 def clear_psf():
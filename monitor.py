@@ -0,0 +1,346 @@
+import time
+import array
+import struct
+from utils import *
+from proc import *
+from mem import phys
+from mmio import setup_sideband_channel
+from addrmap import ATT_BASE, ATT_ENTRIES
+import xhci as xhci_module
+
+# Gap (bytes) below which two registers of a source are read in one block
+MERGE_GAP = 0x40
+MAX_BLOCK = 0x1000
+
+_FORMATS = {1: "<B", 2: "<H", 4: "<I", 8: "<Q"}
+
+class Register(object):
+    """
+    One value to sample
+
+    kind is "phys" (physical memory), "sb" (register behind a sideband
+    channel, like XHCI.bar_read/pci_read) or "reg" (thread register).
+    fields are {name: (first bit, length)}, only decoded when viewed.
+    """
+    __slots__ = ("name", "kind", "addr", "size", "channel", "fid", "fields")
+
+    def __init__(self, name, kind, addr, size=4, channel=None, fid=0, fields=None):
+        if size not in _FORMATS:
+            raise ValueError("Register %s: unsupported size %d" % (name, size))
+        self.name = name
+        self.kind = kind
+        self.addr = addr
+        self.size = size
+        self.channel = channel
+        self.fid = fid
+        self.fields = fields or {}
+
+    @classmethod
+    def phys(cls, name, addr, size=4, fields=None):
+        return cls(name, "phys", addr, size, fields=fields)
+
+    @classmethod
+    def sideband(cls, name, port, offset, size=4, fid=0, opcode=0, fields=None):
+        """
+        opcode 0 reads the BAR of the function, 4 its PCI configuration space
+        """
+        channel = 1 << 28 | (opcode | 1) << 16 | (opcode & ~1) << 8 | port
+        return cls(name, "sb", offset, size, channel, fid, fields)
+
+    @classmethod
+    def thread(cls, name, register, size=4, fields=None):
+        return cls(name, "reg", register, size, fields=fields)
+
+    @property
+    def source(self):
+        return (self.kind, self.channel, self.fid)
+
+    def decode(self, value):
+        return dict((field, (value >> start) & ((1 << length) - 1))
+                    for (field, (start, length)) in self.fields.items())
+
+    def format(self, value):
+        text = "0x%0*X" % (self.size * 2, value)
+        if self.fields:
+            text += " " + " ".join("%s=%X" % (field, decoded)
+                                   for (field, decoded) in sorted(self.decode(value).items()))
+        return text
+
+class Trigger(object):
+    """
+    Fires when a register's masked value changes (value is None) or when it
+    becomes value. The monitor then takes burst samples at burst_rate (as
+    fast as the link allows if None).
+    """
+
+    def __init__(self, register, mask=None, value=None, burst=64, burst_rate=None):
+        self.register = register
+        self.mask = mask
+        self.value = value
+        self.burst = burst
+        self.burst_rate = burst_rate
+        self.previous = None
+        self.fired = 0
+
+    def check(self, value):
+        if self.mask is not None:
+            value &= self.mask
+        previous, self.previous = self.previous, value
+        if self.value is not None:
+            return value == self.value and previous != value
+        return previous is not None and value != previous
+
+    def __str__(self):
+        name = self.register if self.mask is None else "%s & 0x%X" % (self.register, self.mask)
+        if self.value is not None:
+            return "%s == 0x%X" % (name, self.value)
+        return "%s changed" % name
+
+class _Block(object):
+    __slots__ = ("source", "addr", "size", "registers")
+
+    def __init__(self, source, addr):
+        self.source = source
+        self.addr = addr
+        self.size = 0
+        self.registers = []
+
+class Monitor(object):
+    """
+    Time series of registers sampled at a fixed rate
+
+    Registers of the same source are merged into the fewest block reads
+    (dwords for MMIO), sideband channels are set up once per sample and
+    not at all when there is only one of them. Each sample is a row of raw
+    values in a ring buffer of history rows with its timestamp next to it,
+    values and fields are only decoded when looked at.
+    """
+
+    def __init__(self, registers, rate=100, history=4096, thread=None, triggers=()):
+        self.thread = thread if thread is not None else t
+        self.registers = list(registers)
+        self.rate = rate
+        self.history = history
+        self.triggers = list(triggers)
+        self.offsets = {}
+        row = 0
+        for register in self.registers:
+            if register.name in self.offsets:
+                raise ValueError("Register %s listed twice" % register.name)
+            self.offsets[register.name] = (row, register)
+            row += register.size
+        self.row_size = row
+        self.rows = bytearray(row * history)
+        self.times = array.array("d", [0.0]) * history
+        self.count = 0
+        self.bursts = []
+        self.blocks = self.plan()
+        self.channels = sorted(set(block.source for block in self.blocks if block.source[0] == "sb"))
+        self.selected = None
+
+    def plan(self):
+        blocks = []
+        by_source = {}
+        for register in self.registers:
+            if register.kind == "reg":
+                block = _Block(register.source, register.addr)
+                block.registers.append(register)
+                blocks.append(block)
+            else:
+                by_source.setdefault(register.source, []).append(register)
+        for (source, registers) in sorted(by_source.items()):
+            block = None
+            for register in sorted(registers, key=lambda register: register.addr):
+                end = register.addr + register.size
+                if block is None or register.addr - (block.addr + block.size) > MERGE_GAP or \
+                   end - block.addr > MAX_BLOCK:
+                    block = _Block(source, register.addr & ~3)
+                    blocks.append(block)
+                block.size = max(block.size, (end - block.addr + 3) & ~3)
+                block.registers.append(register)
+        return blocks
+
+    def transactions(self):
+        """
+        Link transactions per sample (sideband channel setup included)
+        """
+        return len(self.blocks) + (4 * len(self.channels) if len(self.channels) > 1 else 0)
+
+    def __select(self, source):
+        if self.selected is not None and self.selected[0] == source:
+            return self.selected[1]
+        window, _ = setup_sideband_channel(self.thread, source[1], 0, source[2] << 3)
+        self.selected = (source, int(window))
+        return self.selected[1]
+
+    def __read(self, block):
+        if block.source[0] == "reg":
+            register = block.registers[0]
+            value = int(self.thread.arch_register(register.addr))
+            return struct.pack(_FORMATS[register.size], value & ((1 << 8 * register.size) - 1))
+        addr = block.addr
+        if block.source[0] == "sb":
+            addr += self.__select(block.source)
+        return bytes(bytearray(self.thread.memblock(phys(addr), block.size // 4, 4).ToRawBytes()))
+
+    def sample(self):
+        """
+        Take one sample, returns the triggers that fired on it
+        """
+        if len(self.channels) > 1:
+            self.selected = None
+        timestamp = time.time()
+        slot = self.count % self.history
+        pos = slot * self.row_size
+        for block in self.blocks:
+            data = self.__read(block)
+            for register in block.registers:
+                start = self.offsets[register.name][0]
+                offset = register.addr - block.addr if block.source[0] != "reg" else 0
+                self.rows[pos + start:pos + start + register.size] = data[offset:offset + register.size]
+        self.times[slot] = timestamp
+        self.count += 1
+        fired = []
+        for trigger in self.triggers:
+            if trigger.check(self.value(trigger.register, -1)):
+                trigger.fired += 1
+                fired.append(trigger)
+        return fired
+
+    def run(self, duration=10, count=None):
+        """
+        Sample at rate for duration seconds (or count samples), switching to
+        a trigger's burst_rate for its burst samples when it fires
+        """
+        start = time.time()
+        deadline = start
+        taken = 0
+        burst = 0
+        burst_period = None
+        self.selected = None
+        while time.time() - start < duration and (count is None or taken < count):
+            fired = self.sample()
+            taken += 1
+            for trigger in fired:
+                self.bursts.append((self.count - 1, trigger))
+                burst = max(burst, trigger.burst)
+                if trigger.burst_rate:
+                    burst_period = min(burst_period or 1.0 / trigger.burst_rate, 1.0 / trigger.burst_rate)
+            if burst:
+                burst -= 1
+                period = burst_period or 0
+            else:
+                burst_period = None
+                period = 1.0 / self.rate
+            # Keep the schedule, don't accumulate the time spent reading
+            deadline = max(deadline + period, time.time())
+            delay = deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        elapsed = time.time() - start
+        print("Monitor: %d samples in %.1fs (%.1f/s), %d block reads per sample, %d bursts" %
+              (taken, elapsed, taken / elapsed if elapsed else 0, len(self.blocks), len(self.bursts)))
+        return self
+
+    def __len__(self):
+        return min(self.count, self.history)
+
+    def __slot(self, index):
+        # index 0 is the oldest sample kept, -1 the last one
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return (self.count - len(self) + index) % self.history
+
+    def value(self, name, index=-1):
+        start, register = self.offsets[name]
+        pos = self.__slot(index) * self.row_size + start
+        return struct.unpack_from(_FORMATS[register.size], bytes(self.rows[pos:pos + register.size]))[0]
+
+    def timestamp(self, index=-1):
+        return self.times[self.__slot(index)]
+
+    def series(self, name):
+        """
+        [(timestamp, value)] of a register, oldest first
+        """
+        return [(self.timestamp(i), self.value(name, i)) for i in xrange(len(self))]
+
+    def fields(self, name, index=-1):
+        return self.offsets[name][1].decode(self.value(name, index))
+
+    def changes(self, names=None):
+        """
+        [(timestamp, name, old, new)] whenever a register changes
+        """
+        names = names or [register.name for register in self.registers]
+        result = []
+        for name in names:
+            previous = None
+            for (timestamp, value) in self.series(name):
+                if previous is not None and value != previous:
+                    result.append((timestamp, name, previous, value))
+                previous = value
+        return sorted(result)
+
+    def print_timeline(self, names=None, changes_only=True):
+        if not len(self):
+            print("No samples")
+            return
+        origin = self.timestamp(0)
+        if changes_only:
+            for name in names or [register.name for register in self.registers]:
+                print("%10.6f %-12s %s" % (0, name, self.offsets[name][1].format(self.value(name, 0))))
+            for (timestamp, name, old, new) in self.changes(names):
+                print("%10.6f %-12s %s" % (timestamp - origin, name, self.offsets[name][1].format(new)))
+            return
+        names = names or [register.name for register in self.registers]
+        for i in xrange(len(self)):
+            print("%10.6f %s" % (self.timestamp(i) - origin,
+                                 " ".join("%s=0x%X" % (name, self.value(name, i)) for name in names)))
+
+USBSTS_FIELDS = {"HCH": (0, 1), "HSE": (2, 1), "EINT": (3, 1), "PCD": (4, 1), "CNR": (11, 1), "HCE": (12, 1)}
+PORTSC_FIELDS = {"CCS": (0, 1), "PED": (1, 1), "PR": (4, 1), "PLS": (5, 4), "PP": (9, 1), "SPEED": (10, 4),
+                 "CSC": (17, 1), "PEC": (18, 1), "PRC": (21, 1)}
+
+def xhci_registers(xhci, ports=True, interrupters=(0, )):
+    """
+    Status registers of an XHCI (through its sideband BAR window)
+    """
+    def bar(name, offset, size=4, fields=None):
+        return Register.sideband(name, xhci.port, offset, size, xhci.fid, fields=fields)
+    registers = [bar("USBCMD", 0x80, fields={"RS": (0, 1), "HCRST": (1, 1)}),
+                 bar("USBSTS", 0x84, fields=USBSTS_FIELDS),
+                 bar("CRCR", 0x98, fields={"CRR": (3, 1)})]
+    for interrupter in interrupters:
+        ir = 0x2020 + 0x20 * interrupter
+        registers.append(bar("IMAN%d" % interrupter, ir, fields={"IP": (0, 1), "IE": (1, 1)}))
+        registers.append(bar("ERDP%d" % interrupter, ir + 0x18, 8, fields={"DESI": (0, 3), "EHB": (3, 1)}))
+    if ports:
+        max_ports = getattr(xhci, "max_ports", None) or int(xhci.bar_read32(0x4)) >> 24
+        for port in xrange(max_ports):
+            registers.append(bar("PORTSC%d" % (port + 1), 0x480 + 0x10 * port, fields=PORTSC_FIELDS))
+    return registers
+
+def att_registers(entries=xrange(ATT_ENTRIES)):
+    registers = []
+    for entry in entries:
+        base = ATT_BASE + 0x20 * entry
+        registers += [Register.phys("ATT%d_BASE" % entry, base), Register.phys("ATT%d_SIZE" % entry, base + 4),
+                      Register.phys("ATT%d_CTRL" % entry, base + 0x10, fields={"EN": (0, 1)})]
+    return registers
+
+def monitor_xhci(duration=10, rate=100, xhci=None, triggers=None, **kwargs):
+    """
+    Timeline of the XHCI status, bursting on port and status changes
+    """
+    if xhci is None:
+        xhci = xhci_module.xhci
+    registers = xhci_registers(xhci)
+    if triggers is None:
+        triggers = [Trigger(register.name, None if register.name.startswith("PORTSC") else 0x1D)
+                    for register in registers if register.name == "USBSTS" or register.name.startswith("PORTSC")]
+    monitor = Monitor(registers, rate, triggers=triggers, **kwargs).run(duration)
+    monitor.print_timeline()
+    return monitor
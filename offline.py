@@ -0,0 +1,405 @@
+import os
+import re
+import json
+import mmap
+import time
+import bisect
+import struct
+import binascii
+import utils
+from utils import *
+from proc import *
+from cache import parse_address
+from mmio import HexView, ldt_ranges
+from segments import GDTEntry
+from dumpwriter import read_compressed
+from sparsedump import fabricated_runs
+
+# Registers saved with a dump so the analysis tools can run against it
+SNAPSHOT_REGISTERS = ["eax", "ebx", "ecx", "edx", "esi", "edi", "ebp", "esp", "eip", "eflags",
+                      "cs", "ds", "es", "fs", "gs", "ss", "tr", "ldtr",
+                      "cr0", "cr2", "cr3", "cr4",
+                      "gdtbas", "gdtlim", "idtbas", "idtlim", "ldtbas", "ldtlim"]
+
+REGISTERS_FILE = "registers.json"
+
+# Descriptor tables saved with the registers, mapped at their linear base
+DESCRIPTOR_TABLES = ("gdt", "idt", "ldt")
+
+class DumpHole(Exception):
+    """
+    Read of memory that isn't in any dump
+    """
+
+    def __init__(self, addr, size):
+        Exception.__init__(self, "0x%X-0x%X is not in the dump" % (addr, addr + size))
+        self.addr = addr
+        self.size = size
+
+class AddressTranslator(object):
+    """
+    Resolves ipccli addresses to physical ranges like the CPU would
+
+    Subclasses provide read_phys(addr, size) and register_value(name).
+    """
+
+    def __read_u32(self, addr):
+        return struct.unpack("<I", bytes(self.read_phys(addr, 4)))[0]
+
+    def linear_to_phys(self, linear):
+        if not self.register_value("cr0") & 0x80000000:
+            return linear
+        pde = self.__read_u32((self.register_value("cr3") & ~0xFFF) + (linear >> 22) * 4)
+        if not pde & 1:
+            raise Exception("Linear address 0x%X not mapped" % linear)
+        if pde & 0x80:
+            return (pde & 0xFFC00000) | (linear & 0x3FFFFF)
+        pte = self.__read_u32((pde & ~0xFFF) + ((linear >> 12) & 0x3FF) * 4)
+        if not pte & 1:
+            raise Exception("Linear address 0x%X not mapped" % linear)
+        return (pte & ~0xFFF) | (linear & 0xFFF)
+
+    def read_linear(self, linear, size):
+        data = bytearray()
+        for (phys, length) in self.linear_ranges(linear, size):
+            data += self.read_phys(phys, length)
+        return data
+
+    def segment_base(self, selector):
+        table = self.register_value("ldtbas" if selector & 4 else "gdtbas")
+        data = self.read_linear(table + (selector >> 3) * 8, 8)
+        return GDTEntry(struct.unpack("<Q", bytes(data))[0]).base_value
+
+    def linear_ranges(self, linear, size):
+        """
+        (physical address, size) chunks backing a linear range
+        """
+        ranges = []
+        while size > 0:
+            chunk = min(size, 0x1000 - (linear & 0xFFF))
+            phys = self.linear_to_phys(linear)
+            if ranges and ranges[-1][0] + ranges[-1][1] == phys:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + chunk)
+            else:
+                ranges.append((phys, chunk))
+            linear += chunk
+            size -= chunk
+        return ranges
+
+    def linear_address(self, addr):
+        """
+        (space, address) of an ipccli address, with space "P" or "L"
+        """
+        parsed = parse_address(addr)
+        if parsed is None:
+            raise Exception("Invalid address %r" % (addr, ))
+        space, offset = parsed
+        if space == "P":
+            return ("P", offset)
+        if space.endswith(":"):
+            offset += self.segment_base(int(space[:-1], 16))
+        return ("L", offset & 0xFFFFFFFF)
+
+    def phys_ranges(self, addr, size):
+        space, offset = self.linear_address(addr)
+        if space == "P":
+            return [(offset, size)]
+        return self.linear_ranges(offset, size)
+
+def _bitdata(data):
+    value = int(binascii.hexlify(bytes(data[::-1])), 16) if data else 0
+    return ipccli.BitData(len(data) * 8, value)
+
+def save_registers(pwd, thread=None, names=SNAPSHOT_REGISTERS, tables=True):
+    """
+    Save the registers of a halted thread next to its dumps, along with its
+    GDT/IDT/LDT (as GDT.bin, IDT.bin, LDT.bin) if tables
+    """
+    if thread is None:
+        thread = t
+    registers = {}
+    for name in names:
+        try:
+            value = thread.arch_register(name)
+        except:
+            # Not every register exists on every core
+            continue
+        registers[name] = [value.BitSize, int(value)]
+    try:
+        os.makedirs(pwd)
+    except:
+        pass
+    with open(os.path.join(pwd, REGISTERS_FILE), "w") as f:
+        json.dump({"thread": thread.name, "created": time.time(), "registers": registers}, f,
+                  indent=1, sort_keys=True)
+    for table in DESCRIPTOR_TABLES if tables else ():
+        if table + "bas" in registers and table + "lim" in registers:
+            thread.memsave(os.path.join(pwd, table.upper() + ".bin"), str(registers[table + "bas"][1]) + "L",
+                           registers[table + "lim"][1] + 1)
+    return registers
+
+class DumpImage(AddressTranslator):
+    """
+    Read-only stand-in for a halted thread, backed by dump files
+
+    Every <prefix><hex address>.bin file of the directory (as written by
+    save_mmios) is memory-mapped at its physical address (.bin.gz/.bin.xz
+    ones from DumpWriter are decompressed in memory), LDT-<n>.bin files
+    (dump_ldts) at the linear base of LDT entry n. Registers and descriptor
+    tables come from the snapshot written by save_registers.
+
+    Reads outside the dumps are holes: they raise DumpHole, or return fill
+    bytes when fill is set. Either way they're recorded in holes. The pages
+    a sparse dump (sparsedump.py) wrote without reading them are holes too,
+    listed in fabricated, unless fabricated=True maps them as written.
+    """
+
+    PREFIXES = ("MMIO_", "PCI_", "BAR_")
+
+    def __init__(self, pwd=None, registers=None, name=None, prefixes=PREFIXES, fill=None, fabricated=False):
+        self.name = name
+        self.fill = fill
+        self.registers = {}
+        self.regions = []
+        self.linear_regions = []
+        self.holes = []
+        self.fabricated = []
+        self.reads = 0
+        self.__files = []
+        if pwd is not None:
+            self.load_directory(pwd, prefixes, fabricated)
+            if registers is None and os.path.exists(os.path.join(pwd, REGISTERS_FILE)):
+                registers = os.path.join(pwd, REGISTERS_FILE)
+        if registers is not None:
+            self.load_registers(registers)
+        if pwd is not None:
+            self.load_tables(pwd)
+            self.load_ldts(pwd)
+
+    def close(self):
+        for (f, data) in self.__files:
+            data.close()
+            f.close()
+        self.__files = []
+        self.regions = []
+        self.linear_regions = []
+
+    def __map(self, path):
+        if os.path.getsize(path) == 0:
+            return None
+        f = open(path, "rb")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__files.append((f, data))
+        return data
+
+    def add_region(self, addr, data, source=None, linear=False):
+        regions = self.linear_regions if linear else self.regions
+        bisect.insort(regions, (addr, addr + len(data), source, data))
+
+    def load_directory(self, pwd, prefixes=PREFIXES, fabricated=False):
+        pattern = re.compile(r"^(.*_)([0-9a-fA-F]+)\.bin(\.gz|\.xz)?$")
+        skipped = fabricated_runs(pwd) if not fabricated else {}
+        for filename in sorted(os.listdir(pwd)):
+            match = pattern.match(filename)
+            if match is None or not match.group(1).startswith(tuple(prefixes)):
+                continue
+            if match.group(3):
+                # Compressed DumpWriter output, kept in memory
+                data = read_compressed(os.path.join(pwd, filename)) or None
+            else:
+                data = self.__map(os.path.join(pwd, filename))
+            if data is None:
+                continue
+            addr = int(match.group(2), 16)
+            runs = skipped.get(filename)
+            if not runs:
+                self.add_region(addr, data, filename)
+                continue
+            # Only what the sparse dump read, around its fill runs
+            offset = 0
+            for (start, size) in runs + [(len(data), 0)]:
+                if start > offset:
+                    self.add_region(addr + offset, buffer(data, offset, start - offset), filename)
+                offset = max(offset, start + size)
+            self.fabricated.extend((addr + start, size, filename) for (start, size) in runs)
+
+    def load_registers(self, filename):
+        if isinstance(filename, dict):
+            snapshot = {"registers": filename}
+        else:
+            with open(filename, "r") as f:
+                snapshot = json.load(f)
+        if self.name is None:
+            self.name = snapshot.get("thread")
+        for (name, value) in snapshot["registers"].items():
+            if isinstance(value, list):
+                self.registers[str(name)] = (value[0], value[1])
+            else:
+                self.registers[str(name)] = (16 if name in ("cs", "ds", "es", "fs", "gs", "ss") else 32, value)
+
+    def load_tables(self, pwd):
+        for table in DESCRIPTOR_TABLES:
+            path = os.path.join(pwd, table.upper() + ".bin")
+            if table + "bas" in self.registers and os.path.exists(path):
+                data = self.__map(path)
+                if data is not None:
+                    self.add_region(self.register_value(table + "bas"), data, table.upper() + ".bin", linear=True)
+
+    def load_ldts(self, pwd):
+        pattern = re.compile(r"^LDT-(\d+)\.bin$")
+        files = [(int(m.group(1)), f) for (m, f) in
+                 [(pattern.match(f), f) for f in os.listdir(pwd)] if m is not None]
+        if not files:
+            return
+        # Segment bases come from the dumped LDT itself, or the known CSE layout
+        bases = {}
+        holes, fill, self.fill = len(self.holes), self.fill, None
+        try:
+            data = self.read_linear(self.register_value("ldtbas"), ((self.register_value("ldtlim") + 1) // 8) * 8)
+            bases = dict((i, entry.base_value) for (i, entry) in enumerate(GDTEntry.table(data))
+                         if entry.present_value)
+        except Exception:
+            pass
+        finally:
+            self.fill = fill
+            del self.holes[holes:]
+        if not bases:
+            bases = dict((i, base) for (i, (base, size)) in enumerate(ldt_ranges))
+        for (idx, filename) in sorted(files):
+            data = self.__map(os.path.join(pwd, filename))
+            if data is not None and idx in bases:
+                self.add_region(bases[idx], data, filename, linear=True)
+
+    def register_value(self, name):
+        return self.registers.get(name, (32, 0))[1]
+
+    def coverage(self):
+        """
+        Merged physical (start, end) ranges present in the image
+        """
+        ranges = []
+        for (start, end, source, data) in self.regions:
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def __find(self, regions, addr):
+        # Regions can overlap (e.g. MMIOS lists some ranges twice)
+        idx = bisect.bisect_right(regions, (addr, float("inf"))) - 1
+        while idx >= 0:
+            if regions[idx][0] <= addr < regions[idx][1]:
+                return regions[idx]
+            idx -= 1
+        return None
+
+    def __next_start(self, regions, addr):
+        idx = bisect.bisect_right(regions, (addr, float("inf")))
+        return regions[idx][0] if idx < len(regions) else None
+
+    def __read_regions(self, regions, addr, size, hole):
+        data = bytearray()
+        end = addr + size
+        while addr < end:
+            region = self.__find(regions, addr)
+            if region is not None:
+                chunk_end = min(end, region[1])
+                data += region[3][addr - region[0]:chunk_end - region[0]]
+            else:
+                following = self.__next_start(regions, addr)
+                chunk_end = min(end, following) if following is not None else end
+                data += hole(addr, chunk_end - addr)
+            addr = chunk_end
+        return data
+
+    def __hole(self, addr, size):
+        self.holes.append((addr, size))
+        if self.fill is None:
+            raise DumpHole(addr, size)
+        return bytearray([self.fill]) * size
+
+    def read_phys(self, addr, size):
+        return self.__read_regions(self.regions, addr, size, self.__hole)
+
+    def read_linear(self, linear, size):
+        # Dumped tables and segments first, page tables for the rest
+        return self.__read_regions(self.linear_regions, linear, size,
+                                   lambda linear, size: AddressTranslator.read_linear(self, linear, size))
+
+    def read(self, addr, size):
+        self.reads += 1
+        space, offset = self.linear_address(addr)
+        if space == "P":
+            return self.read_phys(offset, size)
+        return self.read_linear(offset, size)
+
+    def print_holes(self):
+        merged = []
+        for (addr, size) in sorted(self.holes):
+            if merged and addr <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], addr + size))
+            else:
+                merged.append((addr, addr + size))
+        for (start, end) in merged:
+            print("Hole: 0x%X-0x%X (%d bytes)" % (start, end, end - start))
+        return merged
+
+    # Thread API
+
+    def memblock(self, addr, length, width, *args):
+        if args:
+            raise Exception("Dump images are read-only")
+        size = int(length) * (int(width) if int(width) > 1 else 1)
+        return _bitdata(self.read(addr, size))
+
+    def mem(self, addr, size, value=None):
+        if value is not None:
+            raise Exception("Dump images are read-only")
+        return _bitdata(self.read(addr, size))
+
+    def memdump(self, addr, size, width=1):
+        parsed = parse_address(addr)
+        for line in HexView(self.read(addr, int(size)), parsed[1] if parsed else 0):
+            print(line)
+
+    def memsave(self, filename, addr, size, *args):
+        with open(filename, "wb") as f:
+            f.write(self.read(addr, int(size)))
+
+    def arch_register(self, name, value=None):
+        if value is not None:
+            raise Exception("Dump images are read-only")
+        if name not in self.registers:
+            raise Exception("Register %s is not in the snapshot" % name)
+        return ipccli.BitData(*self.registers[name])
+
+    def ishalted(self):
+        return True
+
+    def isrunning(self):
+        return False
+
+    def halt(self):
+        pass
+
+    def go(self, *args):
+        raise Exception("Can't run a dump image")
+
+    step = go
+
+    def asm(self, *args):
+        raise Exception("No disassembler for dump images")
+
+def open_dump(pwd=None, registers=None, fill=None):
+    """
+    Point the library at a dump directory, returns (image, previous thread)
+    """
+    image = DumpImage(pwd if pwd is not None else utils.pwd, registers, fill=fill)
+    return (image, set_thread(image))
+
+def close_dump(image, previous):
+    set_thread(previous)
+    image.close()
+    if image.holes:
+        print("%d reads hit holes in the dump" % len(image.holes))
@@ -0,0 +1,161 @@
+import time
+import bisect
+import random
+import struct
+from utils import *
+from proc import *
+import dispatch
+
+# proc_addresses entries that are code, the others are MMIO, ports and data
+FUNCTION_SYMBOLS = ("RESET_ME_CALL", "BUP_ENTRY", "SYSLIB:MALLOC", "SYSLIB:MALIGN")
+
+def symbol_table(thread, extra=None, functions=FUNCTION_SYMBOLS):
+    """
+    Sorted (address, name) list of the functions proc_addresses knows on a
+    thread, plus the extra {address: name}
+    """
+    symbols = {}
+    for name in functions:
+        addr = proc_addresses.get(name, {}).get(thread.name)
+        if isinstance(addr, (int, long)):
+            symbols[addr] = name
+    if extra:
+        symbols.update(extra)
+    return sorted(symbols.items())
+
+def symbolize(symbols, addr, offset=True):
+    idx = bisect.bisect_right(symbols, (addr, "\xff")) - 1
+    if idx < 0:
+        return "0x%X" % addr
+    (base, name) = symbols[idx]
+    if addr == base:
+        return name
+    return "%s+0x%X" % (name, addr - base) if offset else name
+
+class Profiler(object):
+    """
+    Statistical sampling profiler for the code running on a thread
+
+    Every sample halts the thread, reads cs/eip/ebp (and depth frames of the
+    ebp chain, one 8 byte read per frame) and resumes it, all as a single
+    queued request when a dispatcher runs. The delay between samples is
+    stretched so the thread never spends more than max_intrusion of the
+    wall time halted.
+    """
+
+    def __init__(self, thread=None, rate=20, max_intrusion=0.05, depth=0, symbols=None):
+        self.thread = thread if thread is not None else t
+        self.rate = rate
+        self.max_intrusion = max_intrusion
+        self.depth = depth
+        self.symbols = symbol_table(self.thread, symbols)
+        self.samples = []
+        self.halted_time = 0.0
+        self.wall_time = 0.0
+        self.failed = 0
+
+    def __halt(self):
+        try:
+            self.thread.halt()
+        except:
+            # It could timeout for no good reason
+            pass
+
+    def __frames(self, ss, ebp):
+        frames = []
+        for i in xrange(self.depth):
+            if ebp == 0:
+                break
+            try:
+                raw = self.thread.memblock("0x%X:0x%X" % (ss, ebp), 8, 1).ToRawBytes()
+            except:
+                break
+            ebp, ret = struct.unpack("<II", bytearray(raw))
+            frames.append(ret)
+        return tuple(frames)
+
+    def __take(self):
+        self.__halt()
+        try:
+            cs = self.thread.arch_register("cs").ToUInt32()
+            eip = self.thread.arch_register("eip").ToUInt32()
+            frames = ()
+            if self.depth:
+                ss = self.thread.arch_register("ss").ToUInt32()
+                ebp = self.thread.arch_register("ebp").ToUInt32()
+                frames = self.__frames(ss, ebp)
+            return (cs, eip, frames)
+        finally:
+            self.thread.go()
+
+    def sample(self):
+        start = time.time()
+        try:
+            dispatcher = dispatch.get_dispatcher()
+            if dispatcher is not None:
+                # Back to back on the link, nothing queued in between
+                sample = dispatcher.submit_call(self.__take, priority=dispatch.PRIORITY_INTERACTIVE).result()
+            else:
+                sample = self.__take()
+            self.samples.append(sample)
+        except:
+            self.failed += 1
+        duration = time.time() - start
+        self.halted_time += duration
+        return duration
+
+    def run(self, duration=10, count=None):
+        if self.thread.ishalted():
+            self.thread.go()
+        start = time.time()
+        taken = 0
+        while time.time() - start < duration and (count is None or taken < count):
+            halted = self.sample()
+            taken += 1
+            delay = max(1.0 / self.rate, halted / self.max_intrusion) - halted
+            # Jitter the period so we don't alias with periodic firmware work
+            time.sleep(max(0, delay * random.uniform(0.9, 1.1)))
+        self.wall_time += time.time() - start
+        print("Profiler: %d samples in %.1fs, target halted %.1f%% of the time" %
+              (taken, time.time() - start, self.intrusion() * 100))
+        return self
+
+    def intrusion(self):
+        return self.halted_time / self.wall_time if self.wall_time else 0.0
+
+    def histogram(self, functions=True):
+        counts = {}
+        for (cs, eip, frames) in self.samples:
+            key = symbolize(self.symbols, eip, offset=not functions)
+            counts[key] = counts.get(key, 0) + 1
+        return sorted(counts.items(), key=lambda item: -item[1])
+
+    def print_report(self, top=20, functions=True):
+        total = len(self.samples)
+        if total == 0:
+            print("No samples")
+            return
+        for (name, count) in self.histogram(functions)[:top]:
+            print("%6.2f%% %6d  %s" % (count * 100.0 / total, count, name))
+
+    def folded(self):
+        """
+        Stacks in the folded format used by flamegraph.pl, outermost first
+        """
+        stacks = {}
+        for (cs, eip, frames) in self.samples:
+            chain = [symbolize(self.symbols, addr, offset=False) for addr in reversed(frames)]
+            chain.append(symbolize(self.symbols, eip, offset=False))
+            key = ";".join(chain)
+            stacks[key] = stacks.get(key, 0) + 1
+        return ["%s %d" % (stack, count) for (stack, count) in sorted(stacks.items())]
+
+    def save_folded(self, filename):
+        with open(filename, "w") as f:
+            for line in self.folded():
+                f.write(line + "\n")
+
+def profile(duration=10, rate=20, depth=0, max_intrusion=0.05, thread=None):
+    profiler = Profiler(thread, rate, max_intrusion, depth).run(duration)
+    profiler.print_report()
+    return profiler
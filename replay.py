@@ -0,0 +1,416 @@
+import gzip
+import json
+import time
+import struct
+import binascii
+from utils import *
+from dcitrace import TRACED_OPS
+
+# Session trace format:
+#   "IPCR" | u16 version | u32 header length | JSON header
+#   then one encoded record per operation: [op, args, kwargs, result, error, duration]
+#
+# Values are tagged: N None, T/F bool, I int, B BitData, S str, U unicode,
+# L list, P tuple, D dict, O object (its attributes and str()), R float.
+# Integers are u8 sign | u32 length | little endian magnitude, BitData the
+# same after its u32 bit size.
+
+TRACE_MAGIC = "IPCR"
+TRACE_VERSION = 2
+
+# Methods under ipc.stateport recorded next to the thread's operations, as
+# their path from ipc (e.g. "stateport.spt_tpsb0.sbreg"). ipc.resettarget()
+# is recorded as "resettarget".
+STATEPORT_OPS = ("sbreg", )
+
+class ReplayDivergence(Exception):
+    pass
+
+class ReplayedObject(object):
+    """
+    Stand-in for objects returned by ipccli (e.g. asm() lines)
+    """
+
+    def __init__(self, text, attributes):
+        self.__text = text
+        self.__dict__.update(attributes)
+
+    def __str__(self):
+        return self.__text
+
+    __repr__ = __str__
+
+def _open(filename, mode):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+def _encode_int(out, value):
+    sign = 1 if value < 0 else 0
+    value = -value if sign else value
+    digits = "%x" % value if value else ""
+    raw = binascii.unhexlify("0" * (len(digits) & 1) + digits)[::-1]
+    out.append(struct.pack("<BI", sign, len(raw)) + raw)
+
+def encode(value, out):
+    if value is None:
+        out.append("N")
+    elif value is True or value is False:
+        out.append("T" if value else "F")
+    elif isinstance(value, (int, long)):
+        out.append("I")
+        _encode_int(out, value)
+    elif isinstance(value, float):
+        out.append("R" + struct.pack("<d", value))
+    elif isinstance(value, ipccli.BitData):
+        out.append("B" + struct.pack("<I", value.BitSize))
+        _encode_int(out, int(value) if value.BitSize else 0)
+    elif isinstance(value, str):
+        out.append("S" + struct.pack("<I", len(value)) + value)
+    elif isinstance(value, unicode):
+        value = value.encode("utf-8")
+        out.append("U" + struct.pack("<I", len(value)) + value)
+    elif isinstance(value, (list, tuple)):
+        out.append(("L" if isinstance(value, list) else "P") + struct.pack("<I", len(value)))
+        for item in value:
+            encode(item, out)
+    elif isinstance(value, dict):
+        out.append("D" + struct.pack("<I", len(value)))
+        for (key, item) in sorted(value.items()):
+            encode(key, out)
+            encode(item, out)
+    else:
+        attributes = dict((k, v) for (k, v) in getattr(value, "__dict__", {}).items()
+                          if not k.startswith("_") and isinstance(v, (int, long, str, float, ipccli.BitData)))
+        out.append("O")
+        encode(str(value), out)
+        encode(attributes, out)
+
+def encode_record(record):
+    out = []
+    encode(record, out)
+    data = "".join(out)
+    return struct.pack("<I", len(data)) + data
+
+class _Decoder(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def take(self, size):
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return chunk
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def integer(self):
+        sign, length = self.unpack("<BI")
+        raw = self.take(length)
+        value = int(binascii.hexlify(raw[::-1]), 16) if raw else 0
+        return -value if sign else value
+
+    def value(self):
+        tag = self.take(1)
+        if tag == "N":
+            return None
+        if tag == "T":
+            return True
+        if tag == "F":
+            return False
+        if tag == "I":
+            return self.integer()
+        if tag == "R":
+            return self.unpack("<d")[0]
+        if tag == "B":
+            size = self.unpack("<I")[0]
+            return ipccli.BitData(size, self.integer())
+        if tag in "SU":
+            size = self.unpack("<I")[0]
+            text = self.take(size)
+            return text.decode("utf-8") if tag == "U" else text
+        if tag in "LP":
+            items = [self.value() for i in xrange(self.unpack("<I")[0])]
+            return items if tag == "L" else tuple(items)
+        if tag == "D":
+            result = {}
+            for i in xrange(self.unpack("<I")[0]):
+                key = self.value()
+                result[key] = self.value()
+            return result
+        if tag == "O":
+            text = self.value()
+            return ReplayedObject(text, self.value())
+        raise ValueError("Corrupted session trace (tag %r)" % tag)
+
+def read_trace(filename):
+    """
+    Return (header, records) of a recorded session
+    """
+    with _open(filename, "rb") as f:
+        data = f.read()
+    if data[:4] != TRACE_MAGIC:
+        raise ValueError("%s is not a session trace" % filename)
+    version, length = struct.unpack_from("<HI", data, 4)
+    if version != TRACE_VERSION:
+        raise ValueError("%s is a version %d session trace, expected %d" % (filename, version, TRACE_VERSION))
+    header = json.loads(data[10:10 + length])
+    records = []
+    pos = 10 + length
+    while pos + 4 <= len(data):
+        size = struct.unpack_from("<I", data, pos)[0]
+        records.append(_Decoder(data[pos + 4:pos + 4 + size]).value())
+        pos += 4 + size
+    return (header, records)
+
+class RecordingThread(ThreadProxy):
+    """
+    Logs every link operation and its result into a session trace
+    """
+
+    def __init__(self, thread, filename):
+        ThreadProxy.__init__(self, thread)
+        self._file = _open(filename, "wb")
+        header = json.dumps({"thread": getattr(thread, "name", None), "created": time.time()})
+        self._file.write(TRACE_MAGIC + struct.pack("<HI", TRACE_VERSION, len(header)) + header)
+        self._count = 0
+
+        self._ipc = None
+        self._stateport = None
+        self._resettarget = None
+
+    def call(self, op, func, args, kwargs):
+        start = time.time()
+        result = error = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self._file.write(encode_record([op, list(args), kwargs, result, error,
+                                            time.time() - start]))
+            self._count += 1
+
+    def __getattr__(self, name):
+        attr = getattr(self._thread, name)
+        if name not in TRACED_OPS:
+            return attr
+        def recorded(*args, **kwargs):
+            return self.call(name, attr, args, kwargs)
+        return recorded
+
+    def install_ipc(self, ipc_obj):
+        """
+        Also record the ipc.stateport sbreg accesses and ipc.resettarget()
+        """
+        self._ipc = ipc_obj
+        if hasattr(ipc_obj, "stateport"):
+            self._stateport = ipc_obj.stateport
+            ipc_obj.stateport = RecordingDevice(self._stateport, self, "stateport")
+        if hasattr(ipc_obj, "resettarget"):
+            # Shadowed on the instance, uninstall_ipc() uncovers the method again
+            self._resettarget = getattr(ipc_obj, "__dict__", {}).get("resettarget")
+            resettarget = ipc_obj.resettarget
+            ipc_obj.resettarget = lambda *args, **kwargs: self.call("resettarget", resettarget, args, kwargs)
+
+    def uninstall_ipc(self):
+        if self._ipc is None:
+            return
+        if self._stateport is not None:
+            self._ipc.stateport = self._stateport
+            self._stateport = None
+        if self._resettarget is not None:
+            self._ipc.resettarget = self._resettarget
+        elif "resettarget" in getattr(self._ipc, "__dict__", {}):
+            del self._ipc.resettarget
+        self._resettarget = None
+        self._ipc = None
+
+    def close(self):
+        self._file.close()
+
+class RecordingDevice(object):
+    """
+    Records the STATEPORT_OPS of an object and of the objects hanging off
+    it, under their path
+    """
+
+    def __init__(self, obj, recorder, path):
+        self._obj = obj
+        self._recorder = recorder
+        self._path = path
+
+    def __dir__(self):
+        return dir(self._obj)
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        path = self._path + "." + name
+        if name in STATEPORT_OPS and callable(attr):
+            recorder = self._recorder
+            def recorded(*args, **kwargs):
+                return recorder.call(path, attr, args, kwargs)
+            return recorded
+        if not callable(attr) and not isinstance(attr, (int, long, str, float)) and not name.startswith("_"):
+            return RecordingDevice(attr, self._recorder, path)
+        return attr
+
+class LatencyModel(object):
+    """
+    Simulated link cost of an operation : per_op + per_byte * size
+    """
+
+    def __init__(self, per_op=0.002, per_byte=0.0):
+        self.per_op = per_op
+        self.per_byte = per_byte
+
+    def delay(self, op, args, recorded):
+        size = 0
+        if op in ("mem", "memblock", "memdump") and len(args) > 1 and isinstance(args[1], (int, long)):
+            size = args[1]
+        return self.per_op + self.per_byte * size
+
+class RecordedLatency(object):
+    """
+    Replays the latency measured while recording, scaled by factor
+    """
+
+    def __init__(self, factor=1.0):
+        self.factor = factor
+
+    def delay(self, op, args, recorded):
+        return recorded * self.factor
+
+class ReplayThread(object):
+    """
+    Serves a recorded session in place of a live thread
+
+    Each operation must match the next recorded one (same name and
+    arguments). A mismatch raises ReplayDivergence if strict, otherwise it
+    is logged in divergences and the recorded result of the same operation
+    is returned anyway.
+    """
+
+    def __init__(self, filename, latency=None, strict=True):
+        self.header, self.records = read_trace(filename)
+        self.name = self.header.get("thread")
+        self.latency = latency
+        self.strict = strict
+        self.position = 0
+        self.divergences = []
+        self.transactions = 0
+        self.bytes = 0
+
+    def __compare(self, op, args, kwargs):
+        if self.position >= len(self.records):
+            raise ReplayDivergence("Session trace exhausted at %s%r" % (op, tuple(args)))
+        record = self.records[self.position]
+        expected = encode_record([record[0], record[1], record[2]])
+        issued = encode_record([op, list(args), kwargs])
+        if expected != issued:
+            message = "Operation %d: expected %s%r, got %s%r" % (self.position, record[0],
+                                                              tuple(record[1]), op, tuple(args))
+            if self.strict or record[0] != op:
+                raise ReplayDivergence(message)
+            self.divergences.append(message)
+        return record
+
+    def replay(self, op, args, kwargs):
+        record = self.__compare(op, args, kwargs)
+        self.position += 1
+        self.transactions += 1
+        result, error, duration = record[3], record[4], record[5]
+        if isinstance(result, ipccli.BitData):
+            self.bytes += result.BitSize // 8
+        if self.latency is not None:
+            time.sleep(self.latency.delay(op, args, duration))
+        if error is not None:
+            raise Exception(error)
+        return result
+
+    def remaining(self):
+        return len(self.records) - self.position
+
+    def __getattr__(self, name):
+        if name not in TRACED_OPS:
+            raise AttributeError(name)
+        def replayed(*args, **kwargs):
+            return self.replay(name, args, kwargs)
+        return replayed
+
+class ReplayDevice(object):
+    """
+    Serves the recorded ipc.stateport accesses below path
+    """
+
+    def __init__(self, player, path):
+        self._player = player
+        self._path = path
+
+    def __dir__(self):
+        # Whatever the recorded operations went through (find_tpsb looks here)
+        prefix = self._path + "."
+        return sorted(set(record[0][len(prefix):].split(".")[0] for record in self._player.records
+                          if record[0].startswith(prefix)))
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        path = self._path + "." + name
+        if name in STATEPORT_OPS:
+            player = self._player
+            def replayed(*args, **kwargs):
+                return player.replay(path, args, kwargs)
+            return replayed
+        return ReplayDevice(self._player, path)
+
+class ReplayIPC(object):
+    """
+    Stands in for ipc during a replay, stateport and resettarget() come
+    from the trace and anything else from the live ipc, if there is one
+    """
+
+    BitData = ipccli.BitData
+
+    def __init__(self, player, live=None):
+        self._player = player
+        self._live = live
+        self.threads = [player]
+        self.stateport = ReplayDevice(player, "stateport")
+
+    def resettarget(self, *args, **kwargs):
+        return self._player.replay("resettarget", args, kwargs)
+
+    def __getattr__(self, name):
+        if self._live is None or name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._live, name)
+
+def start_recording(filename, thread=None):
+    recorder = RecordingThread(thread if thread is not None else t, filename)
+    if ipc is not None:
+        recorder.install_ipc(ipc)
+    set_thread(recorder)
+    return recorder
+
+def stop_recording(recorder):
+    set_thread(recorder._thread)
+    recorder.uninstall_ipc()
+    recorder.close()
+    print("Recorded %d operations" % recorder._count)
+
+def start_replay(filename, latency=None, strict=True):
+    player = ReplayThread(filename, latency, strict)
+    previous = (set_thread(player), set_ipc(ReplayIPC(player, ipc)))
+    return (player, previous)
+
+def stop_replay(player, previous):
+    set_thread(previous[0])
+    set_ipc(previous[1])
+    print("Replayed %d operations (%d bytes), %d left, %d divergences" %
+          (player.transactions, player.bytes, player.remaining(), len(player.divergences)))
@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from utils import *
+from proc import *
+from mmio import Sideband, value_is_interesting
+
+# Results of a sweep are kept in a SQLite database so a sweep interrupted by a
+# locked sideband (and the ipc.resettarget() that follows) can be resumed where
+# it stopped. Every probe is recorded with one of these states.
+PROBE_EMPTY = "empty"
+PROBE_INTERESTING = "interesting"
+PROBE_LOCKED = "locked"
+PROBE_TIMEOUT = "timeout"
+
+class SweepStore(object):
+    """
+    Sideband sweep results database
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS probes ("
+                        "grp INTEGER, port INTEGER, fid INTEGER, rs INTEGER, "
+                        "status TEXT, value TEXT, time REAL, "
+                        "PRIMARY KEY (grp, port, fid, rs))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS broken_ports ("
+                        "port INTEGER PRIMARY KEY, reason TEXT, time REAL)")
+        self.db.commit()
+
+    def done(self):
+        with self.lock:
+            return set(self.db.execute("SELECT grp, port, fid, rs FROM probes"))
+
+    def record(self, key, status, value=None):
+        group, port, fid, rs = key
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (group, port, fid, rs, status,
+                             value.ToHex() if value is not None else None, time.time()))
+
+    def mark_broken(self, port, reason):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO broken_ports VALUES (?, ?, ?)",
+                            (port, reason, time.time()))
+            self.db.commit()
+
+    def broken_ports(self):
+        with self.lock:
+            return set(row[0] for row in self.db.execute("SELECT port FROM broken_ports"))
+
+    def empty_devices(self):
+        """
+        (group, port, device, rs) whose function 0 probed empty
+        """
+        with self.lock:
+            return set((group, port, fid >> 3, rs) for (group, port, fid, rs) in
+                       self.db.execute("SELECT grp, port, fid, rs FROM probes WHERE status = ? AND fid & 7 = 0",
+                                       (PROBE_EMPTY, )))
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def results(self, status=PROBE_INTERESTING):
+        with self.lock:
+            return list(self.db.execute("SELECT grp, port, fid, rs, value FROM probes "
+                                        "WHERE status = ? ORDER BY grp, port, fid, rs",
+                                        (status, )))
+
+    def export_jsonl(self, filename):
+        with self.lock:
+            rows = list(self.db.execute("SELECT grp, port, fid, rs, status, value, time FROM probes"))
+        with open(filename, "w") as f:
+            for (group, port, fid, rs, status, value, ts) in rows:
+                f.write(json.dumps({"group": group, "port": port, "fid": fid, "rs": rs,
+                                    "status": status, "value": value, "time": ts}) + "\n")
+
+class SweepPlan(object):
+    """
+    The (group, port, fid, rs) space to probe
+    """
+
+    def __init__(self, groups, ports=xrange(0, 0x100), fids=(0, ), rs=(1, )):
+        self.groups = list(groups)
+        self.ports = list(ports)
+        self.fids = list(fids)
+        self.rs = list(rs)
+
+    def __len__(self):
+        return len(self.groups) * len(self.ports) * len(self.fids) * len(self.rs)
+
+    def __iter__(self):
+        # Port is the outer loop so learning that a port is broken skips the
+        # rest of its probes.
+        for port in self.ports:
+            for group in self.groups:
+                for fid in self.fids:
+                    for rs in self.rs:
+                        yield (group, port, fid, rs)
+
+    @staticmethod
+    def bar(pstart=0, pend=0x100, rs=1):
+        group = (Sideband.BAR_WRITE_GROUP << 8) + Sideband.BAR_READ_GROUP
+        return SweepPlan([group], xrange(pstart, pend), (0, ), (rs, ))
+
+    @staticmethod
+    def pci(pstart=0, pend=0x100, dstart=0, dend=32, fstart=0, fend=8, rs=1):
+        group = (Sideband.PCI_WRITE_GROUP << 8) + Sideband.PCI_READ_GROUP
+        fids = [(dev << 3) + func for dev in xrange(dstart, dend) for func in xrange(fstart, fend)]
+        return SweepPlan([group], xrange(pstart, pend), fids, (rs, ))
+
+class SidebandSweep(object):
+    """
+    Resumable sideband bruteforce
+
+    One worker is started per target thread. Threads that share the same
+    SB_CHANNEL register are serialized on it, so probes only truly overlap
+    when the threads own different sideband channels; result bookkeeping
+    always runs outside of the link lock.
+
+    A target reset waits for the probes in flight and holds the others
+    until reset_delay is over. Probes that fail while a reset happens are
+    not held against their port and are tried again.
+    """
+
+    def __init__(self, store, threads=None, size=0x10, max_failures=2,
+                 reset=None, reset_delay=5, skip_empty_functions=True, checkpoint=64):
+        if not isinstance(store, SweepStore):
+            store = SweepStore(store)
+        self.store = store
+        self.threads = threads if threads is not None else [t]
+        self.size = size
+        self.max_failures = max_failures
+        self.reset = reset if reset is not None else (lambda: ipc.resettarget())
+        self.reset_delay = reset_delay
+        self.skip_empty_functions = skip_empty_functions
+        self.checkpoint = checkpoint
+        self.failures = {}
+        self.broken_ports = set(store.broken_ports())
+        self.empty_devices = store.empty_devices() if skip_empty_functions else set()
+        self.probed = 0
+        self.errors = []
+        self.__state = threading.Lock()
+        self.__channel_locks = {}
+        # Probes in flight and resets, see __begin_probe/__reset_target
+        self.__reset_condition = threading.Condition()
+        self.__active = 0
+        self.__resetting = False
+        self.__generation = 0
+
+    def __sideband(self, thread):
+        sb = Sideband(thread)
+        self.broken_ports.update(sb.broken_ports)
+        lock = self.__channel_locks.setdefault(sb.base_addr, threading.Lock())
+        return (sb, lock)
+
+    def __skip(self, key):
+        group, port, fid, rs = key
+        if port in self.broken_ports:
+            return True
+        # Like bruteforce_port_pci: once a function of a device is empty, the
+        # higher functions of that device are not probed.
+        return (group, port, fid >> 3, rs) in self.empty_devices
+
+    def __ensure_halted(self, thread):
+        if thread.ishalted():
+            return
+        try:
+            thread.halt()
+        except:
+            # It could timeout for no good reason
+            pass
+
+    def __begin_probe(self):
+        with self.__reset_condition:
+            while self.__resetting:
+                self.__reset_condition.wait()
+            self.__active += 1
+            return self.__generation
+
+    def __end_probe(self):
+        with self.__reset_condition:
+            self.__active -= 1
+            self.__reset_condition.notify_all()
+
+    def __reset_target(self, generation):
+        with self.__reset_condition:
+            if self.__generation != generation or self.__resetting:
+                # Already reset since that probe started
+                return
+            self.__resetting = True
+            while self.__active:
+                self.__reset_condition.wait()
+        try:
+            self.reset()
+            time.sleep(self.reset_delay)
+        finally:
+            with self.__reset_condition:
+                self.__resetting = False
+                self.__generation += 1
+                self.__reset_condition.notify_all()
+
+    def __excused(self, generation):
+        # A reset started or happened while the probe ran
+        with self.__reset_condition:
+            return self.__resetting or self.__generation != generation
+
+    def __failure(self, key, status, generation):
+        group, port, fid, rs = key
+        with self.__state:
+            self.failures[port] = self.failures.get(port, 0) + 1
+            learned = self.failures[port] >= self.max_failures and port not in self.broken_ports
+            if learned:
+                self.broken_ports.add(port)
+        if learned:
+            print("Port %s marked as broken (%s)" % (hex(port), status))
+            self.store.mark_broken(port, status)
+        self.__reset_target(generation)
+
+    def probe(self, thread, sb, lock, key):
+        """
+        Probe status, None when it failed because of a reset
+        """
+        group, port, fid, rs = key
+        generation = self.__begin_probe()
+        failed = None
+        try:
+            with lock:
+                self.__ensure_halted(thread)
+                value, locked = sb.probe(group, port, self.size, rs, fid)
+            if locked:
+                failed = PROBE_LOCKED
+        except Exception as e:
+            (failed, value) = (PROBE_TIMEOUT, None)
+        finally:
+            self.__end_probe()
+        if failed is not None:
+            if self.__excused(generation):
+                return None
+            self.store.record(key, failed, value)
+            self.__failure(key, failed, generation)
+            return failed
+        if value_is_interesting(value):
+            print("Group: %s. Port %s. Fid: %s" % (hex(group), hex(port), hex(fid)))
+            print("Value: %s" % hex(value))
+            self.store.record(key, PROBE_INTERESTING, value)
+            return PROBE_INTERESTING
+        self.store.record(key, PROBE_EMPTY, value)
+        if self.skip_empty_functions and fid & 7 == 0:
+            with self.__state:
+                self.empty_devices.add((group, port, fid >> 3, rs))
+        return PROBE_EMPTY
+
+    def __sweep(self, thread, sb, lock, key):
+        if self.__skip(key):
+            return
+        # Failed probes are tried again until the port is found broken
+        for attempt in xrange(self.max_failures + 2):
+            if self.probe(thread, sb, lock, key) in (PROBE_EMPTY, PROBE_INTERESTING) or self.__skip(key):
+                break
+        with self.__state:
+            self.probed += 1
+            probed = self.probed
+        if probed % self.checkpoint == 0:
+            self.store.commit()
+            print("Sweep: %d probes done" % probed)
+
+    def __worker(self, thread, work):
+        sideband = None
+        while True:
+            key = work.get()
+            if key is None:
+                break
+            try:
+                if sideband is None:
+                    sideband = self.__sideband(thread)
+                self.__sweep(thread, sideband[0], sideband[1], key)
+            except Exception as e:
+                # Keep draining so run() never blocks on the queue, the key
+                # isn't recorded and a resumed sweep probes it again
+                with self.__state:
+                    self.errors.append((key, e))
+                print("Sweep: %s failed: %s" % (", ".join(hex(field) for field in key), e))
+
+    def run(self, plan):
+        done = self.store.done()
+        work = queue.Queue(maxsize=len(self.threads) * 4)
+        workers = []
+        for thread in self.threads:
+            worker = threading.Thread(target=self.__worker, args=(thread, work))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        start = time.time()
+        try:
+            for key in plan:
+                if key not in done:
+                    work.put(key)
+        finally:
+            for worker in workers:
+                work.put(None)
+            for worker in workers:
+                worker.join()
+            self.store.commit()
+        print("Sweep finished: %d probes in %.1fs, %d broken ports" %
+              (self.probed, time.time() - start, len(self.broken_ports)))
+        if self.errors:
+            print("Sweep: %d probes failed, run it again to retry them" % len(self.errors))
+        return self.store.results()
+
+def sweep_sideband(store, plan=None, threads=None, **kwargs):
+    if plan is None:
+        plan = SweepPlan.bar()
+    return SidebandSweep(store, threads, **kwargs).run(plan)
@@ -0,0 +1,179 @@
+import sys
+import time
+import threading
+from collections import deque
+from utils import *
+from dispatch import Request
+
+class HaltWindowThread(ThreadProxy):
+    """
+    Thread stand-in while a HaltScheduler runs
+
+    halt() inside a halt window and ishalted()/isrunning() while the state
+    is known are answered without going over the link, and go() from an
+    operation queued as halted is put off until the window ends, so
+    operations that halt and resume the thread themselves (print_registers,
+    dump_sideband_channel...) stay inside the window. Operations queued
+    with resumes=True really resume it, after which the state is asked
+    again as the thread can stop by itself (breakpoints).
+    """
+
+    def __init__(self, scheduler):
+        ThreadProxy.__init__(self, scheduler.thread)
+        self._scheduler = scheduler
+
+    def halt(self, *args, **kwargs):
+        return self._scheduler.halt()
+
+    def go(self, *args, **kwargs):
+        request = self._scheduler.current
+        if request is not None and request.halted and not request.resumes:
+            return None
+        return self._scheduler.go(*args, **kwargs)
+
+    def ishalted(self):
+        return self._scheduler.ishalted()
+
+    def isrunning(self):
+        return not self._scheduler.ishalted()
+
+class HaltScheduler(object):
+    """
+    Runs queued operations with as few halt/go transitions as possible
+
+    Operations are queued as needing a halted thread or not. run() does
+    the ones that don't while the thread runs and all the others inside a
+    single halt window, resuming the thread when the queue drains. A
+    window lasting more than max_halt seconds is interrupted (the firmware
+    runs for min_run seconds) before the next operation. The thread is
+    left as it was found: resumed if it was running, halted otherwise.
+    """
+
+    def __init__(self, thread=None, max_halt=0.5, min_run=0.05):
+        self.thread = thread if thread is not None else t
+        self.max_halt = max_halt
+        self.min_run = min_run
+        self.lock = threading.Lock()
+        self.halted_queue = deque()
+        self.running_queue = deque()
+        self.state = None
+        self.window = None
+        self.halts = 0
+        self.resumes = 0
+        self.halted_time = 0.0
+        self.done = 0
+        self.current = None
+
+    def submit(self, func, args=(), kwargs=None, halted=True, resumes=False):
+        """
+        Queue func(*args, **kwargs), returns its Request
+
+        resumes is for operations that run firmware code (execute_asm,
+        goUntil...) and need their go() to happen.
+        """
+        request = Request(getattr(func, "__name__", "call"), tuple(args), kwargs or {}, 0, func)
+        request.halted = halted
+        request.resumes = resumes
+        with self.lock:
+            (self.halted_queue if halted else self.running_queue).append(request)
+        return request
+
+    def pending(self):
+        with self.lock:
+            return len(self.halted_queue) + len(self.running_queue)
+
+    def ishalted(self):
+        if self.state is None:
+            # Only remember it once halted, a running thread can stop by itself
+            self.state = True if self.thread.ishalted() else None
+            if self.state and self.window is None:
+                self.window = time.time()
+        return bool(self.state)
+
+    def halt(self):
+        if self.state:
+            return
+        try:
+            self.thread.halt()
+        except:
+            # It could timeout for no good reason
+            pass
+        if not self.thread.ishalted():
+            self.thread.halt()
+        self.state = True
+        self.window = time.time()
+        self.halts += 1
+
+    def go(self, *args, **kwargs):
+        if self.window is not None:
+            self.halted_time += time.time() - self.window
+            self.window = None
+        self.state = None
+        self.resumes += 1
+        return self.thread.go(*args, **kwargs)
+
+    def __next(self):
+        with self.lock:
+            # Stay in the current state as long as there's work for it
+            first, second = (self.halted_queue, self.running_queue) if self.state else \
+                            (self.running_queue, self.halted_queue)
+            for queue in (first, second):
+                if queue:
+                    return queue.popleft()
+            return None
+
+    def __execute(self, request):
+        self.current = request
+        try:
+            result = request.func(*request.args, **request.kwargs)
+        except:
+            request.set_exception(sys.exc_info())
+        else:
+            request.set_result(result)
+        finally:
+            self.current = None
+        self.done += 1
+
+    def run(self):
+        """
+        Run everything queued (including what gets queued meanwhile)
+        """
+        was_halted = self.ishalted()
+        proxy = HaltWindowThread(self)
+        previous = set_thread(proxy)
+        try:
+            while True:
+                request = self.__next()
+                if request is None:
+                    break
+                if request.halted:
+                    if self.state and self.window is not None and time.time() - self.window >= self.max_halt:
+                        # Budget spent, let the firmware run a bit
+                        self.go()
+                        time.sleep(self.min_run)
+                    self.halt()
+                self.__execute(request)
+        finally:
+            set_thread(previous)
+            if was_halted:
+                self.halt()
+            elif self.ishalted():
+                self.go()
+            elif self.window is not None:
+                self.halted_time += time.time() - self.window
+                self.window = None
+        return self
+
+    def print_stats(self):
+        print("Halt scheduler: %d operations, %d halts, %d resumes, %.2fs halted" %
+              (self.done, self.halts, self.resumes, self.halted_time))
+
+def run_halted(*calls, **kwargs):
+    """
+    Run (func, args...) calls needing a halted thread in one halt window,
+    returns their results
+    """
+    scheduler = HaltScheduler(**kwargs)
+    requests = [scheduler.submit(call[0], call[1:]) for call in calls]
+    scheduler.run()
+    return [request.result() for request in requests]
@@ -0,0 +1,367 @@
+import re
+from collections import deque
+from utils import *
+from proc import *
+from mem import PDE, phys, att_window
+from addrmap import AddressMap, segment_ranges
+import dispatch
+
+class Pattern(object):
+    """
+    Byte pattern to search for, with an optional per byte mask
+
+    A mask byte of 0xFF must match exactly, 0x00 is a wildcard and
+    anything in between only compares the masked bits.
+    """
+    __slots__ = ("name", "data", "mask", "anchor", "anchor_offset", "checks")
+
+    def __init__(self, name, data, mask=None):
+        self.name = name
+        self.data = bytes(bytearray(data))
+        if mask is not None:
+            mask = bytearray(mask)
+            if len(mask) != len(self.data):
+                raise ValueError("Mask of %s doesn't match its length" % name)
+            if all(m == 0xFF for m in mask):
+                mask = None
+        self.mask = mask
+        # The longest exact run is what the matcher looks for, the rest is
+        # checked on each candidate
+        start, length = 0, len(self.data)
+        if mask is not None:
+            start, length = 0, 0
+            run = 0
+            for (i, m) in enumerate(mask):
+                run = run + 1 if m == 0xFF else 0
+                if run > length:
+                    start, length = i - run + 1, run
+        if length == 0:
+            raise ValueError("Pattern %s has no fixed byte" % name)
+        self.anchor = self.data[start:start + length]
+        self.anchor_offset = start
+        self.checks = []
+        if mask is not None:
+            self.checks = [(i, ord(self.data[i]) & m, m) for (i, m) in enumerate(mask)
+                           if m and not start <= i < start + length]
+
+    @classmethod
+    def parse(cls, name, text):
+        """
+        Pattern from hex text, "??" (or "?" nibbles) are wildcards
+        e.g. Pattern.parse("mz", "4D 5A ?? ?? 5?")
+        """
+        digits = "".join(text.split())
+        if len(digits) % 2:
+            raise ValueError("Odd number of digits in %r" % text)
+        data = bytearray()
+        mask = bytearray()
+        for i in xrange(0, len(digits), 2):
+            pair = digits[i:i + 2]
+            data.append(int(pair.replace("?", "0"), 16))
+            mask.append((0 if pair[0] == "?" else 0xF0) | (0 if pair[1] == "?" else 0x0F))
+        return cls(name, data, mask)
+
+    def __len__(self):
+        return len(self.data)
+
+    def match(self, view, pos):
+        """
+        Whether the pattern is at pos, given the anchor matched there
+        """
+        for (i, value, mask) in self.checks:
+            if view[pos + i] & mask != value:
+                return False
+        return True
+
+    def __str__(self):
+        return self.name
+
+def _pattern(pattern):
+    if isinstance(pattern, Pattern):
+        return pattern
+    if isinstance(pattern, tuple):
+        return Pattern(*pattern)
+    return Pattern(repr(pattern), pattern)
+
+class Matcher(object):
+    """
+    Aho-Corasick automaton over the patterns' anchors
+
+    All patterns are found in a single pass over the data. While in the
+    root state the scan jumps straight to the next byte that can start an
+    anchor, so zero/0xFF filled memory goes by at re speed.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [_pattern(pattern) for pattern in patterns]
+        if not self.patterns:
+            raise ValueError("No pattern to search for")
+        self.longest = max(len(pattern) for pattern in self.patterns)
+        goto = [{}]
+        fail = [0]
+        out = [[]]
+        for pattern in self.patterns:
+            state = 0
+            for c in bytearray(pattern.anchor):
+                following = goto[state].get(c)
+                if following is None:
+                    following = len(goto)
+                    goto.append({})
+                    fail.append(0)
+                    out.append([])
+                    goto[state][c] = following
+                state = following
+            out[state].append((pattern, len(pattern.anchor) + pattern.anchor_offset))
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for (c, following) in goto[state].items():
+                queue.append(following)
+                link = fail[state]
+                while link and c not in goto[link]:
+                    link = fail[link]
+                fail[following] = goto[link].get(c, 0)
+                out[following] = out[following] + out[fail[following]]
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+        self.start = re.compile("[%s]" % "".join(re.escape(chr(c)) for c in sorted(goto[0])))
+
+    def scan(self, data, report_from=0):
+        """
+        Yield (pattern, position) of the matches ending after report_from
+        """
+        view = bytearray(data)
+        goto, fail, out = self.goto, self.fail, self.out
+        end = len(view)
+        state = 0
+        i = 0
+        while i < end:
+            if state == 0:
+                found = self.start.search(data, i)
+                if found is None:
+                    return
+                i = found.start()
+            c = view[i]
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            i += 1
+            for (pattern, anchor_end) in out[state]:
+                pos = i - anchor_end
+                last = pos + len(pattern)
+                if pos >= 0 and report_from < last <= end and pattern.match(view, pos):
+                    yield (pattern, pos)
+
+class Region(object):
+    """
+    Range of target memory (or of a dump) to search
+
+    Target reads go through the dispatcher when one is running, one chunk
+    ahead of the scan.
+    """
+
+    def __init__(self, name, addr, size, space="P", data=None, thread=None):
+        self.name = name
+        self.addr = addr
+        self.size = size
+        self.space = space
+        self.data = data
+        self.thread = thread
+
+    def read_address(self, offset):
+        return "0x%X%s" % (self.addr + offset, self.space)
+
+    def chunks(self, chunk):
+        """
+        Yield (offset, data) over the whole region
+        """
+        if self.data is not None:
+            for offset in xrange(0, self.size, chunk):
+                yield (offset, self.data[offset:offset + chunk])
+            return
+        dispatcher = dispatch.get_dispatcher() if self.thread is None else None
+        thread = self.thread if self.thread is not None else t
+        pending = deque()
+        offset = 0
+        while offset < self.size or pending:
+            while offset < self.size and len(pending) < (2 if dispatcher else 1):
+                length = min(chunk, self.size - offset)
+                if dispatcher is not None:
+                    read = dispatcher.memblock_async(self.read_address(offset), length, 1, dispatch.PRIORITY_BULK)
+                else:
+                    read = thread.memblock(self.read_address(offset), length, 1)
+                pending.append((offset, read))
+                offset += length
+            (position, read) = pending.popleft()
+            if dispatcher is not None:
+                read = read.result()
+            yield (position, bytes(bytearray(read.ToRawBytes())))
+
+    def __str__(self):
+        return self.name
+
+class DramRegion(Region):
+    """
+    Host memory, read through the ATT window 16MB at a time
+    """
+
+    WINDOW = 0x1000000
+
+    def __init__(self, addr, size):
+        # Host addresses, no ipccli space
+        Region.__init__(self, "DRAM_%x" % addr, addr, size, space="")
+
+    def chunks(self, chunk):
+        for start in xrange(0, self.size, self.WINDOW):
+            size = min(self.WINDOW, self.size - start)
+            with att_window(self.addr + start, size) as window:
+                for (offset, data) in Region("", window, size).chunks(chunk):
+                    yield (start + offset, data)
+
+class Attribution(object):
+    """
+    GDT/LDT segments covering an address, from a thread or DumpImage
+    """
+
+    def __init__(self, thread=None):
+        thread = thread if thread is not None else t
+        self.segments = AddressMap(segment_ranges(thread))
+        # Physical page -> linear pages when paging is on
+        self.pages = None
+        if int(thread.arch_register("cr0")) & 0x80000001 == 0x80000001:
+            self.pages = {}
+            pd = int(thread.arch_register("cr3")) & ~0xFFF
+            directory = PDE.entries(thread.memblock(phys(pd), 0x1000, 1).ToRawBytes())
+            for (i, pde) in enumerate(directory):
+                if not pde & 1:
+                    continue
+                if pde & 0x80:
+                    for j in xrange(1024):
+                        self.pages.setdefault((pde >> 12 & ~0x3FF) + j, []).append(i << 10 | j)
+                    continue
+                table = PDE.entries(thread.memblock(phys(pde & ~0xFFF), 0x1000, 1).ToRawBytes())
+                for (j, pte) in enumerate(table):
+                    if pte & 1:
+                        self.pages.setdefault(pte >> 12, []).append(i << 10 | j)
+
+    def linear(self, addr, space="P"):
+        if space != "P" or self.pages is None:
+            return [addr]
+        return [page << 12 | addr & 0xFFF for page in self.pages.get(addr >> 12, [])]
+
+    def selectors(self, addr, space="P"):
+        """
+        [(selector, offset)] of the segments containing addr
+        """
+        result = []
+        for linear in self.linear(addr, space):
+            for segment in sorted(self.segments.lookup(linear), key=lambda segment: segment.start):
+                result.append((segment.get("selector"), linear - segment.start))
+        return result
+
+class Hit(object):
+    __slots__ = ("pattern", "region", "offset", "selectors")
+
+    def __init__(self, pattern, region, offset, selectors=None):
+        self.pattern = pattern
+        self.region = region
+        self.offset = offset
+        self.selectors = selectors or []
+
+    @property
+    def addr(self):
+        return self.region.addr + self.offset
+
+    def __str__(self):
+        line = "%s at 0x%X%s (%s+0x%X)" % (self.pattern, self.addr, self.region.space, self.region, self.offset)
+        if self.selectors:
+            line += " " + ", ".join("%X:%X" % selector for selector in self.selectors)
+        return line
+
+def search(patterns, regions, chunk=0x10000, limit=None, max_hits=None, attribution=None):
+    """
+    Stream the regions chunk by chunk and return the Hits of the patterns
+
+    Chunks overlap by the longest pattern so matches across chunk edges are
+    found (once). A region stops being read after limit hits, the whole
+    search after max_hits.
+    """
+    matcher = patterns if isinstance(patterns, Matcher) else Matcher(patterns)
+    overlap = matcher.longest - 1
+    hits = []
+    for region in regions:
+        found = 0
+        tail = ""
+        chunks = region.chunks(chunk)
+        try:
+            for (offset, data) in chunks:
+                window = tail + data
+                base = offset - len(tail)
+                for (pattern, pos) in matcher.scan(window, len(tail)):
+                    selectors = None
+                    if attribution is not None:
+                        selectors = attribution.selectors(region.addr + base + pos, region.space)
+                    hits.append(Hit(pattern, region, base + pos, selectors))
+                    found += 1
+                    if limit is not None and found >= limit or max_hits is not None and len(hits) >= max_hits:
+                        break
+                else:
+                    tail = window[max(0, len(window) - overlap):] if overlap else ""
+                    continue
+                break
+        finally:
+            chunks.close()
+        if max_hits is not None and len(hits) >= max_hits:
+            break
+    return hits
+
+def _attribution(thread):
+    try:
+        return Attribution(thread)
+    except Exception as e:
+        print("No selector attribution: %s" % e)
+        return None
+
+def search_memory(patterns, ranges, thread=None, attribute=True, **kwargs):
+    """
+    Search physical (addr, size) ranges of the target
+    """
+    regions = [Region("0x%X" % addr, addr, size, thread=thread) for (addr, size) in ranges]
+    return search(patterns, regions, attribution=_attribution(thread) if attribute else None, **kwargs)
+
+def search_mmios(patterns, thread=None, max_size=None, **kwargs):
+    """
+    Search the MMIOS ranges of the thread (largest one when listed twice)
+    """
+    ranges = {}
+    for (addr, size) in proc_get_address(thread if thread is not None else t, "MMIOS", []):
+        if max_size is None or size <= max_size:
+            ranges[addr] = max(size, ranges.get(addr, 0))
+    return search_memory(patterns, sorted(ranges.items()), thread, **kwargs)
+
+def search_dram(patterns, addr, size, **kwargs):
+    """
+    Search host memory through the ATT, like dram() without reading it all
+    """
+    return search(patterns, [DramRegion(addr, size)], **kwargs)
+
+def search_dump(patterns, pwd, attribute=True, **kwargs):
+    """
+    Search the files of a dump directory (see offline.DumpImage)
+    """
+    from offline import DumpImage
+    image = DumpImage(pwd)
+    try:
+        regions = [Region(source, start, end - start, space, data)
+                   for (space, table) in (("P", image.regions), ("L", image.linear_regions))
+                   for (start, end, source, data) in table]
+        attribution = _attribution(image) if attribute and image.registers else None
+        return search(patterns, regions, attribution=attribution, **kwargs)
+    finally:
+        image.close()
+
+def print_hits(hits):
+    for hit in hits:
+        print(hit)
+    print("%d hits" % len(hits))
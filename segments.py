@@ -1,44 +1,97 @@
 import sys
 import os
+import struct
 from utils import *
 from asm import *
 
-class Selector:
+def _raw(bits):
+    return bits if isinstance(bits, (int, long)) else int(bits)
+
+def bitdata(size, value):
+    """
+    BitData of a raw value, for display
+    """
+    return ipccli.bitdata.BitData(size, value)
+
+def _qwords(data):
+    data = bytes(bytearray(data))
+    return struct.unpack_from("<%dQ" % (len(data) // 8), data)
+
+class Selector(object):
+    __slots__ = ("raw", )
+
     def __init__(self, bits):
-        self.bits = bits
-        self.rpl = bits[0:1]
-        self.table = bits[2]
-        self.idx = bits[3:15]
+        self.raw = _raw(bits)
+
+    bits = property(lambda self: bitdata(16, self.raw))
+    rpl = property(lambda self: self.raw & 3)
+    table = property(lambda self: self.raw >> 2 & 1)
+    idx = property(lambda self: self.raw >> 3 & 0x1FFF)
 
     def __str__(self):
-        return "%s %d (Privilege level %d)" % ("LDT" if self.table else "GDT", self.idx.ToUInt32(), self.rpl.ToUInt32())
-    
-class GDTEntry:
+        return "%s %d (Privilege level %d)" % ("LDT" if self.table else "GDT", self.idx, self.rpl)
+
+class GDTEntry(object):
+    """
+    Segment descriptor, stored as its raw 64 bit value
+
+    Fields are plain ints decoded on access, BitData is only built by
+    __str__ to display them.
+    """
+    __slots__ = ("raw", )
+
     def __init__(self, bits):
         # https://wiki.osdev.org/Global_Descriptor_Table
-        self.bits = bits
-        self.base_addr = bits[16:31]
-        self.base_addr.Append(bits[32:39])
-        self.base_addr.Append(bits[56:63])
-        self.limit = bits[0:15]
-        self.limit.Append(bits[48:51])
-        self.access = bits[40:47]
-        self.flags = bits[52:55]
-        self.ac = self.access[0]
-        self.rw = self.access[1]
-        self.dc = self.access[2]
-        self.ex = self.access[3]
-        self.s = self.access[4]
-        self.privl = self.access[5:6]
-        self.pr = self.access[7]
-        self.avl = self.flags[0]
-        self.l = self.flags[1]
-        self.sz = self.flags[2]
-        self.gr = self.flags[3]
-
-        
+        self.raw = _raw(bits)
+
+    @classmethod
+    def table(cls, data):
+        """
+        Decode every descriptor of a table from its raw bytes
+        """
+        return [cls(raw) for raw in _qwords(data)]
+
+    @property
+    def base_value(self):
+        return (self.raw >> 16) & 0xFFFFFF | ((self.raw >> 56) & 0xFF) << 24
+
+    @property
+    def limit_value(self):
+        return self.raw & 0xFFFF | ((self.raw >> 48) & 0xF) << 16
+
+    @property
+    def present_value(self):
+        return (self.raw >> 47) & 1
+
+    @property
+    def size_value(self):
+        # Limit is in 4K pages when the granularity flag is set
+        return (self.limit_value + 1) << 12 if self.raw >> 55 & 1 else self.limit_value + 1
+
+    bits = property(lambda self: bitdata(64, self.raw))
+    base_addr = base_value
+    limit = limit_value
+    access = property(lambda self: self.raw >> 40 & 0xFF)
+    flags = property(lambda self: self.raw >> 52 & 0xF)
+    ac = property(lambda self: self.raw >> 40 & 1)
+    rw = property(lambda self: self.raw >> 41 & 1)
+    dc = property(lambda self: self.raw >> 42 & 1)
+    ex = property(lambda self: self.raw >> 43 & 1)
+    s = property(lambda self: self.raw >> 44 & 1)
+    privl = property(lambda self: self.raw >> 45 & 3)
+    pr = present_value
+    avl = property(lambda self: self.raw >> 52 & 1)
+    l = property(lambda self: self.raw >> 53 & 1)
+    sz = property(lambda self: self.raw >> 54 & 1)
+    gr = property(lambda self: self.raw >> 55 & 1)
 
     def __str__(self):
+        bits = self.bits
+        base_addr = bits[16:31]
+        base_addr.Append(bits[32:39])
+        base_addr.Append(bits[56:63])
+        limit = bits[0:15]
+        limit.Append(bits[48:51])
         return "Segment: %s\n" \
             "  Base Address: %s\n" \
             "  Segment Limit: %s (%s)\n" \
@@ -54,38 +107,51 @@ class GDTEntry:
             "    Read/Write/Execute: %s\n" \
             "    %s: %s\n" \
             "    Accessed: %s\n" % \
-            (self.bits,
-             self.base_addr,
-             self.limit.ToHex() if self.gr == 0 else hex(self.limit.ToUInt32() * 0x1000), self.limit,
-             self.flags,
+            (bits,
+             base_addr,
+             limit.ToHex() if self.gr == 0 else hex(self.limit * 0x1000), limit,
+             bits[52:55],
              "4K Page" if self.gr else "Byte",
              "32-Bit" if self.sz else "16-Bit",
              "x86-64" if self.ex and self.l else ("x86-32" if self.ex else "Not a code segment"),
-             self.avl,
-             self.access,
-             self.pr,
-             "Ring-%d" % self.privl.ToUInt32(),
+             bits[52],
+             bits[40:47],
+             bits[47],
+             "Ring-%d" % self.privl,
              "System Segment" if not self.s else ("Code" if self.ex else "Data"),
              "R-X" if self.ex and self.rw else ("--X" if self.ex else ("RW-" if self.rw else "R--")),
              "Conforming" if self.ex else "Direction",
              ("Grown down" if self.dc else "Grows up") if not self.ex else (("" if self.dc else "Not ") + "Conforming"),
-             self.ac)
+             bits[40])
+
+class IDTEntry(object):
+    __slots__ = ("raw", )
 
-class IDTEntry:
     def __init__(self, bits):
         # https://wiki.osdev.org/Interrupt_Descriptor_Table
-        self.bits = bits
-        self.offset = bits[0:15]
-        self.offset.Append(bits[48:63])
-        self.selector = bits[16:31]
-        self.zero = bits[32:39]
-        self.type_attr = bits[40:47]
-        self.gate_type = self.type_attr[0:3]
-        self.s = self.type_attr[4]
-        self.privl = self.type_attr[5:6]
-        self.pr = self.type_attr[7]
-
-        
+        self.raw = _raw(bits)
+
+    @classmethod
+    def table(cls, data):
+        return [cls(raw) for raw in _qwords(data)]
+
+    @property
+    def offset_value(self):
+        return self.raw & 0xFFFF | ((self.raw >> 48) & 0xFFFF) << 16
+
+    @property
+    def present_value(self):
+        return (self.raw >> 47) & 1
+
+    bits = property(lambda self: bitdata(64, self.raw))
+    offset = offset_value
+    selector = property(lambda self: self.raw >> 16 & 0xFFFF)
+    zero = property(lambda self: self.raw >> 32 & 0xFF)
+    type_attr = property(lambda self: self.raw >> 40 & 0xFF)
+    gate_type = property(lambda self: self.raw >> 40 & 0xF)
+    s = property(lambda self: self.raw >> 44 & 1)
+    privl = property(lambda self: self.raw >> 45 & 3)
+    pr = present_value
 
     def __str__(self):
         GATE_TYPES = {5: "32-bit Task Gate",
@@ -93,7 +159,9 @@ class IDTEntry:
                       7: "16-bit Trap Gate",
                       14: "32-bit Interrupt Gate",
                       15: "32-bit Trap Gate"}
-        
+        bits = self.bits
+        offset = bits[0:15]
+        offset.Append(bits[48:63])
         return "Segment: %s\n" \
             "  Selector: %s (%s)\n" \
             "  Offset: %s\n" \
@@ -102,25 +170,30 @@ class IDTEntry:
             "    Descriptor Privilege Level: %s\n" \
             "    Storage segment: %s\n" \
             "    Gate Type: %s\n" % \
-            (self.bits,
-             Selector(self.selector), self.selector,
-             self.offset,
-             self.type_attr,
-             self.pr,
-             "Ring-%d" % self.privl.ToUInt32(),
-             self.s,
-             GATE_TYPES.get(self.gate_type.ToUInt32(), "Invalid"))
+            (bits,
+             Selector(self.selector), bits[16:31],
+             offset,
+             bits[40:47],
+             bits[47],
+             "Ring-%d" % self.privl,
+             bits[44],
+             GATE_TYPES.get(self.gate_type, "Invalid"))
     
+def read_descriptor_table(base, limit, cls=GDTEntry):
+    """
+    Decode a GDT/LDT/IDT read with a single memblock
+    """
+    entries = (int(limit) + 1) // 8
+    if entries <= 0:
+        return []
+    return cls.table(t.memblock(str(int(base)) + "L", entries * 8, 1).ToRawBytes())
+
 def print_segment(name, base, limit):
     entries = (limit.ToUInt32() + 1) // 8
     print("%s (%s, %s) has %d entries" % (name, base, limit, entries))
-    for i in xrange(entries):
-        segment = t.memblock(str(base.ToUInt32() + 8 * i) + "L", 8, 1)
-        if name == "IDT":
-            entry = IDTEntry(segment)
-        else:
-            entry = GDTEntry(segment)
-        if entry.pr:
+    table = read_descriptor_table(base, limit, IDTEntry if name == "IDT" else GDTEntry)
+    for (i, entry) in enumerate(table):
+        if entry.present_value:
             print("**** %s Entry %d ****" % (name, i))
             print("%s" % str(entry))
 
@@ -136,24 +209,19 @@ def print_segments():
     print_segment("LDT", ldtbas, ldtlim)
 
 def print_selector(selector):
-    if selector.__class__ != ipccli.bitdata.BitData:
-        selector = ipccli.bitdata.BitData(16, selector)
-    table = selector[2]
-    idx = selector[3:15]
-    base = t.arch_register("ldtbas" if table else "gdtbas")
-    segment = t.memblock(str(base.ToUInt32() + 8 * idx.ToUInt32()) + "L", 8, 1)
+    selector = Selector(selector)
+    base = t.arch_register("ldtbas" if selector.table else "gdtbas")
+    segment = t.memblock(str(base.ToUInt32() + 8 * selector.idx) + "L", 8, 1)
     entry = GDTEntry(segment)
-    print "**** %s:%d (%s) ****\n%s" % ("LDT" if table else "GDT", idx.ToUInt32(), selector.ToHex(), str(entry))
+    print "**** %s:%d (%s) ****\n%s" % ("LDT" if selector.table else "GDT", selector.idx, selector.bits.ToHex(),
+                                        str(entry))
 
 def segment_addr_to_linear(selector, addr):
     if type(selector) == str:
         selector = reg(selector)
-    elif selector.__class__ != ipccli.bitdata.BitData:
-        selector = ipccli.bitdata.BitData(16, selector)
-    table = selector[2]
-    idx = selector[3:15].ToUInt32()
-    base = t.arch_register("ldtbas" if table else "gdtbas")
-    segment = t.memblock(str(base.ToUInt32() + 8 * idx) + "L", 8, 1)
+    selector = Selector(selector)
+    base = t.arch_register("ldtbas" if selector.table else "gdtbas")
+    segment = t.memblock(str(base.ToUInt32() + 8 * selector.idx) + "L", 8, 1)
     entry = GDTEntry(segment)
     if addr < entry.limit:
         return entry.base_addr + addr
@@ -161,14 +229,12 @@ def segment_addr_to_linear(selector, addr):
         return None
 
 def table_to_mmio(base, limit):
-    entries = (limit.ToUInt32() + 1) // 8
     mmios = []
-    for i in xrange(entries):
-        segment = t.memblock(str(base.ToUInt32() + 8 * i) + "L", 8, 1)
-        entry = GDTEntry(segment)
-        if entry.pr:
-            mmios.append((entry.base_addr.ToHex(), entry.limit.ToHex()))
+    for entry in read_descriptor_table(base, limit):
+        if entry.present_value:
+            mmios.append((bitdata(32, entry.base_addr).ToHex(), bitdata(20, entry.limit).ToHex()))
     print mmios
+    return mmios
 
 def gdt_ldt_to_mmio():
     gdtbas = t.arch_register("gdtbas")
@@ -197,13 +263,15 @@ def save_to_file(filename, cmd):
 def dump_segments(filename):
     save_to_file(filename, print_segments)
     
-def dump_ldts():
+def dump_ldts(pwd=None):
+    """
+    Save every present LDT segment as LDT-<index>.bin
+    """
     base = t.arch_register("ldtbas")
     limit = t.arch_register("ldtlim")
-    entries = (limit.ToUInt32() + 1) // 8
-    for i in xrange(entries):
-        segment = t.memblock(str(base.ToUInt32() + 8 * i) + "L", 8, 1)
-        entry = GDTEntry(segment)
-        if entry.pr:
-            t.memsave("LDT-" + i + ".bin", str(entry.base.ToUInt32()) + "L")
-    
+    for (i, entry) in enumerate(read_descriptor_table(base, limit)):
+        if entry.present_value:
+            filename = "LDT-%d.bin" % i
+            if pwd is not None:
+                filename = os.path.join(pwd, filename)
+            t.memsave(filename, str(entry.base_value) + "L", entry.size_value)
@@ -0,0 +1,209 @@
+import os
+import sys
+import time
+import threading
+import utils
+from utils import *
+from proc import *
+import xhci as xhci_module
+
+class SessionRouter(object):
+    """
+    Stands in for a module global ('t', 'ipc', xhci.xhci), forwarding to
+    the attribute of the session bound to the calling Python thread, or to
+    the original global when none is
+    """
+
+    def __init__(self, attribute, default):
+        self._attribute = attribute
+        self._default = default
+
+    def _target(self):
+        session = current_session()
+        target = getattr(session, self._attribute) if session is not None else self._default
+        if target is None:
+            raise Exception("No %s for %s" % (self._attribute, session.name if session is not None else "this thread"))
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __repr__(self):
+        session = current_session()
+        return "<%s of %s>" % (self._attribute, session.name if session is not None else "no session")
+
+_routers = None
+
+def enable_sessions():
+    """
+    Route the library globals through the current session (idempotent)
+    """
+    global _routers
+    if _routers is None:
+        _routers = (set_thread(SessionRouter("thread", utils.t)),
+                    set_ipc(SessionRouter("ipc", utils.ipc)),
+                    getattr(xhci_module, "xhci", None))
+        xhci_module.xhci = SessionRouter("xhci", _routers[2])
+    return _routers
+
+def disable_sessions():
+    global _routers
+    if _routers is None:
+        return
+    (thread, ipc_obj, xhci_obj) = _routers
+    set_thread(thread)
+    set_ipc(ipc_obj)
+    xhci_module.xhci = xhci_obj
+    _routers = None
+
+class Session(object):
+    """
+    One target: its ipc connection, execution thread, DMA heap, XHCI,
+    address map, dispatcher, read cache, DCI tracer and dumps directory
+
+    Code running inside "with session:" (or session.call()) sees the
+    session's objects through the usual 't', 'ipc', xhci.xhci,
+    mem.dma_alloc, addrmap.system_map(), start_dispatcher(),
+    enable_cache() and start_tracing(), and the xHCI state is saved under
+    the session's pwd, so the existing tools work
+    unchanged on several targets from one process. proc_addresses are
+    resolved with the thread's name (SPT_CSME_C0_T0, KBP_CSME_C0_T0,
+    CSE_C0_T0...). Sessions are bound per Python thread; a session
+    shouldn't be used by two Python threads at once.
+    """
+
+    def __init__(self, name, thread, ipc_obj=None, pwd=None):
+        self.name = name
+        self.thread = thread
+        self.ipc = ipc_obj
+        self.pwd = pwd if pwd is not None else os.path.join(utils.pwd, name)
+        self.dma_heap = None
+        self.address_map = None
+        self.att_listeners = []
+        self.dispatcher = None
+        self.read_cache = None
+        self.tracer = None
+        self.__xhci = None
+        self.__bound = []
+
+    @classmethod
+    def connect(cls, name, thread=0, **kwargs):
+        """
+        Session over a new ipccli connection
+        """
+        import ipccli
+        ipc_obj = ipccli.baseaccess()
+        return cls(name, ipc_obj.threads[thread] if isinstance(thread, int) else thread, ipc_obj, **kwargs)
+
+    @property
+    def xhci(self):
+        # Created on first use, from the session's thread
+        if self.__xhci is None:
+            with self:
+                self.__xhci = xhci_module.XHCI(self.thread)
+        return self.__xhci
+
+    @xhci.setter
+    def xhci(self, value):
+        self.__xhci = value
+
+    def proc(self, name, default=0):
+        return proc_get_address(self.thread, name, default)
+
+    def __enter__(self):
+        enable_sessions()
+        self.__bound.append(bind_session(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        bind_session(self.__bound.pop())
+        return False
+
+    def call(self, func, *args, **kwargs):
+        with self:
+            return func(*args, **kwargs)
+
+    def __repr__(self):
+        return "<Session %s (%s)>" % (self.name, getattr(self.thread, "name", "?"))
+
+class CampaignResult(object):
+    __slots__ = ("session", "value", "error", "elapsed")
+
+    def __init__(self, session, value=None, error=None, elapsed=0.0):
+        self.session = session
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+class Coordinator(object):
+    """
+    Runs the same campaign on many sessions concurrently
+
+    A campaign is a function called as campaign(session, *args, **kwargs)
+    with the session bound, in one Python thread per session (at most
+    workers at a time). A failing session doesn't stop the others, its
+    exception is kept in its CampaignResult.
+    """
+
+    def __init__(self, sessions, workers=None):
+        self.sessions = list(sessions)
+        self.workers = workers or len(self.sessions)
+
+    def run(self, campaign, *args, **kwargs):
+        """
+        {session name: CampaignResult}
+        """
+        results = {}
+        pending = list(self.sessions)
+        lock = threading.Lock()
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    session = pending.pop(0)
+                start = time.time()
+                result = CampaignResult(session)
+                try:
+                    with session:
+                        result.value = campaign(session, *args, **kwargs)
+                except:
+                    result.error = sys.exc_info()[1]
+                result.elapsed = time.time() - start
+                with lock:
+                    results[session.name] = result
+        enable_sessions()
+        start = time.time()
+        threads = [threading.Thread(target=worker, name="ipclib-campaign-%d" % i)
+                   for i in xrange(min(self.workers, len(self.sessions)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.time() - start
+        return results
+
+    def print_results(self, results):
+        for name in sorted(results):
+            result = results[name]
+            print("%-16s %6.2fs %s" % (name, result.elapsed, "OK" if result.ok else "FAILED: %s" % result.error))
+        print("%d/%d sessions succeeded in %.2fs" %
+              (sum(1 for result in results.values() if result.ok), len(results), self.elapsed))
+
+def aggregate(results, combine=None):
+    """
+    Values of the successful sessions, {name: value} or combine(values)
+    """
+    values = dict((name, result.value) for (name, result) in results.items() if result.ok)
+    return combine(values.values()) if combine is not None else values
+
+def run_campaign(sessions, campaign, *args, **kwargs):
+    coordinator = Coordinator(sessions)
+    results = coordinator.run(campaign, *args, **kwargs)
+    coordinator.print_results(results)
+    return results
@@ -0,0 +1,676 @@
+import time
+import struct
+import random
+import binascii
+from utils import *
+from proc import *
+from cache import parse_address
+from mmio import HexView
+from offline import AddressTranslator
+from session import Session
+
+# In-process simulated target, good enough to run the library's heavy flows
+# (dumps, PCI scan, page tables, descriptor tables, sideband, xHCI bring-up)
+# without hardware. It counts link transactions and bytes, and can charge a
+# configurable latency per transaction to model DCI.
+#
+# memblock(addr, length, width) reads length units of width bytes, which is
+# how PCIDevice.readWord() uses it.
+
+def _to_int(data):
+    return int(binascii.hexlify(bytes(bytearray(data)[::-1])), 16) if data else 0
+
+def _to_bytes(value, size):
+    return bytearray((value >> (8 * i)) & 0xFF for i in xrange(size))
+
+class SparseMemory(object):
+    PAGE = 0x1000
+
+    def __init__(self, fill=0xFF):
+        self.fill = fill
+        self.pages = {}
+
+    def read(self, addr, size):
+        data = bytearray()
+        while size > 0:
+            page, offset = divmod(addr, self.PAGE)
+            chunk = min(size, self.PAGE - offset)
+            if page in self.pages:
+                data += self.pages[page][offset:offset + chunk]
+            else:
+                data += bytearray([self.fill]) * chunk
+            addr += chunk
+            size -= chunk
+        return data
+
+    def write(self, addr, data):
+        pos = 0
+        while pos < len(data):
+            page, offset = divmod(addr + pos, self.PAGE)
+            chunk = min(len(data) - pos, self.PAGE - offset)
+            if page not in self.pages:
+                self.pages[page] = bytearray([self.fill]) * self.PAGE
+            self.pages[page][offset:offset + chunk] = data[pos:pos + chunk]
+            pos += chunk
+
+class RegisterFile(object):
+    """
+    Plain MMIO register block; subclasses hook reads and writes
+    """
+
+    def __init__(self, size, fill=0):
+        self.regs = bytearray([fill]) * size
+
+    def read32(self, offset):
+        return struct.unpack_from("<I", self.regs, offset)[0]
+
+    def write32(self, offset, value):
+        struct.pack_into("<I", self.regs, offset, value & 0xFFFFFFFF)
+
+    def read(self, offset, size):
+        return self.regs[offset:offset + size]
+
+    def write(self, offset, data):
+        self.regs[offset:offset + len(data)] = data
+
+class SimulatedPCIBus(object):
+    """
+    PCI express configuration space (ECAM)
+    """
+
+    def __init__(self):
+        self.functions = {}
+
+    def add(self, bus, dev, func, vid, did, bars=()):
+        config = bytearray(0x1000)
+        struct.pack_into("<HH", config, 0, vid, did)
+        for (i, bar) in enumerate(bars):
+            struct.pack_into("<I", config, 0x10 + 4 * i, bar)
+        self.functions[(bus, dev, func)] = config
+        return config
+
+    def __split(self, offset):
+        return ((offset >> 20) & 0xFF, (offset >> 15) & 0x1F, (offset >> 12) & 0x7), offset & 0xFFF
+
+    def read(self, offset, size):
+        data = bytearray()
+        while size > 0:
+            bdf, reg = self.__split(offset)
+            chunk = min(size, 0x1000 - reg)
+            config = self.functions.get(bdf)
+            data += config[reg:reg + chunk] if config is not None else bytearray([0xFF]) * chunk
+            offset += chunk
+            size -= chunk
+        return data
+
+    def write(self, offset, data):
+        bdf, reg = self.__split(offset)
+        config = self.functions.get(bdf)
+        if config is not None:
+            config[reg:reg + len(data)] = data
+
+class SimulatedSideband(object):
+    """
+    SB_CHANNEL register block and the sideband window it routes
+    """
+
+    def __init__(self, window, window_size=0x10000):
+        self.channel = RegisterFile(0x20)
+        self.channel.write32(0, window)
+        self.channel.write32(4, window_size)
+        self.window = window
+        self.window_size = window_size
+        self.endpoints = {}
+        self.locked_ports = set()
+        self.locked = False
+
+    def add_endpoint(self, port, opcode, device):
+        self.endpoints[(port, opcode & ~1)] = device
+
+    def current(self):
+        channel = self.channel.read32(0x18)
+        return (self.endpoints.get((channel & 0xFF, (channel >> 8) & 0xFE)),
+                self.channel.read32(0x1C) & 0xFF)
+
+    def channel_read(self, offset, size):
+        if self.locked and offset == 0x18:
+            return bytearray(size)
+        return self.channel.read(offset, size)
+
+    def channel_write(self, offset, data):
+        self.channel.write(offset, data)
+        if offset == 0x18:
+            self.locked = self.channel.read32(0x18) & 0xFF in self.locked_ports
+
+    def window_read(self, offset, size):
+        device, fid = self.current()
+        if device is None:
+            return bytearray([0xFF]) * size
+        data = device.read(offset, size)
+        return data + bytearray([0xFF]) * (size - len(data))
+
+    def window_write(self, offset, data):
+        device, fid = self.current()
+        if device is not None:
+            device.write(offset, data)
+
+class _Callbacks(object):
+    def __init__(self, read, write):
+        self.read = read
+        self.write = write
+
+class SimulatedXHCI(RegisterFile):
+    """
+    Minimal xHCI controller : capability/operational/runtime registers, a
+    command ring processor, event rings described by ERSTs and root ports.
+    DMA goes straight to the target's host memory.
+    """
+
+    CAPLENGTH = 0x80
+    RTSOFF = 0x2000
+    DBOFF = 0x3000
+
+    def __init__(self, target, ports=(3, 4), max_slots=8, interrupters=4, erst_max=4):
+        RegisterFile.__init__(self, 0x10000)
+        self.target = target
+        self.port_speeds = list(ports)
+        self.max_slots = max_slots
+        self.interrupters = interrupters
+        self.erst_max = erst_max
+        self.config = bytearray(0x1000)
+        struct.pack_into("<HH", self.config, 0, 0x8086, 0x5AA8)
+        self.dropped_events = 0
+        self.reset()
+
+    def reset(self):
+        self.regs[:] = bytearray(len(self.regs))
+        self.write32(0x0, self.CAPLENGTH | 0x0100 << 16)
+        self.write32(0x4, self.max_slots | self.interrupters << 8 | len(self.port_speeds) << 24)
+        self.write32(0x8, self.erst_max << 4)
+        self.write32(0x14, self.DBOFF)
+        self.write32(0x18, self.RTSOFF)
+        self.write32(0x84, 1)    # HCHalted
+        self.write32(0x88, 1)    # 4K pages
+        for (i, speed) in enumerate(self.port_speeds):
+            if speed:
+                # USB3 ports come up enabled in U0, others wait in polling
+                pls = 0 if speed >= 4 else 7
+                portsc = 1 | (speed >= 4) << 1 | pls << 5 | 1 << 9 | (speed if speed >= 4 else 0) << 10
+            else:
+                portsc = 1 << 9
+            self.write32(0x480 + 0x10 * i, portsc)
+        self.crcr = 0
+        self.ccs = 1
+        self.running = False
+        self.next_slot = 1
+        self.events = [None] * self.interrupters
+
+    def dma_read(self, addr, size):
+        return self.target.dram.read(addr, size)
+
+    def dma_write(self, addr, data):
+        self.target.dram.write(addr, data)
+
+    def pci_device(self):
+        return _Callbacks(lambda offset, size: self.config[offset:offset + size],
+                          self.__pci_write)
+
+    def __pci_write(self, offset, data):
+        self.config[offset:offset + len(data)] = data
+
+    def read(self, offset, size):
+        if offset == 0x98:
+            # CRCR only reads back Command Ring Running
+            return _to_bytes(8 if self.running else 0, size)
+        if offset == 0x9C:
+            return bytearray(size)
+        return RegisterFile.read(self, offset, size)
+
+    def write(self, offset, data):
+        # Registers are dwords, merge partial writes before applying them
+        end = offset + len(data)
+        aligned = offset & ~3
+        while aligned < end:
+            merged = self.regs[aligned:aligned + 4]
+            start, stop = max(offset, aligned), min(end, aligned + 4)
+            merged[start - aligned:stop - aligned] = data[start - offset:stop - offset]
+            self.write_register(aligned, struct.unpack("<I", bytes(merged))[0])
+            aligned += 4
+
+    def write_register(self, offset, value):
+        if offset == 0x80:
+            self.write32(0x80, value & ~2)
+            if value & 2:
+                self.reset()
+                return
+            self.write32(0x84, (self.read32(0x84) & ~1) | (0 if value & 1 else 1))
+        elif offset == 0x84:
+            # RW1C status bits
+            self.write32(0x84, self.read32(0x84) & ~(value & 0x41C))
+        elif offset == 0x98:
+            if value & 6 and self.running:
+                self.running = False
+                self.post_event(0, self.crcr, 24, 33)
+            elif not self.running:
+                self.crcr = value & ~0x3F
+                self.ccs = value & 1
+        elif offset == 0x9C:
+            pass
+        elif 0x480 <= offset < 0x480 + 0x10 * len(self.port_speeds) and offset % 0x10 == 0:
+            self.__portsc_write(offset, value)
+        elif offset >= self.DBOFF:
+            if offset == self.DBOFF:
+                self.process_commands()
+        else:
+            self.write32(offset, value)
+            if offset >= self.RTSOFF + 0x20 and (offset - self.RTSOFF) % 0x20 == 0x10:
+                # ERSTBA write (re)starts the event ring
+                self.__reset_event_ring((offset - self.RTSOFF - 0x20) // 0x20)
+
+    def __portsc_write(self, offset, value):
+        portsc = self.read32(offset)
+        # PR : the reset completes immediately, port enabled in U0
+        if value & 0x10 and portsc & 1:
+            speed = self.port_speeds[(offset - 0x480) // 0x10]
+            portsc = (portsc & ~(0xF << 5) & ~(0xF << 10)) | 2 | speed << 10 | 1 << 21
+        # RW1C change bits
+        portsc &= ~(value & 0x00FE0000)
+        self.write32(offset, portsc)
+
+    def __ir(self, interrupter):
+        return self.RTSOFF + 0x20 + 0x20 * interrupter
+
+    def __reset_event_ring(self, interrupter):
+        ir = self.__ir(interrupter)
+        erstsz = self.read32(ir + 0x8) & 0xFFFF
+        erstba = self.read32(ir + 0x10)
+        segments = []
+        for i in xrange(erstsz):
+            addr, _, size = struct.unpack_from("<III", bytes(self.dma_read(erstba + 0x10 * i, 12)))
+            segments.append((addr & ~0x3F, size & 0xFFFF))
+        self.events[interrupter] = {"segments": segments, "segment": 0, "index": 0, "pcs": 1}
+
+    def post_event(self, interrupter, ptr, cc, tt, slot=0, status=0):
+        ring = self.events[interrupter] if interrupter < len(self.events) else None
+        if ring is None or not ring["segments"]:
+            self.dropped_events += 1
+            return False
+        segments = ring["segments"]
+        addr = segments[ring["segment"]][0] + 0x10 * ring["index"]
+        # Next enqueue position, the ring is full if it reaches the dequeue pointer
+        segment, index = ring["segment"], ring["index"] + 1
+        if index >= segments[segment][1]:
+            segment, index = (segment + 1) % len(segments), 0
+        erdp = self.read32(self.__ir(interrupter) + 0x18) & ~0xF
+        if segments[segment][0] + 0x10 * index == erdp:
+            self.dropped_events += 1
+            return False
+        trb = struct.pack("<IIII", ptr & 0xFFFFFFFF, ptr >> 32, cc << 24 | status,
+                          slot << 24 | tt << 10 | ring["pcs"])
+        self.dma_write(addr, bytearray(trb))
+        if segment == 0 and index == 0:
+            ring["pcs"] ^= 1
+        ring["segment"], ring["index"] = segment, index
+        return True
+
+    def __address_device(self, slot, input_context):
+        # Slot and EP0 contexts go to the output context, slot addressed
+        dcbaa = self.read32(0xB0) | self.read32(0xB4) << 32
+        output = struct.unpack("<Q", bytes(self.dma_read((dcbaa & ~0x3F) + 8 * slot, 8)))[0] & ~0x3F
+        if not output:
+            return
+        contexts = self.dma_read(input_context + 0x20, 0x40)
+        struct.pack_into("<I", contexts, 0xC, 2 << 27 | slot)
+        self.dma_write(output, contexts)
+
+    def process_commands(self):
+        if self.read32(0x84) & 1:
+            return
+        self.running = True
+        for i in xrange(256):
+            ptr_lo, ptr_hi, status, control = struct.unpack("<IIII", bytes(self.dma_read(self.crcr, 16)))
+            if control & 1 != self.ccs:
+                break
+            tt = (control >> 10) & 0x3F
+            if tt == 6:
+                # LINK
+                if control & 2:
+                    self.ccs ^= 1
+                self.crcr = ptr_lo & ~0xF
+                continue
+            slot = 0
+            cc = 1
+            if tt == 9:
+                if self.next_slot > self.max_slots:
+                    cc = 9
+                else:
+                    slot = self.next_slot
+                    self.next_slot += 1
+            elif tt in (10, 11, 12, 13, 14, 15, 16):
+                slot = control >> 24
+                if tt == 11:
+                    self.__address_device(slot, (ptr_lo | ptr_hi << 32) & ~0xF)
+            elif tt != 23:
+                cc = 5
+            self.post_event(0, self.crcr, cc, 33, slot)
+            self.crcr += 0x10
+
+class SimulatedIPC(object):
+    """
+    What the library uses of the ipc object
+    """
+
+    BitData = ipccli.BitData
+
+    def __init__(self, threads):
+        self.threads = list(threads)
+        self.devicelist = "Simulated target"
+        self.stateport = object()
+        self.resets = 0
+
+    def resettarget(self):
+        self.resets += 1
+        for thread in self.threads:
+            thread.reset()
+
+    def reconnect(self):
+        pass
+
+class SimulatedTarget(AddressTranslator):
+    """
+    Simulated execution thread
+    """
+
+    SEGMENT_REGISTERS = ("cs", "ds", "es", "fs", "gs", "ss", "tr", "ldtr")
+
+    def __init__(self, name="CSE_C0_T0", latency=0.0, per_byte=0.0):
+        self.name = name
+        self.latency = latency
+        self.per_byte = per_byte
+        self.memory = SparseMemory(0xFF)
+        self.dram = SparseMemory(0x00)
+        self.devices = []
+        self.registers = {"cr0": 0x11, "eflags": 0x2, "cs": 0x8, "ds": 0x10, "ss": 0x10}
+        self.halted = True
+        self.resets = 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def reset(self):
+        self.resets += 1
+        self.halted = False
+
+    def map_device(self, start, size, device):
+        self.devices.append((start, start + size, device))
+        self.devices.sort(key=lambda device: device[0])
+
+    def __charge(self, size, write=False):
+        self.transactions += 1
+        if write:
+            self.bytes_written += size
+        else:
+            self.bytes_read += size
+        if self.latency or self.per_byte:
+            time.sleep(self.latency + self.per_byte * size)
+
+    # Address translation
+
+    def __att_windows(self):
+        windows = []
+        for entry in xrange(8):
+            base, size, ext_lo, ext_hi, control = struct.unpack(
+                "<IIIII", bytes(self.memory.read(0xF00A8000 + 0x20 * entry, 20)))
+            if control & 1 and size and control != 0xFFFFFFFF:
+                windows.append((base, base + size, ext_lo | ext_hi << 32))
+        return windows
+
+    def __segments(self, addr, size):
+        # (start, end, read, write) for every region overlapping the access
+        regions = [(start, end, device.read, device.write) for (start, end, device) in self.devices]
+        for (start, end, ext) in self.__att_windows():
+            regions.append((start, end,
+                            lambda offset, size, ext=ext: self.dram.read(ext + offset, size),
+                            lambda offset, data, ext=ext: self.dram.write(ext + offset, data)))
+        return regions
+
+    def read_phys(self, addr, size):
+        regions = self.__segments(addr, size)
+        data = bytearray()
+        end = addr + size
+        while addr < end:
+            chunk_end = end
+            handled = False
+            for (start, stop, read, write) in regions:
+                if start <= addr < stop:
+                    chunk_end = min(end, stop)
+                    data += read(addr - start, chunk_end - addr)
+                    handled = True
+                    break
+                if addr < start < chunk_end:
+                    chunk_end = start
+            if not handled:
+                data += self.memory.read(addr, chunk_end - addr)
+            addr = chunk_end
+        return data
+
+    def write_phys(self, addr, data):
+        regions = self.__segments(addr, len(data))
+        pos = 0
+        while pos < len(data):
+            cur = addr + pos
+            chunk_end = addr + len(data)
+            handled = False
+            for (start, stop, read, write) in regions:
+                if start <= cur < stop:
+                    chunk_end = min(chunk_end, stop)
+                    write(cur - start, data[pos:pos + chunk_end - cur])
+                    handled = True
+                    break
+                if cur < start < chunk_end:
+                    chunk_end = start
+            if not handled:
+                self.memory.write(cur, data[pos:pos + chunk_end - cur])
+            pos += chunk_end - cur
+
+    def register_value(self, name):
+        return self.registers.get(name, 0)
+
+    def read(self, addr, size):
+        data = bytearray()
+        for (phys, length) in self.phys_ranges(addr, size):
+            data += self.read_phys(phys, length)
+        return data
+
+    def write(self, addr, data):
+        pos = 0
+        for (phys, length) in self.phys_ranges(addr, len(data)):
+            self.write_phys(phys, data[pos:pos + length])
+            pos += length
+
+    # Thread API
+
+    def memblock(self, addr, length, width, data=None):
+        size = int(length) * (int(width) if int(width) > 1 else 1)
+        if data is None:
+            self.__charge(size)
+            return ipccli.BitData(size * 8, _to_int(self.read(addr, size)))
+        self.__charge(size, True)
+        if isinstance(data, (int, long)) or isinstance(data, ipccli.BitData):
+            self.write(addr, _to_bytes(int(data), int(width)) * int(length))
+        else:
+            self.write(addr, bytearray(data))
+
+    def mem(self, addr, size, value=None):
+        if value is None:
+            self.__charge(size)
+            return ipccli.BitData(size * 8, _to_int(self.read(addr, size)))
+        self.__charge(size, True)
+        self.write(addr, _to_bytes(int(value), size))
+
+    def memdump(self, addr, size, width=1):
+        self.__charge(size)
+        for line in HexView(self.read(addr, size), parse_address(addr)[1]):
+            print(line)
+
+    def memsave(self, filename, addr, size, *args):
+        self.__charge(size)
+        with open(filename, "wb") as f:
+            f.write(self.read(addr, int(size)))
+
+    def arch_register(self, name, value=None):
+        self.__charge(4, value is not None)
+        if value is None:
+            width = 16 if name in self.SEGMENT_REGISTERS or name.endswith("lim") and name != "ldtlim" else 32
+            return ipccli.BitData(width, self.registers.get(name, 0))
+        self.registers[name] = int(value)
+
+    def dport(self, port, value=None):
+        self.__charge(4, value is not None)
+        if value is None:
+            return ipccli.BitData(32, self.registers.get("port_%X" % port, 0xFFFFFFFF))
+        self.registers["port_%X" % port] = int(value)
+
+    def halt(self):
+        self.__charge(0)
+        self.halted = True
+
+    def go(self):
+        self.__charge(0)
+        self.halted = False
+
+    def step(self, *args):
+        self.__charge(0)
+        self.halted = True
+
+    def ishalted(self):
+        self.__charge(0)
+        return self.halted
+
+    def isrunning(self):
+        self.__charge(0)
+        return not self.halted
+
+    def asm(self, addr, *args):
+        raise Exception("asm is not supported by the simulated target")
+
+def _descriptor(base, size, access):
+    # 32 bit segment, in 4K pages when it doesn't fit the 20 bit limit
+    flags, limit = (0xC, (size >> 12) - 1) if size > 0x100000 else (0x4, size - 1)
+    return struct.pack("<Q", (limit & 0xFFFF) | (base & 0xFFFFFF) << 16 | access << 40 |
+                       ((limit >> 16) & 0xF) << 48 | flags << 52 | ((base >> 24) & 0xFF) << 56)
+
+def simulated_board(name="CSE_C0_T0", latency=0.0, per_byte=0.0, xhci_ports=(3, 4), seed=0):
+    """
+    Simulated target with descriptor tables, PCI devices, a sideband window
+    with a few endpoints, an xHCI controller and some populated MMIO
+    """
+    rand = random.Random(seed)
+    target = SimulatedTarget(name, latency, per_byte)
+
+    # Descriptor tables
+    gdt, ldt, idt = 0x96000, 0x134000, 0x97000
+    target.write_phys(gdt, bytearray("".join(_descriptor(base, size, 0x9A if i == 1 else 0x92)
+                                             for (i, (base, size)) in enumerate([(0, 1), (0, 0x90000), (0, 0x100000),
+                                                                                 (ldt, 0x400), (0x96000, 0x68)]))))
+    entries = [_descriptor(base, size, 0x92) for (base, size) in proc_get_address(target, "MMIOS", [])[:64]]
+    target.write_phys(ldt, bytearray("".join(entries)))
+    target.write_phys(idt, bytearray("".join(struct.pack("<HHBBH", 0x1000 + i * 0x10, 0x8, 0, 0x8E, 0)
+                                             for i in xrange(32))))
+    target.registers.update({"gdtbas": gdt, "gdtlim": 5 * 8 - 1, "ldtbas": ldt, "ldtlim": len(entries) * 8 - 1,
+                             "idtbas": idt, "idtlim": 32 * 8 - 1, "esp": 0x8F000, "ebp": 0x8F100, "eip": 0x26000})
+
+    # MMIO content : about a quarter of the pages hold data, the rest read as 0xFF or 0x00
+    for (addr, size) in proc_get_address(target, "MMIOS", []):
+        if size > 0x100000:
+            continue
+        for page in xrange(addr & ~0xFFF, addr + size, 0x1000):
+            kind = rand.random()
+            if kind < 0.25:
+                target.memory.write(page, bytearray(rand.getrandbits(8) for i in xrange(0x1000)))
+            elif kind < 0.5:
+                target.memory.write(page, bytearray(0x1000))
+
+    # The ATT is at the start of an MMIO range, keep it disabled
+    target.memory.write(0xF00A8000, bytearray(0x1000))
+
+    # PCI
+    pci = SimulatedPCIBus()
+    pci.add(0, 0, 0, 0x8086, 0x5AF0)
+    pci.add(0, 2, 0, 0x8086, 0x5A85, bars=[0xA0000000])
+    pci.add(0, 0x15, 0, 0x8086, 0x5AA8)
+    pci.add(0, 0x1F, 0, 0x8086, 0x5AE8)
+    pci.add(0, 0x1F, 1, 0x8086, 0x5AD4)
+    target.map_device(0xE0000000, 0x10000000, pci)
+    target.pci = pci
+
+    # Sideband
+    sideband = SimulatedSideband(proc_get_address(target, "SB_WINDOW_MMIO", 0xF6110000))
+    target.map_device(proc_get_address(target, "SB_CHANNEL", 0xF00A9000), 0x20,
+                      _Callbacks(sideband.channel_read, sideband.channel_write))
+    target.map_device(sideband.window, sideband.window_size,
+                      _Callbacks(sideband.window_read, sideband.window_write))
+    sideband.locked_ports.update(proc_get_address(target, "SB_BROKEN_PORTS", []))
+    for port in (0x4C, 0x6A, 0xA1, 0xC7):
+        sideband.add_endpoint(port, 0, RegisterFile(0x10000, fill=port))
+    target.sideband = sideband
+
+    xhci = SimulatedXHCI(target, xhci_ports)
+    port = proc_get_address(target, "XHCI_PORTID", 0xA2)
+    sideband.add_endpoint(port, 0, xhci)
+    sideband.add_endpoint(port, 4, xhci.pci_device())
+    target.xhci = xhci
+
+    # Host memory seen through the ATT
+    for page in xrange(0, 0x40000, 0x1000):
+        target.dram.write(0x100000000 + page, bytearray(rand.getrandbits(8) for i in xrange(0x1000)))
+    return target
+
+def enable_paging(target, mappings=((0, 0, 0x400000), (0xF0000000, 0xF0000000, 0x1000000))):
+    """
+    Build a two level page directory identity mapping (linear, physical, size) ranges
+    """
+    pd = 0x200000
+    tables = pd + 0x1000
+    for (linear, physical, size) in mappings:
+        for offset in xrange(0, size, 0x1000):
+            directory = (linear + offset) >> 22
+            pde = struct.unpack("<I", bytes(target.memory.read(pd + directory * 4, 4)))[0]
+            if not pde & 1 or pde == 0xFFFFFFFF:
+                pde = tables | 0x3
+                target.memory.write(tables, bytearray(0x1000))
+                tables += 0x1000
+                target.memory.write(pd + directory * 4, _to_bytes(pde, 4))
+            entry = (pde & ~0xFFF) + (((linear + offset) >> 12) & 0x3FF) * 4
+            target.memory.write(entry, _to_bytes((physical + offset) | 0x3, 4))
+    # Unused directory entries must read as not present
+    for directory in xrange(1024):
+        pde = struct.unpack("<I", bytes(target.memory.read(pd + directory * 4, 4)))[0]
+        if pde == 0xFFFFFFFF:
+            target.memory.write(pd + directory * 4, bytearray(4))
+    target.registers["cr3"] = pd
+    target.registers["cr0"] |= 0x80000001
+    return target
+
+def install_simulation(target):
+    """
+    Point the whole library at a simulated target
+    Returns what to pass to uninstall_simulation()
+    """
+    previous = (set_ipc(SimulatedIPC([target])), set_thread(target))
+    return previous
+
+def uninstall_simulation(previous):
+    set_ipc(previous[0])
+    set_thread(previous[1])
+
+def simulated_session(name, thread_name="CSE_C0_T0", **kwargs):
+    """
+    Session on its own simulated board (see simulated_board), so several
+    can run side by side in one process
+    """
+    target = simulated_board(thread_name, **kwargs)
+    return Session(name, target, SimulatedIPC([target]))
@@ -0,0 +1,464 @@
+import os
+import re
+import json
+import mmap
+import time
+import struct
+import bisect
+from array import array
+from utils import *
+from dumpwriter import read_compressed
+from checkpoint import CHECKPOINT_FILE
+from offline import DumpImage, REGISTERS_FILE
+from search import Region, Attribution
+from sparsedump import fabricated_runs
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Dump files compared, with how their prefix reads in the report
+DIFF_PREFIXES = ("MMIO_", "PCI_", "BAR_", "SB_", "RAM_")
+DIFF_BLOCK = 0x100000
+
+_DUMP_FILE = re.compile(r"^(.*_)([0-9a-fA-F]+)\.bin(\.gz|\.xz)?$")
+
+def describe_prefix(prefix):
+    """
+    What a dump file prefix stands for: "PCI_0.20.0_" -> "PCI 0.20.0 config"
+    """
+    parts = prefix.rstrip("_").split("_")
+    if parts[0] == "PCI" and len(parts) > 1:
+        return "PCI %s config" % parts[-1]
+    if parts[0] == "BAR" and len(parts) > 1:
+        return "PCI %s BAR" % parts[-1]
+    if parts[0] == "SB" and len(parts) > 1:
+        return "sideband channel %s" % parts[1]
+    return " ".join(parts)
+
+class DumpDirectory(object):
+    """
+    Dump files of a directory (save_mmios, DumpWriter, checkpoint) for diffing
+
+    Files are memory-mapped (compressed ones decompressed in memory). The
+    page hashes of a checkpoint.json are used, when there is one, so
+    identical pages are skipped without being read. The fill runs of sparse
+    dumps were never read, fabricated() lists them.
+    """
+
+    def __init__(self, pwd, prefixes=DIFF_PREFIXES):
+        self.pwd = pwd
+        self.name = pwd
+        self.entries = {}
+        self.page_size = None
+        self.__files = []
+        self.__fabricated = {}
+        skipped = fabricated_runs(pwd)
+        for filename in sorted(os.listdir(pwd)):
+            match = _DUMP_FILE.match(filename)
+            if match is None or not match.group(1).startswith(tuple(prefixes)):
+                continue
+            path = os.path.join(pwd, filename)
+            if match.group(3):
+                data = read_compressed(path)
+            elif os.path.getsize(path) == 0:
+                data = ""
+            else:
+                f = open(path, "rb")
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.__files.append((f, data))
+            self.entries[(match.group(1), int(match.group(2), 16))] = [data, None, filename]
+            if filename in skipped:
+                self.__fabricated[(match.group(1), int(match.group(2), 16))] = skipped[filename]
+        path = os.path.join(pwd, CHECKPOINT_FILE)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                state = json.load(f)
+            self.page_size = state["page_size"]
+            files = dict((entry[2], entry) for entry in self.entries.values())
+            for region in state["regions"]:
+                if region["file"] in files:
+                    files[region["file"]][1] = region["hashes"]
+
+    def keys(self):
+        return self.entries.keys()
+
+    def size(self, key):
+        return len(self.entries[key][0])
+
+    def hashes(self, key):
+        """
+        (page size, [page hashes]) or None
+        """
+        hashes = self.entries[key][1]
+        return (self.page_size, hashes) if hashes is not None else None
+
+    def read(self, key, offset, size):
+        return self.entries[key][0][offset:offset + size]
+
+    def fabricated(self, key):
+        """
+        [(offset, size)] of the file that hold fill values, not target data
+        """
+        return self.__fabricated.get(key, [])
+
+    def image(self):
+        # Registers and tables for selector attribution
+        if not os.path.exists(os.path.join(self.pwd, REGISTERS_FILE)):
+            return None
+        return DumpImage(self.pwd)
+
+    def close(self):
+        for (f, data) in self.__files:
+            data.close()
+            f.close()
+        self.__files = []
+
+class StoreSnapshot(object):
+    """
+    Snapshot of a DumpStore for diffing, pages compare by their hash
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.snapshot = store.load_snapshot(name) if not isinstance(name, dict) else name
+        self.name = self.snapshot["name"]
+        self.page_size = self.snapshot["page_size"]
+        self.entries = dict(((str(region["prefix"]), region["addr"]), region) for region in self.snapshot["regions"])
+
+    def keys(self):
+        return self.entries.keys()
+
+    def size(self, key):
+        return self.entries[key]["size"]
+
+    def hashes(self, key):
+        return (self.page_size, self.entries[key]["pages"])
+
+    def read(self, key, offset, size):
+        pages = self.entries[key]["pages"]
+        first = offset // self.page_size
+        last = (offset + size - 1) // self.page_size
+        data = "".join(self.store.get_page(pages[i]) for i in xrange(first, last + 1))
+        skip = offset - first * self.page_size
+        return data[skip:skip + size]
+
+    def fabricated(self, key):
+        return []
+
+    def image(self):
+        return None
+
+    def close(self):
+        pass
+
+class LiveTarget(object):
+    """
+    The ranges of a reference snapshot, read from the target
+
+    Reads go through the dispatcher when one is running. Sideband window
+    dumps (SB_) depend on how the channel was set up and are left out.
+    """
+
+    def __init__(self, reference, thread=None):
+        self.thread = thread
+        self.name = getattr(thread if thread is not None else t, "name", "target")
+        self.entries = dict((key, reference.size(key)) for key in reference.keys() if not key[0].startswith("SB_"))
+        self.__chunks = {}
+
+    def keys(self):
+        return self.entries.keys()
+
+    def size(self, key):
+        return self.entries[key]
+
+    def hashes(self, key):
+        return None
+
+    def read(self, key, offset, size):
+        # Called in order with the same block size, so stream the range in
+        # blocks of the first read. Only the last one may be shorter.
+        state = self.__chunks.get(key)
+        if state is None:
+            chunks = Region(describe_prefix(key[0]), key[1], self.entries[key], thread=self.thread).chunks(size)
+            state = self.__chunks[key] = [size, chunks]
+        if size > state[0]:
+            raise Exception("Read of %s larger than its block" % describe_prefix(key[0]))
+        (position, data) = next(state[1])
+        if position != offset:
+            raise Exception("Out of order read of %s" % describe_prefix(key[0]))
+        return data[:size]
+
+    def fabricated(self, key):
+        return []
+
+    def image(self):
+        return None
+
+    def close(self):
+        for (size, chunks) in self.__chunks.values():
+            chunks.close()
+        self.__chunks = {}
+
+def _source(value):
+    if isinstance(value, basestring):
+        return DumpDirectory(value)
+    if isinstance(value, tuple):
+        return StoreSnapshot(*value)
+    return value
+
+def _changed_words(old, new):
+    """
+    Offsets (multiple of 4) of the 32-bit words that differ
+    """
+    if len(old) % 4:
+        pad = "\0" * (4 - len(old) % 4)
+        old, new = old + pad, new + pad
+    if numpy is not None:
+        xor = numpy.frombuffer(old, dtype="<u4") ^ numpy.frombuffer(new, dtype="<u4")
+        return (numpy.flatnonzero(xor) * 4).tolist()
+    offsets = []
+    # Narrow down to the 64 byte lines that differ, then compare their words
+    for line in xrange(0, len(old), 64):
+        if old[line:line + 64] != new[line:line + 64]:
+            a = array("I", old[line:line + 64])
+            b = array("I", new[line:line + 64])
+            offsets.extend(line + i * 4 for i in xrange(len(a)) if a[i] != b[i])
+    return offsets
+
+def _word(data, offset):
+    raw = data[offset:offset + 4]
+    return struct.unpack("<I", raw + "\0" * (4 - len(raw)))[0]
+
+class RangeDiff(object):
+    """
+    Differences between the two copies of one dump file
+    """
+
+    def __init__(self, prefix, addr, old_size, new_size):
+        self.prefix = prefix
+        self.addr = addr
+        self.old_size = old_size
+        self.new_size = new_size
+        self.changed = 0
+        self.skipped = 0
+        self.unread = 0
+        self.ranges = []
+        self.words = []
+        self.selectors = {}
+
+    @property
+    def label(self):
+        return describe_prefix(self.prefix)
+
+    def add(self, offset, old, new, gap, max_words):
+        self.changed += 1
+        if max_words is None or len(self.words) < max_words:
+            self.words.append((offset, old, new))
+        if self.ranges and offset - self.ranges[-1][1] <= gap:
+            self.ranges[-1][1] = offset + 4
+        else:
+            self.ranges.append([offset, offset + 4])
+
+    def __str__(self):
+        line = "%-28s 0x%08X %6d words changed in %d ranges" % (self.label, self.addr, self.changed, len(self.ranges))
+        if self.old_size != self.new_size:
+            line += " (size 0x%X -> 0x%X)" % (self.old_size, self.new_size)
+        if self.unread:
+            line += " (%d bytes not read by a sparse dump)" % self.unread
+        return line
+
+class SnapshotDiff(object):
+    """
+    Word level differences between two snapshots
+
+    Either side is a dump directory, a (DumpStore, snapshot name) tuple or
+    a source object (LiveTarget...). Files are matched by prefix and
+    address and compared block by block: pages whose hashes are known on
+    both sides and match are skipped, then blocks that compare equal, and
+    the rest is XORed 32 bits at a time (with numpy when it's there) to
+    find the changed words. Words in the fill runs of a sparse dump, on
+    either side, weren't read and aren't reported. Changed words closer
+    than gap bytes make one
+    range. At most max_words words per file are kept in the change list,
+    all of them are counted.
+    """
+
+    def __init__(self, old, new, block=DIFF_BLOCK, gap=0x10, max_words=4096, attribute=True):
+        self.old = _source(old)
+        self.new = _source(new)
+        self.block = block
+        self.gap = gap
+        self.max_words = max_words
+        self.attribute = attribute
+        self.diffs = []
+        self.added = []
+        self.removed = []
+        self.stats = {"compared": 0, "hash_skipped": 0, "equal_skipped": 0, "scanned": 0, "unread": 0}
+        self.elapsed = 0.0
+
+    def __blocks(self, old_hashes, new_hashes, size):
+        """
+        (offset, length, skipped) blocks to compare, pages with the same
+        hash on both sides grouped apart
+        """
+        if old_hashes is None or new_hashes is None or old_hashes[0] != new_hashes[0]:
+            for offset in xrange(0, size, self.block):
+                yield (offset, min(self.block, size - offset), False)
+            return
+        (page_size, old_pages), new_pages = old_hashes, new_hashes[1]
+        run = None
+        for offset in xrange(0, size, page_size):
+            i = offset // page_size
+            same = i < len(old_pages) and i < len(new_pages) and old_pages[i] == new_pages[i]
+            length = min(page_size, size - offset)
+            if run is not None and run[2] == same and run[1] + length <= max(self.block, page_size):
+                run[1] += length
+                continue
+            if run is not None:
+                yield tuple(run)
+            run = [offset, length, same]
+        if run is not None:
+            yield tuple(run)
+
+    def __unread(self, key, size):
+        # Merged fill runs of both sides, within the compared size
+        runs = []
+        for (offset, length) in sorted(self.old.fabricated(key) + self.new.fabricated(key)):
+            end = min(offset + length, size)
+            if offset >= end:
+                continue
+            if runs and offset <= runs[-1][1]:
+                runs[-1][1] = max(runs[-1][1], end)
+            else:
+                runs.append([offset, end])
+        return runs
+
+    def __diff(self, key):
+        (prefix, addr) = key
+        old_size, new_size = self.old.size(key), self.new.size(key)
+        diff = RangeDiff(prefix, addr, old_size, new_size)
+        unread = self.__unread(key, min(old_size, new_size))
+        starts = [start for (start, end) in unread]
+        diff.unread = sum(end - start for (start, end) in unread)
+        self.stats["unread"] += diff.unread
+        for (offset, length, skipped) in self.__blocks(self.old.hashes(key), self.new.hashes(key),
+                                                       min(old_size, new_size)):
+            self.stats["compared"] += length
+            if skipped:
+                self.stats["hash_skipped"] += length
+                diff.skipped += length
+                continue
+            old = self.old.read(key, offset, length)
+            new = self.new.read(key, offset, length)
+            if old == new:
+                self.stats["equal_skipped"] += length
+                continue
+            self.stats["scanned"] += length
+            for word in _changed_words(old, new):
+                idx = bisect.bisect_right(starts, offset + word) - 1
+                if idx >= 0 and offset + word < unread[idx][1]:
+                    continue
+                diff.add(offset + word, _word(old, word), _word(new, word), self.gap, self.max_words)
+        return diff
+
+    def run(self):
+        start = time.time()
+        old_keys, new_keys = set(self.old.keys()), set(self.new.keys())
+        self.added = sorted(new_keys - old_keys, key=lambda key: (key[1], key[0]))
+        self.removed = sorted(old_keys - new_keys, key=lambda key: (key[1], key[0]))
+        for key in sorted(old_keys & new_keys, key=lambda key: (key[1], key[0])):
+            diff = self.__diff(key)
+            if diff.changed or diff.old_size != diff.new_size:
+                self.diffs.append(diff)
+        if self.attribute:
+            self.__attribute()
+        self.elapsed = time.time() - start
+        return self
+
+    def __attribute(self):
+        image = self.new.image() or self.old.image()
+        if image is None:
+            return
+        try:
+            attribution = Attribution(image)
+            for diff in self.diffs:
+                if diff.prefix.startswith(("MMIO_", "RAM_")):
+                    for (start, end) in diff.ranges:
+                        diff.selectors[start] = attribution.selectors(diff.addr + start)
+        except Exception as e:
+            print("No selector attribution: %s" % e)
+        finally:
+            image.close()
+
+    def close(self):
+        self.old.close()
+        self.new.close()
+
+    def changes(self):
+        """
+        Yield (label, address, old, new) of the changed words kept
+        """
+        for diff in self.diffs:
+            for (offset, old, new) in diff.words:
+                yield (diff.label, diff.addr + offset, old, new)
+
+    def print_summary(self):
+        for diff in self.diffs:
+            print(diff)
+        for key in self.removed:
+            print("%-28s 0x%08X only in %s" % (describe_prefix(key[0]), key[1], self.old.name))
+        for key in self.added:
+            print("%-28s 0x%08X only in %s" % (describe_prefix(key[0]), key[1], self.new.name))
+        stats = self.stats
+        print("%d files differ, %d words changed. %d bytes compared in %.2fs "
+              "(%d skipped by hash, %d by block compare, %d scanned)" %
+              (len(self.diffs), sum(diff.changed for diff in self.diffs), stats["compared"], self.elapsed,
+               stats["hash_skipped"], stats["equal_skipped"], stats["scanned"]))
+        if stats["unread"]:
+            print("%d bytes were not read by sparse dumps and not compared" % stats["unread"])
+
+    def print_changes(self, limit=None):
+        shown = 0
+        for diff in self.diffs:
+            print("%s (0x%X):" % (diff.label, diff.addr))
+            for (start, end) in diff.ranges:
+                selectors = diff.selectors.get(start)
+                print("  0x%08X-0x%08X%s" % (diff.addr + start, diff.addr + end,
+                                            " " + ", ".join("%X:%X" % s for s in selectors) if selectors else ""))
+            for (offset, old, new) in diff.words:
+                if limit is not None and shown >= limit:
+                    return
+                print("    0x%08X: %08X -> %08X" % (diff.addr + offset, old, new))
+                shown += 1
+
+    def to_json(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"old": self.old.name, "new": self.new.name, "stats": self.stats,
+                       "added": self.added, "removed": self.removed,
+                       "diffs": [{"prefix": diff.prefix, "label": diff.label, "addr": diff.addr,
+                                  "old_size": diff.old_size, "new_size": diff.new_size, "changed": diff.changed,
+                                  "ranges": diff.ranges, "words": diff.words} for diff in self.diffs]},
+                      f, indent=1)
+
+def diff_snapshots(old, new, changes=20, **kwargs):
+    """
+    Compare two snapshots and print what changed
+    """
+    result = SnapshotDiff(old, new, **kwargs)
+    try:
+        result.run()
+    finally:
+        result.close()
+    result.print_summary()
+    if changes:
+        result.print_changes(changes)
+    return result
+
+def diff_live(reference, thread=None, changes=20, **kwargs):
+    """
+    Compare a snapshot with the target's memory as it is now
+    """
+    old = _source(reference)
+    return diff_snapshots(old, LiveTarget(old, thread), changes, **kwargs)
@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import struct
+from collections import deque
+from utils import *
+from proc import *
+from mem import phys
+from mmio import dump_filename, setup_sideband_channel
+import dispatch
+
+# Page states found by the probing pass
+PAGE_EMPTY = "empty"          # Sampled words all 0xFF or all 0x00
+PAGE_UNIFORM = "uniform"      # Sampled words all the same other value
+PAGE_POPULATED = "populated"
+
+SPARSE_MANIFEST = "sparse.json"
+
+class SparseDumper(object):
+    """
+    Dumps ranges reading only the pages that carry information
+
+    A probing pass first samples every page of a range: the words on each
+    side of every page boundary (one 8 byte read), a word every stride
+    bytes and samples pseudo-random words, all queued on the dispatcher in
+    one batch. Pages whose samples are all 0xFF/0x00 are empty, all the
+    same other word uniform, anything else populated. Only populated pages
+    are read, the others are written from their fill value and recorded as
+    runs in the directory's sparse.json manifest, so the .bin files have
+    the same layout as save_mmios ones. The fill bytes were never read:
+    DumpImage treats them as holes and SnapshotDiff doesn't compare them
+    (see fabricated_runs).
+
+    A page that looks empty can still hold a register or two, with
+    verify=True the skipped pages are read in full afterwards and the ones
+    that didn't match their fill are written and marked populated.
+    """
+
+    def __init__(self, thread=None, page_size=0x1000, stride=None, samples=2, chunk=0x1000, read_ahead=8,
+                 verify=False, dispatcher=None):
+        self.thread = thread if thread is not None else target_thread()
+        self.page_size = page_size
+        self.stride = stride
+        self.samples = samples
+        self.chunk = chunk
+        self.read_ahead = read_ahead
+        self.verify = verify
+        self.dispatcher = dispatcher
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.pages = dict((state, 0) for state in (PAGE_EMPTY, PAGE_UNIFORM, PAGE_POPULATED))
+        self.probe_reads = 0
+        self.bytes_probed = 0
+        self.bytes_read = 0
+        self.bytes_skipped = 0
+        self.bytes_verified = 0
+        self.misclassified = 0
+        self.elapsed = 0.0
+
+    def __sample_offsets(self, addr, length):
+        # Boundary words are read separately
+        offsets = set()
+        if self.stride:
+            offsets.update(xrange(self.stride, length - 4, self.stride))
+        words = length // 4
+        seed = addr
+        for i in xrange(self.samples if words > 2 else 0):
+            # Deterministic per page so a re-dump probes the same words
+            seed = (seed * 1103515245 + 12345) & 0x7FFFFFFF
+            offsets.add((seed % words) * 4)
+        return sorted(offset for offset in offsets if 0 < offset < length - 4)
+
+    def probe(self, addr, size, dispatcher):
+        """
+        [(state, fill)] for each page of the range
+        """
+        pages = [(offset, min(self.page_size, size - offset)) for offset in xrange(0, size, self.page_size)]
+        samples = [[] for page in pages]
+        requests = []
+        # First word of the range, then across every page boundary
+        requests.append((0, None, 0, dispatcher.memblock_async(phys(addr), min(4, size), 1,
+                                                             dispatch.PRIORITY_BULK)))
+        for (i, (offset, length)) in enumerate(pages):
+            end = offset + length
+            if length >= 8:
+                following = i + 1 if i + 1 < len(pages) else None
+                span = 8 if following is not None else 4
+                requests.append((i, following, 4, dispatcher.memblock_async(phys(addr + end - 4), span, 1,
+                                                                            dispatch.PRIORITY_BULK)))
+            for sample in self.__sample_offsets(addr + offset, length):
+                requests.append((i, None, 4, dispatcher.memblock_async(phys(addr + offset + sample), 4, 1,
+                                                                       dispatch.PRIORITY_BULK)))
+        for (i, following, split, request) in requests:
+            data = bytes(bytearray(request.result().ToRawBytes()))
+            self.probe_reads += 1
+            self.bytes_probed += len(data)
+            samples[i].append(data[:split or len(data)])
+            if following is not None:
+                samples[following].append(data[split:])
+        states = []
+        for (i, (offset, length)) in enumerate(pages):
+            data = "".join(samples[i])
+            if length < 8 or not data:
+                # Too small to be worth guessing
+                states.append((PAGE_POPULATED, None))
+            elif data.count("\xFF") == len(data):
+                states.append((PAGE_EMPTY, 0xFF))
+            elif data.count("\0") == len(data):
+                states.append((PAGE_EMPTY, 0x00))
+            elif len(data) % 4 == 0 and data == data[:4] * (len(data) // 4):
+                states.append((PAGE_UNIFORM, struct.unpack("<I", data[:4])[0]))
+            else:
+                states.append((PAGE_POPULATED, None))
+        return states
+
+    def __fill(self, state, value, length):
+        if state == PAGE_EMPTY:
+            return chr(value) * length
+        return (struct.pack("<I", value) * (length // 4 + 1))[:length]
+
+    def __read(self, dispatcher, f, addr, size):
+        inflight = deque()
+        offset = 0
+        while offset < size or inflight:
+            while offset < size and len(inflight) < self.read_ahead:
+                length = min(self.chunk, size - offset)
+                inflight.append(dispatcher.memblock_async(phys(addr + offset), length, 1, dispatch.PRIORITY_BULK))
+                offset += length
+            data = bytes(bytearray(inflight.popleft().result().ToRawBytes()))
+            self.bytes_read += len(data)
+            f.write(data)
+
+    def __runs(self, states, size):
+        # Merge pages of the same state and fill into [offset, size, state, fill]
+        runs = []
+        for (i, (state, value)) in enumerate(states):
+            offset = i * self.page_size
+            length = min(self.page_size, size - offset)
+            self.pages[state] += 1
+            if runs and runs[-1][2] == state and runs[-1][3] == value:
+                runs[-1][1] += length
+            else:
+                runs.append([offset, length, state, value])
+        return runs
+
+    def __verify(self, dispatcher, f, addr, runs):
+        checked = []
+        for run in runs:
+            (offset, size, state, value) = run
+            if state == PAGE_POPULATED:
+                checked.append(run)
+                continue
+            for page in xrange(offset, offset + size, self.page_size):
+                length = min(self.page_size, offset + size - page)
+                data = bytes(bytearray(dispatcher.memblock_async(phys(addr + page), length, 1,
+                                                                 dispatch.PRIORITY_BULK).result().ToRawBytes()))
+                self.bytes_verified += length
+                if data != self.__fill(state, value, length):
+                    f.seek(page)
+                    f.write(data)
+                    self.misclassified += 1
+                    checked.append([page, length, PAGE_POPULATED, None])
+                elif checked and checked[-1][2:] == [state, value] and checked[-1][0] + checked[-1][1] == page:
+                    checked[-1][1] += length
+                else:
+                    checked.append([page, length, state, value])
+        return checked
+
+    def __region(self, dispatcher, pwd, prefix, addr, size, manifest):
+        filename = dump_filename(prefix, addr)
+        path = os.path.join(pwd, filename)
+        entry = manifest.get(filename)
+        if entry is not None and entry["size"] >= size and os.path.exists(path) and \
+           os.stat(path).st_size >= size and (entry["verified"] or not self.verify):
+            print("Skipping. Already dumped")
+            return
+        runs = self.__runs(self.probe(addr, size, dispatcher), size)
+        with open(path, "w+b") as f:
+            for (offset, length, state, value) in runs:
+                if state == PAGE_POPULATED:
+                    self.__read(dispatcher, f, addr + offset, length)
+                else:
+                    f.write(self.__fill(state, value, length))
+                    self.bytes_skipped += length
+            if self.verify:
+                runs = self.__verify(dispatcher, f, addr, runs)
+        manifest[filename] = {"addr": addr, "size": size, "page_size": self.page_size, "verified": self.verify,
+                              "runs": runs}
+
+    def dump(self, pwd, mmios, prefix="MMIO_"):
+        """
+        Dump (addr, size) ranges into pwd, returns the manifest
+        """
+        try:
+            os.makedirs(pwd)
+        except:
+            pass
+        manifest = load_sparse_manifest(pwd)
+        dispatcher = self.dispatcher or dispatch.get_dispatcher()
+        private = dispatcher is None
+        if private:
+            dispatcher = dispatch.Dispatcher(self.thread)
+        start = time.time()
+        try:
+            # Same order as save_mmios
+            for (addr, size) in sorted(mmios, key=lambda mmio: (mmio[1], mmio[0])):
+                print("Addr: %s, size: %s" % (hex(addr), hex(size)))
+                self.__region(dispatcher, pwd, prefix, addr, size, manifest)
+        finally:
+            if private:
+                dispatcher.stop()
+            with open(os.path.join(pwd, SPARSE_MANIFEST), "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            self.elapsed += time.time() - start
+        return manifest
+
+    def print_stats(self):
+        total = self.bytes_read + self.bytes_skipped
+        print("%d pages populated, %d uniform, %d empty. Read %d bytes (+%d in %d probes) of %d, %.1f%% skipped "
+              "in %.2fs" %
+              (self.pages[PAGE_POPULATED], self.pages[PAGE_UNIFORM], self.pages[PAGE_EMPTY], self.bytes_read,
+               self.bytes_probed, self.probe_reads, total, self.bytes_skipped * 100.0 / total if total else 0,
+               self.elapsed))
+        if self.verify:
+            print("Verified %d bytes, %d skipped pages didn't match their fill" %
+                  (self.bytes_verified, self.misclassified))
+
+def load_sparse_manifest(pwd):
+    path = os.path.join(pwd, SPARSE_MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def fabricated_runs(pwd):
+    """
+    {filename: [(offset, size)]} of the bytes the sparse dumps of pwd wrote
+    from a fill value without reading them, verified dumps have none
+    """
+    runs = {}
+    for (filename, entry) in load_sparse_manifest(pwd).items():
+        skipped = [(offset, size) for (offset, size, state, fill) in entry["runs"] if state != PAGE_POPULATED]
+        if skipped and not entry["verified"]:
+            runs[str(filename)] = skipped
+    return runs
+
+def save_mmios_sparse(t, pwd, mmios=None, prefix="MMIO_", **kwargs):
+    if mmios is None:
+        mmios = proc_get_address(t, "MMIOS", [])
+    dumper = SparseDumper(t, **kwargs)
+    manifest = dumper.dump(pwd, mmios, prefix)
+    dumper.print_stats()
+    return manifest
+
+def dump_sideband_channel_sparse(t, pwd, channel, size=0x8000, rs=1, fid=0, **kwargs):
+    """
+    dump_sideband_channel saving the window, populated pages only
+    """
+    try:
+        t.halt()
+    except:
+        # It could timeout for no good reason
+        pass
+    sb_channel_port_addr = proc_get_address(t, "SB_CHANNEL")
+    sb_mmio, _ = setup_sideband_channel(t, channel, rs, fid)
+    manifest = save_mmios_sparse(t, pwd, [(int(sb_mmio), size)], "SB_" + hex(channel) + "_", **kwargs)
+    if t.mem(phys(sb_channel_port_addr + 0x18), 4) != channel:
+        print("SB seems to have locked")
+    return manifest
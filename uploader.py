@@ -0,0 +1,197 @@
+import os
+import json
+import mmap
+import time
+import bisect
+import hashlib
+from utils import *
+from cache import parse_address
+
+# Largest single memblock transfer
+MAX_WRITE = 0x10000
+
+class VerifyError(Exception):
+    """
+    Read back doesn't match what was uploaded
+    """
+
+    def __init__(self, addr, offset):
+        Exception.__init__(self, "Verification of %s failed at offset 0x%X" % (addr, offset))
+        self.addr = addr
+        self.offset = offset
+
+def format_address(space, offset):
+    """
+    Inverse of cache.parse_address
+    """
+    if space.endswith(":"):
+        return "%s%X" % (space, offset)
+    return "0x%X%s" % (offset, space)
+
+def _parse(addr):
+    parsed = parse_address(addr)
+    if parsed is None:
+        raise Exception("Invalid address %r" % (addr, ))
+    return parsed
+
+class WriteBatch(object):
+    """
+    Write-combining buffer for target memory
+
+    Writes are held until flush() (or the end of the with block). Adjacent
+    and overlapping ones of the same address space then go out as single
+    memblock writes of up to max_write bytes, later writes winning.
+    Only meant for memory: register writes with side effects shouldn't be
+    combined or reordered.
+    """
+
+    def __init__(self, thread=None, max_write=MAX_WRITE):
+        self.thread = thread
+        self.max_write = max_write
+        self.writes = []
+        self.transfers = 0
+        self.bytes = 0
+
+    def write(self, addr, data):
+        space, offset = _parse(addr)
+        data = bytearray(data)
+        if data:
+            self.writes.append((space, offset, data))
+
+    def mem(self, addr, size, value):
+        value = int(value)
+        self.write(addr, bytearray((value >> (8 * i)) & 0xFF for i in xrange(size)))
+
+    def memset(self, addr, value, size):
+        self.write(addr, bytearray([value & 0xFF]) * size)
+
+    def runs(self):
+        """
+        (space, start, data) of the combined writes
+        """
+        runs = []
+        for (space, start, data) in sorted(self.writes, key=lambda write: (write[0], write[1])):
+            end = start + len(data)
+            if runs and runs[-1][0] == space and start <= runs[-1][2]:
+                runs[-1][2] = max(runs[-1][2], end)
+            else:
+                runs.append([space, start, end])
+        keys = [(space, start) for (space, start, end) in runs]
+        buffers = [bytearray(end - start) for (space, start, end) in runs]
+        # Applied in submission order so the last write to a byte wins
+        for (space, start, data) in self.writes:
+            idx = bisect.bisect_right(keys, (space, start)) - 1
+            offset = start - keys[idx][1]
+            buffers[idx][offset:offset + len(data)] = data
+        return [(space, start, buffers[i]) for (i, (space, start, end)) in enumerate(runs)]
+
+    def flush(self):
+        thread = self.thread if self.thread is not None else t
+        for (space, start, data) in self.runs():
+            for pos in xrange(0, len(data), self.max_write):
+                piece = data[pos:pos + self.max_write]
+                thread.memblock(format_address(space, start + pos), len(piece), 1, list(piece))
+                self.transfers += 1
+                self.bytes += len(piece)
+        self.writes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+def _read(thread, space, offset, size):
+    return bytes(bytearray(thread.memblock(format_address(space, offset), size, 1).ToRawBytes()))
+
+def verify_upload(addr, data, mode="sample", thread=None, max_write=MAX_WRITE, samples=16, sample_size=64):
+    """
+    Compare target memory at addr with data, raises VerifyError
+
+    "full" reads everything back, "sample" only samples windows spread
+    evenly over the buffer (always including both ends).
+    """
+    thread = thread if thread is not None else t
+    space, start = _parse(addr)
+    size = len(data)
+    if mode == "full":
+        windows = [(pos, min(max_write, size - pos)) for pos in xrange(0, size, max_write)]
+    elif mode == "sample":
+        length = min(sample_size, size)
+        count = max(1, min(samples, size // max(length, 1)))
+        last = size - length
+        windows = sorted(set((last * i // max(count - 1, 1), length) for i in xrange(count)))
+    else:
+        raise ValueError("Unknown verification %r" % (mode, ))
+    for (pos, length) in windows:
+        expected = bytes(data[pos:pos + length])
+        actual = _read(thread, space, start + pos, length)
+        if actual != expected:
+            mismatch = next(i for i in xrange(length) if actual[i] != expected[i])
+            raise VerifyError(addr, pos + mismatch)
+
+def _load_journal(journal, addr, size, digest):
+    if journal is None or not os.path.exists(journal):
+        return 0
+    with open(journal, "r") as f:
+        state = json.load(f)
+    if state.get("addr") != str(addr) or state.get("size") != size or state.get("sha1") != digest:
+        print("Journal %s is for another upload, starting over" % journal)
+        return 0
+    return state["done"]
+
+def _save_journal(journal, addr, size, digest, done):
+    with open(journal + ".tmp", "w") as f:
+        json.dump({"addr": str(addr), "size": size, "sha1": digest, "done": done}, f)
+    if os.path.exists(journal):
+        os.remove(journal)
+    os.rename(journal + ".tmp", journal)
+
+def upload(addr, data, verify=None, journal=None, thread=None, max_write=MAX_WRITE):
+    """
+    Write a buffer to target memory at addr in max_write sized memblocks
+
+    addr is anything ipccli takes: phys(addr), "sel:offset", "...L".
+    verify is None, "sample" or "full" (see verify_upload).
+    With a journal file, progress is recorded after every write and a
+    rerun with the same journal resumes where an interrupted upload
+    stopped. It's removed once the upload is complete.
+    Returns the number of bytes written.
+    """
+    thread = thread if thread is not None else t
+    space, start = _parse(addr)
+    size = len(data)
+    digest = hashlib.sha1(data).hexdigest() if journal is not None else None
+    done = _load_journal(journal, addr, size, digest)
+    if done:
+        print("Resuming upload to %s at 0x%X/0x%X" % (addr, done, size))
+    written = 0
+    begin = time.time()
+    for pos in xrange(done, size, max_write):
+        piece = bytearray(data[pos:pos + max_write])
+        thread.memblock(format_address(space, start + pos), len(piece), 1, list(piece))
+        written += len(piece)
+        if journal is not None:
+            _save_journal(journal, addr, size, digest, pos + len(piece))
+    elapsed = time.time() - begin
+    print("Uploaded %d bytes to %s in %.2fs (%.1f KB/s)" %
+          (written, addr, elapsed, written / 1024.0 / elapsed if elapsed else 0))
+    if verify is not None:
+        verify_upload(addr, data, verify, thread, max_write)
+    if journal is not None and os.path.exists(journal):
+        os.remove(journal)
+    return written
+
+def upload_file(addr, filename, verify=None, journal=None, **kwargs):
+    """
+    upload() the contents of a host file, memory-mapped rather than read
+    """
+    if os.path.getsize(filename) == 0:
+        return 0
+    with open(filename, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return upload(addr, data, verify, journal, **kwargs)
+        finally:
+            data.close()
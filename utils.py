@@ -1,6 +1,8 @@
 import ipccli
 import time
 import os
+import sys
+import threading
 
 ipc = None
 
@@ -20,6 +22,78 @@ def setLogging(path=None, echo=False, logger="ipc", level="DEBUG"):
     manager.echo(echo)
     manager.level(logger, level)
 
+class ThreadProxy(object):
+    """
+    Stands in for an ipc thread, forwarding anything it doesn't override
+    """
+
+    def __init__(self, thread):
+        self._thread = thread
+
+    def __getattr__(self, name):
+        return getattr(self._thread, name)
+
+def _rebind(name, value):
+    # Modules use 'from utils import *', so each one holds its own reference
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None)
+        if path and os.path.dirname(os.path.abspath(path)) == directory and hasattr(module, name):
+            setattr(module, name, value)
+    globals()[name] = value
+
+def set_thread(thread):
+    """
+    Make every loaded ipclib module use thread as its global 't'
+    Returns the previous thread so it can be restored.
+    """
+    previous = globals().get("t")
+    _rebind("t", thread)
+    return previous
+
+def set_ipc(obj):
+    """
+    Make every loaded ipclib module use obj as its global 'ipc'
+    """
+    previous = globals().get("ipc")
+    _rebind("ipc", obj)
+    return previous
+
+# Session (see session.py) the calling Python thread works on
+_session_local = threading.local()
+
+def current_session():
+    return getattr(_session_local, "session", None)
+
+def bind_session(session):
+    """
+    Make session current for the calling Python thread, returns the
+    previous one
+    """
+    previous = current_session()
+    _session_local.session = session
+    return previous
+
+def target_thread():
+    """
+    Thread of the current session, the global 't' without one
+    """
+    session = current_session()
+    return session.thread if session is not None else t
+
+def use_thread(thread, session=None):
+    """
+    set_thread() for the current (or given) session only: with sessions
+    't' routes to session.thread, so proxies (cache, dispatcher, tracer)
+    replace that instead of the global. Returns the previous thread.
+    """
+    session = session if session is not None else current_session()
+    if session is None:
+        return set_thread(thread)
+    previous = session.thread
+    session.thread = thread
+    return previous
+
 def usleep(us):
     time.sleep(us / 1000000.0)
 
@@ -51,12 +125,18 @@ def displayValidIdcodes(prefix=""):
                 idcode += " (" + proc_id.ToHex() + ")"
             print("%s : %s" % (d.name, idcode))
 
-ipc = connect()
-print(ipc.devicelist)
-try:
-    t = ipc.threads[0]
-except:
+t = None
+if os.environ.get("IPCLIB_OFFLINE"):
+    # No DCI connection, a simulated or replayed target gets installed with
+    # set_ipc()/set_thread() (see sim.py)
     pass
+else:
+    ipc = connect()
+    print(ipc.devicelist)
+    try:
+        t = ipc.threads[0]
+    except:
+        pass
 
 # Display hex values when using ipython
 try:
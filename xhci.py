@@ -3,9 +3,23 @@ from utils import *
 from segments import *
 from proc import *
 from asm import *
+from addrmap import system_map
+import os
+import json
+import struct
+import mem
+import utils
 
 xhci_debug = debug
 
+# Where setup() records the host side state for attach(), in the dumps
+# directory of the session (see session.py) if there's one
+XHCI_STATE_FILE = "xhci_state.json"
+
+def xhci_state_file():
+    session = current_session()
+    return os.path.join(session.pwd if session is not None else utils.pwd, XHCI_STATE_FILE)
+
 class Data:
     def __init__(self, size, data=0, addr=None):
         self.size = size
@@ -69,6 +83,7 @@ class TRBStatusBits:
     TL = [TRB.STATUS, 0, 17] # TL - Transfer Length 
     EVTL = [TRB.STATUS, 0, 24] #  EVTL - (Event TRB) Transfer Length 
     TDS = [TRB.STATUS, 17, 5] # TDS - TD Size 
+    INTR = [TRB.STATUS, 22, 10] # INTR - Interrupter Target
     CC = [TRB.STATUS, 24, 8] # CC - Completion Code
 
 class TRBControlBits:
@@ -133,11 +148,24 @@ class TRBCompletionCode(TRBEnum):
     STOPPED = 26
     STOPPED_LENGTH_INVALID = 27
     
+def _cycle_boundary(cycles):
+    # Index of the first TRB written in a different pass than the first one
+    for i in range(1, len(cycles)):
+        if cycles[i] != cycles[0]:
+            return i
+    return None
+
 class XHCICycleRing:
-    def __init__(self, size):
-        self.ring = dma_align(64, size * 0x10)
-        self.size = size
-        self.init()
+    def __init__(self, size, ring=None, dequeue=None):
+        if ring is None:
+            self.ring = dma_align(64, size * 0x10)
+            self.size = size
+            self.init()
+        else:
+            # Ring left by a previous session (XHCI.attach)
+            self.ring = ring
+            self.size = size
+            self.resume(dequeue)
     
     def __len__(self):
         return self.size
@@ -163,8 +191,34 @@ class XHCICycleRing:
         trb.read(self.current)
         return trb
 
+    def cycle_bits(self, entries):
+        data = bytearray(t.memblock(phys(self.ring), entries * 0x10, 1).ToRawBytes())
+        return [data[i * 0x10 + 12] & 1 for i in range(entries)]
+
+    def entries(self):
+        return self.size
+
+    def resume(self, dequeue=None):
+        """
+        Find the enqueue pointer and cycle state from the TRBs' cycle bits,
+        TRBs before the enqueue pointer were written in the current pass.
+        """
+        cycles = self.cycle_bits(self.entries())
+        boundary = _cycle_boundary(cycles)
+        if boundary is None:
+            # Nothing written yet, or a whole pass just completed
+            self.current = self.ring
+            self.pcs = cycles[0] ^ 1
+        else:
+            self.current = self.ring + boundary * 0x10
+            self.pcs = cycles[0]
+
 class XHCICommandRing(XHCICycleRing):
 
+    def entries(self):
+        # The last TRB is the LINK
+        return self.size - 1
+
     def init(self):
         XHCICycleRing.init(self)
         trb = TRB()
@@ -244,17 +298,102 @@ class XHCICommandRing(XHCICycleRing):
         trb = self.next_command_trb(TRBType.CMD_ADDRESS_DEV)
         trb.set(TRBControlBits.ID, slot_id)
         trb.set(TRB.PTR_LOW, ic)
+        trb.write(self.current)
         cmd = self.current
         self.post_command()
         return self.wait_for_command(cmd, True)
 
 class XHCIEventRing(XHCICycleRing):
+    """
+    Event ring of one interrupter, in segments described by an ERST
+
+    The dequeue pointer goes from the end of a segment to the start of the
+    next one and the cycle state toggles when it wraps back to the first.
+    Pass table (and the number of entries) to pick up the ring an
+    interrupter already uses instead of allocating one.
+    """
+
+    def __init__(self, size, segments=1, interrupter=0, table=None, dequeue=None):
+        self.interrupter = interrupter
+        self.overruns = 0
+        if table is None:
+            self.segments = [(dma_align(64, size * 0x10, memset_value=0), size) for i in range(segments)]
+            self.table = dma_align(64, len(self.segments) * 0x10, memset_value=0)
+            erst = bytearray().join(struct.pack("<QII", ring, entries, 0) for (ring, entries) in self.segments)
+            t.memblock(phys(self.table), len(erst), 1, list(erst))
+        else:
+            self.table = table
+            erst = bytes(bytearray(t.memblock(phys(table), segments * 0x10, 1).ToRawBytes()))
+            self.segments = []
+            for i in range(segments):
+                ring, entries, _ = struct.unpack_from("<QII", erst, i * 0x10)
+                self.segments.append((ring & ~0x3F, entries & 0xFFFF))
+        self.ring, self.size = self.segments[0]
+        self.segment = 0
+        self.current = self.ring
+        self.pcs = 1
+        if table is not None:
+            self.resume(dequeue)
+
+    def __len__(self):
+        return sum(entries for (ring, entries) in self.segments)
+
+    def __getitem__(self, idx):
+        idx = int(idx)
+        for (ring, entries) in self.segments:
+            if idx < entries:
+                return ring + idx * 0x10
+            idx -= entries
+        raise IndexError()
+
+    @property
+    def ir(self):
+        # Interrupter register set : IMAN, IMOD, ERSTSZ, ERSTBA, ERDP
+        return 0x2020 + 0x20 * self.interrupter
+
+    def enable(self):
+        """
+        Point the interrupter at the ring (ERSTBA last, it starts the ring)
+        """
+        xhci.bar_write32(self.ir + 0x8, len(self.segments))
+        self.update_dequeue_pointer()
+        xhci.bar_write32(self.ir + 0x1c, 0)
+        xhci.bar_write32(self.ir + 0x10, self.table)
+        xhci.bar_write32(self.ir + 0x14, 0)
+
+    def cycle_bits(self, entries=None):
+        cycles = []
+        for (ring, size) in self.segments:
+            data = bytearray(t.memblock(phys(ring), size * 0x10, 1).ToRawBytes())
+            cycles += [data[i * 0x10 + 12] & 1 for i in range(size)]
+        return cycles
+
+    def resume(self, dequeue=None):
+        """
+        Consumer cycle state at the dequeue pointer (ERDP), from the cycle
+        bits of what the controller wrote
+        """
+        cycles = self.cycle_bits()
+        boundary = _cycle_boundary(cycles)
+        dequeue = int(dequeue) & ~0xF if dequeue else self.ring
+        index = 0
+        for (segment, (ring, size)) in enumerate(self.segments):
+            if ring <= dequeue < ring + size * 0x10:
+                self.segment = segment
+                self.current = dequeue
+                index += (dequeue - ring) // 0x10
+                break
+            index += size
+        if boundary is None:
+            self.pcs = cycles[0] if index else cycles[0] ^ 1
+        else:
+            # Past the controller's enqueue pointer, still in the previous pass
+            self.pcs = cycles[0] if index <= boundary else cycles[0] ^ 1
 
     def reset(self):
-        trb = TRB()
-        for i in range(self.size):
-            trb.read(self[i])
-            trb.set(TRBControlBits.C, 0)
+        for (ring, size) in self.segments:
+            memset(ring, 0, size * 0x10)
+        self.segment = 0
         self.current = self.ring
         self.pcs = 1
         
@@ -280,13 +419,45 @@ class XHCIEventRing(XHCICycleRing):
             self.handle_event(trb)
         return timeout
 
-    def advance_dequeue_pointer(self):
-        self.current = self.current + 0x10
-        if self.current == self.ring + self.size * 0x10:
-            self.current = self.ring
-        xhci.bar_write32(0x2038, self.current)
-            
-    def handle_event(self, trb):
+    def advance_dequeue_pointer(self, update=True):
+        ring, size = self.segments[self.segment]
+        self.current = int(self.current) + 0x10
+        if self.current == ring + size * 0x10:
+            self.segment = (self.segment + 1) % len(self.segments)
+            self.current = self.segments[self.segment][0]
+            if self.segment == 0:
+                self.pcs ^= 1
+        if update:
+            self.update_dequeue_pointer()
+
+    def update_dequeue_pointer(self):
+        # DESI is the segment index, EHB is write 1 to clear
+        xhci.bar_write32(self.ir + 0x18, self.current | self.segment & 7 | 1 << 3)
+
+    def poll(self):
+        """
+        Consume the events ready at the dequeue pointer and return their
+        TRBs, reading up to a segment at a time and writing ERDP once
+        """
+        events = []
+        while True:
+            ring, size = self.segments[self.segment]
+            left = (ring + size * 0x10 - self.current) // 0x10
+            data = bytearray(t.memblock(phys(self.current), left * 0x10, 1).ToRawBytes())
+            for i in range(left):
+                if data[i * 0x10 + 12] & 1 != self.pcs:
+                    break
+                low, high = struct.unpack_from("<QQ", bytes(data), i * 0x10)
+                events.append(TRB(high << 64 | low))
+                self.advance_dequeue_pointer(False)
+            else:
+                continue
+            break
+        if events:
+            self.update_dequeue_pointer()
+        return events
+
+    def handle_event(self, trb, update=True):
         tt = trb.get(TRBControlBits.TT)
         cc = trb.get(TRBStatusBits.CC)
         xhci_debug("Received event : %s, Completion Code: %s\n%s" % (TRBType.name(tt), TRBCompletionCode.name(cc), trb))
@@ -297,17 +468,17 @@ class XHCIEventRing(XHCICycleRing):
                        (trb.get(TRBPtrBits.PORT), TRBCompletionCode.name(cc)))
         elif tt == TRBType.EV_HOST:
             if cc == TRBCompletionCode.EVENT_RING_FULL_ERROR:
+                self.overruns += 1
                 xhci_debug("Event ring full!")
         else:
             xhci_debug("Warning: Spurious event: %s, Completion Code: %s\n" %
                        (TRBType.name(tt), TRBCompletionCode.name(cc)))
-        self.advance_dequeue_pointer()
+        if update:
+            self.advance_dequeue_pointer()
         
     def handle_events(self):
-        trb = self.TRB()
-        while self.event_ready(trb):
-            self.handle_event(trb)
-            trb.read(self.current)
+        for trb in self.poll():
+            self.handle_event(trb, False)
         
     def wait_for_command_done(self, addr, clear_event):
         timeout = 100 * 1000 # 100ms
@@ -445,6 +616,11 @@ class XHCIInputContext:
         self.dev = XHCIDevice(slot_id, self.ctx + 0x20)
         
 class XHCI:
+    # Event ring of interrupter 0 : segments of EVENT_SEGMENT_SIZE TRBs, as
+    # many as the ERST can have up to EVENT_SEGMENTS
+    EVENT_SEGMENTS = 4
+    EVENT_SEGMENT_SIZE = 256
+
     def __init__(self, thread):
         self.port = proc_get_address(thread, "XHCI_PORTID")
         self.fid = proc_get_address(thread, "XHCI_PCI_DEVICE")
@@ -456,14 +632,9 @@ class XHCI:
     
     def check_pci_from_ME(self):
         sb_mmio, _ = setup_sideband_channel(t, 0x050400 | self.port, 0, self.fid << 3)
-        base = t.arch_register("ldtbas")
-        selector = 0
-        for idx in range(128):
-            segment = t.memblock(str(base.ToUInt32() + 8 * idx) + "L", 8, 1)
-            entry = GDTEntry(segment)
-            if entry.base_addr == sb_mmio:
-                selector = idx << 3 | 0xf
-                break
+        # LDT selector (idx << 3 | 7) of the segment starting at the window,
+        # flat addressing through selector 0 if there's none
+        selector = system_map(refresh=True).selector(int(sb_mmio), "ldt") or 0
 
         execute_asm(t,
                     "mov edx, fs",
@@ -479,6 +650,10 @@ class XHCI:
         sb_channel = 1 << 28 | (rw_opcode | 1) << 16 | (rw_opcode & ~1) << 8 | self.port
         sb_mmio, _ = setup_sideband_channel(t, sb_channel, 0, fid << 3)
         return t.mem(phys(sb_mmio + offset), size)
+    def sb_read_block(self, rw_opcode, fid, offset, size):
+        sb_channel = 1 << 28 | (rw_opcode | 1) << 16 | (rw_opcode & ~1) << 8 | self.port
+        sb_mmio, _ = setup_sideband_channel(t, sb_channel, 0, fid << 3)
+        return bytes(bytearray(t.memblock(phys(sb_mmio + offset), size // 4, 4).ToRawBytes()))
     def sb_write(self, rw_opcode, fid, size, offset, value):
         sb_channel = 1 << 28 | (rw_opcode | 1) << 16 | (rw_opcode & ~1) << 8 | self.port
         sb_mmio, _ = setup_sideband_channel(t, sb_channel, 0, fid << 3)
@@ -506,6 +681,8 @@ class XHCI:
         return self.sb_read(0, self.fid, size, offset)
     def bar_write(self, size, offset, value):
         return self.sb_write(0, self.fid, size, offset, value) 
+    def bar_read_block(self, offset, size):
+        return self.sb_read_block(0, self.fid, offset, size)
 
     def bar_read32(self, offset):
         return self.bar_read(4, offset)
@@ -606,6 +783,8 @@ class XHCI:
         xhci_debug("Max Slots:   %d" % self.max_slots)
         xhci_debug("Max Ports:   %d" % self.max_ports)
         xhci_debug("Page Size:   %d" % self.page_size)
+        self.read_event_limits()
+        xhci_debug("Interrupters:   %d, ERST entries: %d" % (self.max_interrupters, self.max_erst))
 
         
         # Allocate resources
@@ -623,10 +802,11 @@ class XHCI:
         self.dma_buffer = dma_align(64 * 1024, 64 * 1024)
         self.cr = XHCICommandRing(4)
         xhci_debug("command ring %s" % hex(self.cr.ring))
-        self.er = XHCIEventRing(64)
-        xhci_debug("event ring %s" % hex(self.er.ring))
-        self.ev_ring_table = dma_align(64, 0x10, memset_value=0)
+        self.er = XHCIEventRing(self.EVENT_SEGMENT_SIZE, min(self.EVENT_SEGMENTS, self.max_erst))
+        xhci_debug("event ring %s (%d segments)" % (hex(self.er.ring), len(self.er.segments)))
+        self.ev_ring_table = self.er.table
         xhci_debug("event ring table %s" % hex(self.ev_ring_table))
+        self.interrupters = {0: self.er}
 
         # Setup hardware
         self.wait_ready()
@@ -637,13 +817,7 @@ class XHCI:
         self.bar_write32(0x98, self.cr.ring | 0x1)
         self.bar_write32(0x9c, 0)
         
-        self.set(self.ev_ring_table, self.er.ring)
-        self.set(self.ev_ring_table + 8, 64)
-        
-        self.bar_write32(0x2028, 1) # Size of evet ring table
-        self.bar_write32(0x2030, self.ev_ring_table)
-        self.bar_write32(0x2034, 0)
-        xhci.bar_write32(0x2038, self.er.current)
+        self.er.enable()
 
         self.start()
 
@@ -658,6 +832,175 @@ class XHCI:
         self.devs = [None]* self.max_ports
         self.transfer_rings = [None]* self.max_ports
         self.check_ports()
+        self.save_state()
+
+    def read_event_limits(self):
+        self.set_event_limits(int(self.bar_read32(0x4)), int(self.bar_read32(0x8)))
+
+    def set_event_limits(self, hcsparams1, hcsparams2):
+        self.max_interrupters = (hcsparams1 >> 8) & 0x7FF
+        # ERST Max is log2 of the number of ERST entries
+        self.max_erst = 1 << ((hcsparams2 >> 4) & 0xF)
+
+    def add_interrupter(self, interrupter, size=None, segments=None):
+        """
+        Event ring of a secondary interrupter
+
+        Transfer TRBs with their interrupter target (TRBStatusBits.INTR) set
+        to it complete there and can be consumed with poll() independently
+        of self.er, which keeps command completions and port changes.
+        """
+        if not 0 < interrupter < self.max_interrupters:
+            raise ValueError("Interrupter %d out of range (%d)" % (interrupter, self.max_interrupters))
+        er = XHCIEventRing(size or self.EVENT_SEGMENT_SIZE, min(segments or self.EVENT_SEGMENTS, self.max_erst),
+                           interrupter)
+        er.enable()
+        self.interrupters[interrupter] = er
+        xhci_debug("Interrupter %d : event ring %s (%d segments)" % (interrupter, hex(er.ring), len(er.segments)))
+        self.save_state()
+        return er
+
+    def save_state(self, filename=None):
+        """
+        Remember where the rings and contexts are for attach()
+        """
+        filename = filename if filename is not None else xhci_state_file()
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except:
+            pass
+        state = {
+            "dcbaa": self.dcbaa,
+            "ev_ring_table": self.ev_ring_table,
+            "cr": [self.cr.ring, self.cr.size],
+            "interrupters": dict((str(interrupter), [er.table, len(er.segments)])
+                                 for (interrupter, er) in self.interrupters.items()),
+            "dma_buffer": self.dma_buffer,
+            "dma_heap": mem.get_dma_heap(),
+            "transfer_rings": dict((str(port), [tr.ring, tr.size])
+                                   for (port, tr) in enumerate(self.transfer_rings) if tr is not None),
+        }
+        with open(filename, "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+
+    def load_state(self, filename, dcbaa, ev_ring_table):
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "r") as f:
+            state = json.load(f)
+        if state["dcbaa"] != dcbaa or state["ev_ring_table"] != ev_ring_table:
+            xhci_debug("%s is from another setup, ignoring it" % filename)
+            return None
+        return state
+
+    def attach(self, filename=None):
+        """
+        Pick up a controller left running by a previous session instead of
+        resetting it with setup(), so attached devices stay up
+
+        DCBAAP, ERSTBA/ERDP and the device contexts are read back from the
+        controller, ring positions and cycle states from the rings' cycle
+        bits. The command ring pointer can't be read back (CRCR reads as 0),
+        it comes from the file save_state() wrote during setup(); without
+        it the command ring is stopped and replaced by a new one.
+        Returns False when the controller isn't running.
+        """
+        op = self.bar_read_block(0x80, 0x40)
+        usbcmd, usbsts, pagesize = struct.unpack_from("<III", op, 0)
+        dcbaa = struct.unpack_from("<Q", op, 0x30)[0] & ~0x3F
+        if not usbcmd & 1 or usbsts & (1 | 1 << 11) or not dcbaa:
+            xhci_debug("Controller isn't running, it needs setup()")
+            return False
+        hcsparams1, hcsparams2 = struct.unpack("<II", self.bar_read_block(0x4, 8))
+        self.page_size = (pagesize & 0xFFFF) << 12
+        self.max_slots = hcsparams1 & 0xff
+        self.max_ports = hcsparams1 >> 24
+        self.set_event_limits(hcsparams1, hcsparams2)
+        self.dcbaa = dcbaa
+
+        self.er = self.attach_interrupter(0)
+        if self.er is None:
+            xhci_debug("Interrupter 0 has no event ring, it needs setup()")
+            return False
+        self.ev_ring_table = self.er.table
+        self.interrupters = {0: self.er}
+        filename = filename if filename is not None else xhci_state_file()
+        state = self.load_state(filename, self.dcbaa, self.ev_ring_table)
+        for interrupter in sorted(int(n) for n in state.get("interrupters", {})) if state is not None else []:
+            if interrupter:
+                er = self.attach_interrupter(interrupter)
+                if er is not None:
+                    self.interrupters[interrupter] = er
+        heap = []
+        for er in self.interrupters.values():
+            heap += [er.table + len(er.segments) * 0x10] + [ring + size * 0x10 for (ring, size) in er.segments]
+
+        self.cr = None
+        self.dma_buffer = None
+        if state is not None:
+            self.cr = XHCICommandRing(state["cr"][1], state["cr"][0])
+            self.dma_buffer = state["dma_buffer"]
+            heap += [state["dma_heap"], self.cr.ring + self.cr.size * 0x10]
+
+        # Device contexts and EP0 transfer rings
+        self.devs = [None] * self.max_ports
+        self.transfer_rings = [None] * self.max_ports
+        rings = state["transfer_rings"] if state is not None else {}
+        entries = struct.unpack("<%dQ" % (self.max_slots + 1), bytes(bytearray(
+            t.memblock(phys(self.dcbaa), (self.max_slots + 1) * 8, 1).ToRawBytes())))
+        heap.append(self.dcbaa + len(entries) * 8)
+        for slot_id in range(1, len(entries)):
+            ctx = entries[slot_id] & ~0x3F
+            if not ctx:
+                continue
+            contexts = bytes(bytearray(t.memblock(phys(ctx), 0x40, 1).ToRawBytes()))
+            port = (struct.unpack_from("<I", contexts, 4)[0] >> 16) & 0xFF
+            if port >= self.max_ports:
+                continue
+            self.devs[port] = XHCIDevice(slot_id, ctx)
+            ring, size = rings.get(str(port), [struct.unpack_from("<Q", contexts, 0x28)[0] & ~0xF, 32])
+            self.transfer_rings[port] = XHCICycleRing(size, ring)
+            heap += [ctx + XHCIDevice.NUM_EPS * 0x20, ring + size * 0x10]
+            xhci_debug("Slot %d on port %d" % (slot_id, port + 1))
+
+        # Scratchpad buffers
+        if entries[0]:
+            self.sp_ptrs = entries[0]
+            max_sp_hi = (self.bar_read32(0x8) & 0x03E00000) >> 21
+            max_sp_lo = (self.bar_read32(0x8) & 0xF8000000) >> 27
+            self.max_sp_bufs = max_sp_hi << 5 | max_sp_lo
+            if self.max_sp_bufs:
+                pages = struct.unpack("<%dQ" % self.max_sp_bufs, bytes(bytearray(
+                    t.memblock(phys(self.sp_ptrs), self.max_sp_bufs * 8, 1).ToRawBytes())))
+                heap += [self.sp_ptrs + self.max_sp_bufs * 8] + [page + self.page_size for page in pages]
+
+        # Don't let new allocations overwrite what the controller uses
+        mem.set_dma_heap(max([mem.get_dma_heap() or 0] + heap))
+        if self.cr is None:
+            if self.bar_read32(0x98) & 8:
+                # CS, the stop is reported by an event
+                self.bar_write32(0x98, 0x2)
+                self.handshake(0x98, 8, 0)
+                self.er.handle_events()
+            self.cr = XHCICommandRing(4)
+            self.bar_write32(0x98, self.cr.ring | self.cr.pcs)
+            self.bar_write32(0x9c, 0)
+        if self.dma_buffer is None:
+            self.dma_buffer = dma_align(64 * 1024, 64 * 1024)
+        xhci_debug("Attached: command ring %s, event ring %s (dequeue %s, cycle %d)" %
+                   (hex(self.cr.ring), hex(self.er.ring), hex(self.er.current), self.er.pcs))
+        self.save_state(filename)
+        return True
+
+    def attach_interrupter(self, interrupter):
+        # ERSTSZ, ERSTBA, ERDP of a running interrupter
+        ir = self.bar_read_block(0x2028 + 0x20 * interrupter, 0x18)
+        erstsz = struct.unpack_from("<I", ir, 0)[0] & 0xFFFF
+        table = struct.unpack_from("<Q", ir, 0x8)[0] & ~0x3F
+        erdp = struct.unpack_from("<Q", ir, 0x10)[0]
+        if not erstsz or not table:
+            return None
+        return XHCIEventRing(0, erstsz, interrupter, table, erdp)
         
     def check_ports(self):
         for i in range(self.max_ports):
@@ -733,7 +1076,8 @@ class XHCI:
         
         self.devs[port] = XHCIDevice(slot_id)
         self.transfer_rings[port] = tr
-        self.set(self.dcbaa + slot_id, ic.dev.ctx)
+        # DCBAA entries are 64 bit, pointing at the output device context
+        self.set(self.dcbaa + int(slot_id) * 8, self.devs[port].ctx)
         self.cr.address_device(slot_id, ic.ctx)
         
         